@@ -8,7 +8,7 @@ sys.path.extend([ os.path.join(base_dir, d) for d in
     ( 'lib', 'extlib' ) 
 ])
 
-import pickle, time, md5
+import time, md5
 
 import wsgiref.handlers
 import feedparser, simplejson
@@ -18,10 +18,15 @@ from xml.sax.saxutils import escape, unescape
 
 from datetime import datetime
 
-from google.appengine.ext import webapp
-from google.appengine.ext import db
-from google.appengine.api import urlfetch
-from google.appengine.api import memcache
+from backend import webapp, db, urlfetch, memcache
+
+from messagequeue import MessageQueueRequestHandler, \
+    MessageQueueStatsHandler, MessageQueueCompactHandler, \
+    MessageQueueBackfillHandler
+from feedmagick.fetcher import FeedFetcher
+from feedmagick.fetchcache import request_fingerprint, local_cache, \
+    cache_get_multi, cache_set, result_size, acquire_refresh, \
+    release_refresh, await_refreshes, fetches_in_flight, FetchInProgress
 
 class MainHandler(webapp.RequestHandler):
 
@@ -86,34 +91,222 @@ class MainHandler(webapp.RequestHandler):
                 msg.put()
                 """
 
-                """
-                feed_resp = self.urlfetch_cached(url)
-                out.append('%s : %s = %s' % ( len(feed_resp['content']), 'cache_time' in feed_resp and feed_resp['cache_time'] or 'n/a', url ) )
-                """
+            # Fetch all the feeds at once, rather than one after another.
+            feed_resps, feed_errors = self.urlfetch_cached_many(feed_urls)
+            for url in feed_urls:
+                if url in feed_resps:
+                    feed_resp = feed_resps[url]
+                    out.append('%s : %s = %s' % ( len(feed_resp['content']), 'cache_time' in feed_resp and feed_resp['cache_time'] or 'n/a', url ) )
+                else:
+                    out.append('%s = %s' % ( escape('%s' % feed_errors.get(url, 'not fetched')), url ) )
         
         self.response.out.write("<br />\n".join(out))
 
     def urlfetch_cached(self, url, payload=None, method='GET', headers=None, 
-            allow_truncated=False, follow_redirects=True, cache_max_age=600):
-        """Wrap urlfetch.fetch() calls in some caching magic."""
+            allow_truncated=False, follow_redirects=True, cache_max_age=600,
+            stale_max_age=3600):
+        """
+        Wrap urlfetch.fetch() calls in some caching magic.  Results older
+        than cache_max_age, by up to stale_max_age, are served stale while
+        a single caller refreshes them.  Anything else not freshly cached is
+        fetched by a single caller too, with the rest waiting for it to turn
+        up in memcache, and raising FetchInProgress if it doesn't in time.
+        """
 
-        # TODO: account for all parameters in the above
-        cache_key = 'feedmagick:feed:%(url)s' % ({
-            'url': url
-        })
+        # Key the cache on everything that can change the result.
+        cache_key = self.urlfetch_cache_key(url, payload, method, headers,
+            allow_truncated, follow_redirects)
 
-        # Try grabbing and unpickling cached results
-        cache_data    = memcache.get(cache_key)
-        cached_result = cache_data and pickle.loads(cache_data) or {}
+        # Try grabbing cached results, from this process or else memcache
+        cached_result = self.urlfetch_cache_lookup([ cache_key ], 
+            cache_max_age)[cache_key]
 
         # Tolerate possibly stale cache for up to cache_max_age seconds
-        if 'cache_time' in cached_result: 
-            if time.time() - cached_result['cache_time'] < cache_max_age:
+        if self.urlfetch_cache_fresh(cached_result, cache_max_age):
+            cached_result['cache_hit'] = True
+            return cached_result
+
+        # Only one caller anywhere fetches.  The rest serve a stale result
+        # as is, or else wait for the fetch to land in memcache.
+        if not acquire_refresh(cache_key):
+            if self.urlfetch_cache_fresh(cached_result, 
+                    cache_max_age + stale_max_age):
                 cached_result['cache_hit'] = True
+                cached_result['cache_stale'] = True
                 return cached_result
 
+            results, taken = await_refreshes(
+                { cache_key: cached_result.get('cache_time', 0) })
+            if cache_key in results:
+                return self.urlfetch_cache_awaited(cache_key, 
+                    results[cache_key])
+            if not taken:
+                raise FetchInProgress('Timed out waiting on fetch of %s' % 
+                    url)
+
+        # Fetch, sharing the fetch with any others for the same key already
+        # in flight in this process.
+        try:
+            result = fetches_in_flight.run(cache_key, self.urlfetch_refresh,
+                cache_key, cached_result, url, payload, method, headers,
+                allow_truncated, follow_redirects)
+        finally:
+            release_refresh(cache_key)
+        return dict(result)
+
+    def urlfetch_refresh(self, cache_key, cached_result, url, payload, method,
+            headers, allow_truncated, follow_redirects):
+        """Fetch a URL and cache the result."""
+
         # If possible, prepare caching headers from previous request.
-        if headers is None: headers = {}
+        headers = self.urlfetch_cache_headers(cached_result, method, headers)
+
+        # Perform the actual URL fetch call.
+        rv = urlfetch.fetch(
+            url=url, payload=payload, method=method, headers=headers, 
+            allow_truncated=allow_truncated, follow_redirects=follow_redirects
+        )
+
+        return self.urlfetch_cache_put(cache_key, cached_result, rv)
+
+    def urlfetch_cached_many(self, urls, cache_max_age=600, 
+            stale_max_age=3600, fetcher=None):
+        """
+        Fetch a list of URLs with the caching of urlfetch_cached(), fetching
+        everything not freshly cached, and not being fetched elsewhere, all
+        at once with a FeedFetcher.  What is being fetched elsewhere is
+        served stale, or else waited for once the rest are fetched.  Returns
+        a dict of results by URL, and a dict of errors by URL for fetches
+        that failed or were waited on in vain.
+        """
+        cache_keys = dict([ (url, self.urlfetch_cache_key(url)) 
+            for url in urls ])
+        cache_data = self.urlfetch_cache_lookup(cache_keys.values(),
+            cache_max_age)
+
+        results, cached_results, awaited = {}, {}, {}
+        for url in urls:
+            if url in results or url in cached_results or url in awaited:
+                continue
+            cache_key = cache_keys[url]
+            cached_result = cache_data[cache_key]
+            if self.urlfetch_cache_fresh(cached_result, cache_max_age):
+                cached_result['cache_hit'] = True
+                results[url] = cached_result
+            elif acquire_refresh(cache_key):
+                cached_results[url] = cached_result
+            elif self.urlfetch_cache_fresh(cached_result, 
+                    cache_max_age + stale_max_age):
+                cached_result['cache_hit'] = True
+                cached_result['cache_stale'] = True
+                results[url] = cached_result
+            else:
+                awaited[url] = cached_result
+
+        if fetcher is None: fetcher = FeedFetcher()
+        errors = self.urlfetch_refresh_many(fetcher, cache_keys, 
+            cached_results, results)
+
+        # Wait on fetches elsewhere, and make any let go of unfinished here.
+        if awaited:
+            found, taken = await_refreshes(dict([ 
+                (cache_keys[url], cached_result.get('cache_time', 0))
+                for url, cached_result in awaited.items() ]))
+            taken_results = {}
+            for url, cached_result in awaited.items():
+                cache_key = cache_keys[url]
+                if cache_key in found:
+                    results[url] = self.urlfetch_cache_awaited(cache_key,
+                        found[cache_key])
+                elif cache_key in taken:
+                    taken_results[url] = cached_result
+                else:
+                    errors[url] = FetchInProgress(
+                        'Timed out waiting on fetch of %s' % url)
+            errors.update(self.urlfetch_refresh_many(fetcher, cache_keys,
+                taken_results, results))
+
+        return results, errors
+
+    def urlfetch_refresh_many(self, fetcher, cache_keys, cached_results, 
+            results):
+        """
+        Fetch URLs whose refreshes this caller holds, all at once, adding
+        the results to a dict by URL and letting go of the refreshes.
+        Returns a dict of errors by URL for fetches that failed.
+        """
+        if not cached_results: return {}
+        try:
+            responses, errors = fetcher.fetch_all(cached_results.keys(), 
+                headers_by_url=dict([ 
+                    (url, self.urlfetch_cache_headers(cached_result, 'GET', 
+                        None))
+                    for url, cached_result in cached_results.items() ]))
+            for url, rv in responses.items():
+                results[url] = self.urlfetch_cache_put(cache_keys[url],
+                    cached_results[url], rv)
+        finally:
+            for url in cached_results: release_refresh(cache_keys[url])
+        return errors
+
+    def urlfetch_cache_awaited(self, cache_key, cached_result):
+        """
+        Keep a result fetched by another caller in this process too, and
+        return it as a cache hit.
+        """
+        local_cache.set(cache_key, cached_result, result_size(cached_result))
+        cached_result = dict(cached_result)
+        cached_result['cache_hit'] = True
+        return cached_result
+
+    def urlfetch_cache_key(self, url, payload=None, method='GET', 
+            headers=None, allow_truncated=False, follow_redirects=True):
+        """Build the memcache key for a cached fetch."""
+        return 'feedmagick:fetch:%(fingerprint)s' % ({
+            'fingerprint': request_fingerprint(url, payload, method, headers,
+                allow_truncated, follow_redirects)
+        })
+
+    def urlfetch_cache_lookup(self, cache_keys, cache_max_age=None):
+        """
+        Look up cached results by key, first in this process and then in
+        memcache for the rest, keeping what memcache had in this process.
+        Given cache_max_age, results here that are no longer fresh are
+        looked up in memcache too, in case another instance refreshed them,
+        and the newer copy wins.  Returns a dict of results by key, empty
+        for those not cached.
+        """
+        results, missing = {}, []
+        for cache_key in cache_keys:
+            cached_result = local_cache.get(cache_key)
+            if cached_result is None:
+                results[cache_key] = {}
+                missing.append(cache_key)
+            else:
+                results[cache_key] = dict(cached_result)
+                if cache_max_age is not None and not \
+                        self.urlfetch_cache_fresh(cached_result, cache_max_age):
+                    missing.append(cache_key)
+
+        cache_data = cache_get_multi(missing)
+        for cache_key in missing:
+            cached_result = cache_data.get(cache_key)
+            if cached_result and cached_result.get('cache_time', 0) > \
+                    results[cache_key].get('cache_time', 0):
+                local_cache.set(cache_key, cached_result, 
+                    result_size(cached_result))
+                results[cache_key] = dict(cached_result)
+
+        return results
+
+    def urlfetch_cache_fresh(self, cached_result, cache_max_age):
+        """Decide whether a cached result is fresh enough to use as is."""
+        return 'cache_time' in cached_result and \
+            time.time() - cached_result['cache_time'] < cache_max_age
+
+    def urlfetch_cache_headers(self, cached_result, method, headers):
+        """Add conditional GET headers from a cached result, if possible."""
+        headers = dict(headers or {})
         if method == 'GET' and 'headers' in cached_result:
             if 'Last-Modified' in cached_result['headers']:
                 headers['If-Modified-Since'] = \
@@ -121,12 +314,10 @@ class MainHandler(webapp.RequestHandler):
             if 'ETag' in cached_result['headers']:
                 headers['If-None-Match'] = \
                     cached_result['headers']['ETag']
+        return headers
 
-        # Perform the actual URL fetch call.
-        rv = urlfetch.fetch(
-            url=url, payload=payload, method=method, headers=headers, 
-            allow_truncated=allow_truncated, follow_redirects=follow_redirects
-        )
+    def urlfetch_cache_put(self, cache_key, cached_result, rv):
+        """Cache the result of a fetch, unless it wasn't modified."""
 
         # Convert urlfetch response object into a plain old dict.
         result = dict([ 
@@ -135,13 +326,19 @@ class MainHandler(webapp.RequestHandler):
         ])
 
         if result['status_code'] == 304:
-            # On a not modified response, return the cached results.
+            # On a not modified response, the cached results are good for
+            # another cache_max_age, so restamp and return them.
+            cached_result['cache_time'] = time.time()
+            cache_set(cache_key, cached_result)
+            local_cache.set(cache_key, dict(cached_result), 
+                result_size(cached_result))
             cached_result['cache_hit'] = True
             return cached_result
         else:
             # Otherwise, cache the fresh results and return them.
             result['cache_time'] = time.time()
-            memcache.set(cache_key, pickle.dumps(result))
+            cache_set(cache_key, result)
+            local_cache.set(cache_key, dict(result), result_size(result))
             result['cache_hit'] = False
             return result
 
@@ -200,7 +397,8 @@ class Feed(db.Model):
         """ """
         if not 'key_name' in kw:
             kw['key_name'] = Feed.buildKeyName(kw)
-        return db.Model.get_or_insert(cls, **kw)
+        key_name = kw.pop('key_name')
+        return super(Feed, cls).get_or_insert(key_name, **kw)
 
     def __init__(self, parent=None, key_name=None, **kw):
         """ """
@@ -223,7 +421,11 @@ class Entry(db.Model):
 
 def main():
     app = webapp.WSGIApplication([
-        ('/', MainHandler)
+        ('/', MainHandler),
+        ('/queue/work', MessageQueueRequestHandler),
+        ('/queue/stats', MessageQueueStatsHandler),
+        ('/queue/compact', MessageQueueCompactHandler),
+        ('/queue/backfill', MessageQueueBackfillHandler)
     ], debug=True)
 
     import firepython.middleware.FirePythonWSGI
@@ -0,0 +1,23 @@
+"""
+Pluggable backend for the App Engine services this app uses: db, memcache,
+urlfetch, and webapp.
+
+Set FEEDMAGICK_BACKEND to 'appengine' or 'local' to choose between the App
+Engine APIs and the in-memory stand-ins in localbackend.  By default, the App
+Engine APIs are used whenever they can be imported.
+"""
+import os
+
+BACKEND = os.environ.get('FEEDMAGICK_BACKEND')
+
+if BACKEND != 'local':
+    try:
+        from google.appengine.ext import db, webapp
+        from google.appengine.api import memcache, urlfetch
+        BACKEND = 'appengine'
+    except ImportError:
+        if BACKEND == 'appengine': raise
+        BACKEND = 'local'
+
+if BACKEND == 'local':
+    from localbackend import db, memcache, urlfetch, webapp
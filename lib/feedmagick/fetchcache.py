@@ -0,0 +1,465 @@
+"""
+Caching for urlfetch results.
+"""
+import time, threading, md5, urlparse, struct, zlib, logging
+
+from backend import memcache, urlfetch
+
+# Request headers that don't change what comes back, either because the
+# cache adds them itself for conditional fetches or because they only
+# concern the connection.
+IGNORED_HEADERS = (
+    'if-modified-since', 'if-none-match', 'if-match', 'if-unmodified-since',
+    'if-range', 'cache-control', 'pragma', 'connection', 'keep-alive', 'te',
+    'trailer', 'transfer-encoding', 'upgrade', 'content-length', 'host',
+    'referer'
+)
+
+DEFAULT_PORTS = { 'http': '80', 'https': '443' }
+
+def canonical_url(url):
+    """
+    Normalize a URL for comparison: lowercase scheme and host, no default
+    port, an empty path as '/', and no fragment.
+    """
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    scheme = scheme.lower()
+    netloc = netloc.lower()
+    if ':' in netloc and netloc.rsplit(':', 1)[1] == \
+            DEFAULT_PORTS.get(scheme):
+        netloc = netloc.rsplit(':', 1)[0]
+    return urlparse.urlunsplit((scheme, netloc, path or '/', query, ''))
+
+def request_fingerprint(url, payload=None, method='GET', headers=None,
+        allow_truncated=False, follow_redirects=True):
+    """
+    Build a fingerprint of everything about a fetch that can change its
+    result: the canonical URL, the method, a hash of the payload, the
+    headers that matter with names lowercased and sorted, and the flags.
+    Fetches with the same fingerprint can share a cached result.
+    """
+    header_lines = [
+        '%s:%s' % (name.lower().strip(), ('%s' % value).strip())
+        for name, value in (headers or {}).items()
+        if name.lower().strip() not in IGNORED_HEADERS
+    ]
+    header_lines.sort()
+    parts = [
+        method.upper(),
+        canonical_url(url),
+        payload is not None and md5.new(payload).hexdigest() or '',
+        '\n'.join(header_lines),
+        'truncated=%s' % (allow_truncated and 1 or 0),
+        'redirects=%s' % (follow_redirects and 1 or 0)
+    ]
+    return md5.new('\n'.join(parts)).hexdigest()
+
+class LRUCache:
+    """
+    In-process cache holding up to max_bytes worth of values, dropping the
+    least recently used first, with each value expiring after its own time
+    to live.  Counts hits, misses, evictions, and expirations.
+    """
+    MAX_BYTES = 8 * 1024 * 1024
+    TTL       = 60
+
+    def __init__(self, max_bytes=MAX_BYTES, ttl=TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """
+        Drop everything, and zero the counters.
+        """
+        self._lock.acquire()
+        try:
+            # Entries are [ prev, next, key, value, size, expires ], linked
+            # in a ring through a root entry from least to most recently used.
+            self._root = [ None, None, None, None, 0, None ]
+            self._root[0] = self._root[1] = self._root
+            self._entries = {}
+            self.bytes = 0
+            self.hits = self.misses = self.evictions = self.expirations = 0
+        finally:
+            self._lock.release()
+
+    def get(self, key):
+        """
+        Get a value, or None if it's missing or expired.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None and entry[5] is not None and \
+                    entry[5] <= time.time():
+                self._unlink(entry)
+                self.expirations = self.expirations + 1
+                entry = None
+            if entry is None:
+                self.misses = self.misses + 1
+                return None
+            self._unlink(entry)
+            self._link(entry)
+            self.hits = self.hits + 1
+            return entry[3]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, size, ttl=None):
+        """
+        Set a value taking up size bytes, expiring after ttl seconds or else
+        the cache's default.  Values too big to ever fit aren't kept.
+        """
+        if ttl is None: ttl = self.ttl
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None: self._unlink(entry)
+            if size > self.max_bytes: return False
+            while self.bytes + size > self.max_bytes:
+                self._unlink(self._root[1])
+                self.evictions = self.evictions + 1
+            self._link([ None, None, key, value, size,
+                ttl and time.time() + ttl or None ])
+            return True
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        """
+        Drop a value, if it's there.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None: self._unlink(entry)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        Report the counters, along with how much is held.
+        """
+        self._lock.acquire()
+        try:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'items': len(self._entries),
+                'bytes': self.bytes
+            }
+        finally:
+            self._lock.release()
+
+    def _link(self, entry):
+        last = self._root[0]
+        entry[0], entry[1] = last, self._root
+        last[1] = self._root[0] = entry
+        self._entries[entry[2]] = entry
+        self.bytes = self.bytes + entry[4]
+
+    def _unlink(self, entry):
+        entry[0][1], entry[1][0] = entry[1], entry[0]
+        del self._entries[entry[2]]
+        self.bytes = self.bytes - entry[4]
+
+# Results cached in this process, in front of memcache.
+local_cache = LRUCache()
+
+# Cached results are kept in memcache as versioned records: a fixed header
+# with the status, flags, cache time, and the length and checksum of the
+# body, then the ETag and Last-Modified headers, then the body compressed
+# with zlib.  The body holds the rest of the response headers, a blank
+# line, and the content.
+RECORD_MAGIC   = 'FMC'
+RECORD_VERSION = 1
+RECORD_HEADER  = struct.Struct('!3sBHBdII')
+RECORD_STRING  = struct.Struct('!H')
+RECORD_LEVEL   = 6
+
+RECORD_TRUNCATED = 1
+
+# Records bigger than this are split across several memcache keys, well
+# under memcache's 1MB limit on values.
+CHUNK_BYTES = 900 * 1000
+
+class BadRecord(Exception):
+    """
+    Raised when a cache record is from another version, cut short, or
+    otherwise can't be read.
+    """
+    pass
+
+def _get_header(headers, name):
+    """
+    Find a header by name, whatever its case.
+    """
+    for key, value in headers.items():
+        if key.lower() == name.lower(): return key, value
+    return None, None
+
+def _encode(value):
+    if isinstance(value, unicode): return value.encode('utf-8')
+    return '%s' % value
+
+def pack_result(result):
+    """
+    Pack a cached fetch result into a record.
+    """
+    headers = dict(result.get('headers') or {})
+    strings = []
+    for name in ('ETag', 'Last-Modified'):
+        key, value = _get_header(headers, name)
+        if key is not None: del headers[key]
+        value = value is not None and _encode(value) or ''
+        strings.append(RECORD_STRING.pack(len(value)) + value)
+
+    header_lines = [ '%s: %s' % (_encode(name), _encode(value))
+        for name, value in headers.items() ]
+    body = zlib.compress('\r\n'.join(header_lines) + '\r\n\r\n' +
+        (result.get('content') or ''), RECORD_LEVEL)
+
+    flags = 0
+    if result.get('content_was_truncated'): flags = flags | RECORD_TRUNCATED
+    return ''.join([
+        RECORD_HEADER.pack(RECORD_MAGIC, RECORD_VERSION,
+            result.get('status_code') or 0, flags,
+            result.get('cache_time') or 0, len(body),
+            zlib.crc32(body) & 0xffffffff)
+    ] + strings + [ body ])
+
+def record_length(head):
+    """
+    Work out the full length of a record from its first chunk, raising
+    BadRecord if it isn't one.
+    """
+    if len(head) < RECORD_HEADER.size: raise BadRecord('Record cut short')
+    magic, version, status_code, flags, cache_time, body_length, crc = \
+        RECORD_HEADER.unpack(head[:RECORD_HEADER.size])
+    if magic != RECORD_MAGIC or version != RECORD_VERSION:
+        raise BadRecord('Not a version %s record' % RECORD_VERSION)
+    offset = RECORD_HEADER.size
+    for i in range(2):
+        if len(head) < offset + RECORD_STRING.size:
+            raise BadRecord('Record cut short')
+        offset = offset + RECORD_STRING.size + \
+            RECORD_STRING.unpack(head[offset:offset + RECORD_STRING.size])[0]
+    return offset + body_length
+
+def unpack_result(record):
+    """
+    Unpack a record into a cached fetch result, raising BadRecord if it's
+    not whole.
+    """
+    if len(record) != record_length(record):
+        raise BadRecord('Record is the wrong length')
+    magic, version, status_code, flags, cache_time, body_length, crc = \
+        RECORD_HEADER.unpack(record[:RECORD_HEADER.size])
+    offset, strings = RECORD_HEADER.size, []
+    for i in range(2):
+        length = RECORD_STRING.unpack(
+            record[offset:offset + RECORD_STRING.size])[0]
+        offset = offset + RECORD_STRING.size
+        strings.append(record[offset:offset + length])
+        offset = offset + length
+
+    body = record[offset:]
+    if zlib.crc32(body) & 0xffffffff != crc:
+        raise BadRecord('Record checksum mismatch')
+    try:
+        header_block, content = zlib.decompress(body).split('\r\n\r\n', 1)
+    except (zlib.error, ValueError), e:
+        raise BadRecord('Record body unreadable: %s' % e)
+
+    headers = {}
+    for line in header_block and header_block.split('\r\n') or []:
+        name, value = line.split(': ', 1)
+        headers[name] = value
+    for name, value in zip(('ETag', 'Last-Modified'), strings):
+        if value: headers[name] = value
+
+    return {
+        'content': content,
+        'status_code': status_code,
+        'headers': headers,
+        'content_was_truncated': bool(flags & RECORD_TRUNCATED),
+        'cache_time': cache_time
+    }
+
+def result_size(result):
+    """
+    Estimate how many bytes a result takes up in memory.
+    """
+    size = len(result.get('content') or '')
+    for name, value in (result.get('headers') or {}).items():
+        size = size + len(name) + len('%s' % value)
+    return size
+
+def _chunk_key(cache_key, i):
+    return '%s:%s' % (cache_key, i)
+
+def cache_set(cache_key, result):
+    """
+    Pack a result and store it in memcache, in as many chunks as it takes
+    after the first at cache_key.  Returns the size of the record, or None
+    if memcache didn't take it.
+    """
+    record = pack_result(result)
+    chunks = [ record[i:i + CHUNK_BYTES]
+        for i in range(0, len(record), CHUNK_BYTES) ]
+    mapping = { cache_key: chunks[0] }
+    for i in range(1, len(chunks)):
+        mapping[_chunk_key(cache_key, i)] = chunks[i]
+    failed = memcache.set_multi(mapping)
+    if failed:
+        logging.getLogger().warning('Failed to cache %s of %s chunks for %s' %
+            (len(failed), len(chunks), cache_key))
+        memcache.delete(cache_key)
+        return None
+    return len(record)
+
+def cache_get_multi(cache_keys):
+    """
+    Look up results in memcache, fetching the first chunk of each and then
+    the rest of any that were split.  Records that are missing chunks, or
+    can't be read, are left out.  Returns a dict of results by key.
+    """
+    heads = cache_keys and memcache.get_multi(cache_keys) or {}
+
+    lengths, more = {}, []
+    for cache_key, head in heads.items():
+        try:
+            lengths[cache_key] = record_length(head)
+        except (BadRecord, TypeError), e:
+            continue
+        for i in range(1, (lengths[cache_key] - 1) / CHUNK_BYTES + 1):
+            more.append(_chunk_key(cache_key, i))
+    chunks = more and memcache.get_multi(more) or {}
+
+    results = {}
+    for cache_key, length in lengths.items():
+        parts = [ heads[cache_key] ] + [ chunks.get(_chunk_key(cache_key, i))
+            for i in range(1, (length - 1) / CHUNK_BYTES + 1) ]
+        if None in parts: continue
+        try:
+            results[cache_key] = unpack_result(''.join(parts))
+        except BadRecord, e:
+            logging.getLogger().warning('Unreadable cache record %s: %s' %
+                (cache_key, e))
+    return results
+
+# How long one caller may hold on to refreshing a stale result, before
+# another is let try, should the first never finish.
+REFRESH_LOCK_SECONDS = 30
+
+# How long a caller with no result to serve waits on another caller's
+# refresh of it, and how often it looks, before giving up.
+REFRESH_WAIT_SECONDS  = 5
+REFRESH_WAIT_INTERVAL = 0.1
+
+class FetchInProgress(urlfetch.Error):
+    """
+    Raised when another caller is fetching a result that there's nothing
+    cached to stand in for, and it doesn't turn up in time.
+    """
+    pass
+
+def _refresh_key(cache_key):
+    return '%s:refresh' % cache_key
+
+def acquire_refresh(cache_key):
+    """
+    Try to become the one caller refreshing a cached result, returning
+    True if no other caller anywhere already is.
+    """
+    return bool(memcache.add(_refresh_key(cache_key), time.time(),
+        time=REFRESH_LOCK_SECONDS))
+
+def release_refresh(cache_key):
+    """
+    Let go of refreshing a cached result.
+    """
+    memcache.delete(_refresh_key(cache_key))
+
+def await_refreshes(since, timeout=None, interval=None):
+    """
+    Wait for other callers' refreshes of cached results to turn up in
+    memcache, for up to timeout seconds, looking every interval seconds,
+    or else REFRESH_WAIT_SECONDS and REFRESH_WAIT_INTERVAL.  since is a dict
+    by cache key of the cache_time of what the caller already has of each,
+    or 0 for nothing.
+
+    Returns a dict by key of the newer results that turned up, and a list
+    of keys whose refreshes were let go of without one, which the caller
+    now holds the refresh of instead.  Keys in neither timed out.
+    """
+    if timeout is None: timeout = REFRESH_WAIT_SECONDS
+    if interval is None: interval = REFRESH_WAIT_INTERVAL
+    waiting = dict(since)
+    results, taken = {}, []
+    stop = time.time() + timeout
+    while waiting:
+        found = cache_get_multi(waiting.keys())
+        for cache_key, result in found.items():
+            if result.get('cache_time', 0) > waiting[cache_key]:
+                results[cache_key] = result
+                del waiting[cache_key]
+        for cache_key in waiting.keys():
+            if acquire_refresh(cache_key):
+                taken.append(cache_key)
+                del waiting[cache_key]
+        if not waiting or time.time() >= stop: break
+        time.sleep(interval)
+    return results, taken
+
+class Coalescer:
+    """
+    Runs calls by key so that callers asking for the same key while a call
+    for it is in flight wait for that call and share its result, or its
+    error, rather than making another.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def run(self, key, func, *args, **kw):
+        """
+        Call func for a key, unless a call for the key is already in flight
+        in this process, in which case wait for that one instead.
+        """
+        self._lock.acquire()
+        try:
+            # Calls are [ done, result, error ].
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = [ threading.Event(), None, None ]
+        finally:
+            self._lock.release()
+
+        if not leader:
+            call[0].wait()
+            if call[2] is not None: raise call[2]
+            return call[1]
+
+        try:
+            try:
+                call[1] = func(*args, **kw)
+            except Exception, e:
+                call[2] = e
+                raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._calls[key]
+            finally:
+                self._lock.release()
+            call[0].set()
+        return call[1]
+
+# Fetches in flight in this process, by cache key.
+fetches_in_flight = Coalescer()
@@ -0,0 +1,111 @@
+"""
+Concurrent fetching of many URLs at once, through asynchronous urlfetch
+calls.
+"""
+import time, logging, urlparse
+
+from backend import urlfetch
+
+class FeedFetcher:
+    """
+    Fetches a list of URLs with up to max_in_flight fetches running at once
+    and no more than per_host of them against any one host, giving up on
+    whatever's left once deadline seconds have passed.
+    """
+    MAX_IN_FLIGHT = 10
+    PER_HOST      = 2
+    DEADLINE      = 20
+
+    # Longest any one fetch may take, further cut short to fit the deadline.
+    FETCH_DEADLINE = 10
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, per_host=PER_HOST,
+            deadline=DEADLINE, fetch_deadline=FETCH_DEADLINE):
+        self.log = logging.getLogger()
+        self.max_in_flight = max_in_flight
+        self.per_host = per_host
+        self.deadline = deadline
+        self.fetch_deadline = fetch_deadline
+
+    def fetch_all(self, urls, headers=None, headers_by_url=None, 
+            method='GET', payload=None, allow_truncated=False, 
+            follow_redirects=True):
+        """
+        Fetch a list of URLs, in order as far as the limits allow, sending
+        the given headers with every fetch along with any in headers_by_url
+        for the URL.
+
+        Returns a dict of responses by URL, and a dict of the errors raised
+        by fetches that failed.  URLs never fetched before the deadline are
+        left out of both.
+        """
+        start = time.time()
+        stop  = start + self.deadline
+        waiting, seen = [], {}
+        for url in urls:
+            if url in seen: continue
+            seen[url] = True
+            waiting.append(url)
+
+        results, errors = {}, {}
+        in_flight, hosts = [], {}
+
+        while waiting or in_flight:
+            # Start as many fetches as the limits allow, skipping over URLs
+            # on hosts already at their limit.
+            remaining = stop - time.time()
+            i = 0
+            while remaining > 0 and i < len(waiting) and \
+                    len(in_flight) < self.max_in_flight:
+                url = waiting[i]
+                host = self._host(url)
+                if hosts.get(host, 0) >= self.per_host:
+                    i = i + 1
+                    continue
+                del waiting[i]
+                url_headers = dict(headers or {})
+                url_headers.update((headers_by_url or {}).get(url, {}))
+                try:
+                    rpc = urlfetch.create_rpc(
+                        deadline=min(self.fetch_deadline, remaining))
+                    urlfetch.make_fetch_call(rpc, url, payload=payload,
+                        method=method, headers=url_headers,
+                        allow_truncated=allow_truncated,
+                        follow_redirects=follow_redirects)
+                except Exception, e:
+                    errors[url] = e
+                    continue
+                in_flight.append( (rpc, url) )
+                hosts[host] = hosts.get(host, 0) + 1
+
+            if not in_flight: break
+
+            rpc = self._wait_any([ r for r, u in in_flight ])
+            for i in range(len(in_flight)):
+                if in_flight[i][0] is rpc: break
+            url = in_flight.pop(i)[1]
+            host = self._host(url)
+            hosts[host] = hosts[host] - 1
+            try:
+                results[url] = rpc.get_result()
+            except Exception, e:
+                self.log.warning('Failed to fetch %s: %s' % (url, e))
+                errors[url] = e
+
+        if waiting:
+            self.log.warning('Deadline passed with %s of %s URLs unfetched' %
+                (len(waiting), len(results) + len(errors) + len(waiting)))
+        return results, errors
+
+    def _host(self, url):
+        return urlparse.urlparse(url)[1].lower()
+
+    def _wait_any(self, rpcs):
+        """
+        Wait for one of a list of fetches to finish, with wait_any() where
+        the RPCs offer it, or else just on the one started first.
+        """
+        wait_any = getattr(type(rpcs[0]), 'wait_any', None)
+        if wait_any: return wait_any(rpcs)
+        rpcs[0].wait()
+        return rpcs[0]
@@ -0,0 +1,5 @@
+"""
+In-memory stand-ins for the subset of the App Engine services used by this
+app, for running tests and benchmarks away from App Engine.  See the backend
+module for how they get picked.
+"""
@@ -0,0 +1,926 @@
+"""
+In-memory stand-in for google.appengine.ext.db, covering models and their
+properties, keys, queries with filters, ordering and cursors, GQL, batch
+get/put/delete, and transactions.
+
+Everything is kept in a module-level dict and guarded by a single lock, so
+transactions simply run one at a time.  They never fail unless told to with
+set_conflict_rate(), which makes commits fail at random as if another
+transaction had got in first, to exercise retries.  Queries follow the
+datastore's rules closely enough to catch queries it would reject: only one
+property may have inequality filters, and it must be sorted on first.
+"""
+import datetime, threading, pickle, base64, re, heapq, random
+
+class Error(Exception): pass
+class BadValueError(Error): pass
+class BadArgumentError(Error): pass
+class BadQueryError(Error): pass
+class BadKeyError(Error): pass
+class BadRequestError(Error): pass
+class KindError(Error): pass
+class NotSavedError(Error): pass
+class TransactionFailedError(Error): pass
+class Rollback(Error): pass
+
+_lock     = threading.RLock()
+_entities = {}
+_by_kind  = {}
+_kinds    = {}
+_next_id  = [ 0 ]
+_tx       = threading.local()
+
+# Most entities a single batch put or delete may take, as in the datastore.
+MAX_BATCH = 500
+
+# How many times a transaction is retried after a conflict before giving up,
+# as in the datastore, and the chance of any commit conflicting.
+TRANSACTION_RETRIES = 3
+_conflicts = { 'rate': 0.0, 'random': random.Random() }
+
+def reset():
+    """
+    Forget everything in the datastore.
+    """
+    _lock.acquire()
+    try:
+        _entities.clear()
+        _by_kind.clear()
+    finally:
+        _lock.release()
+
+def _locked(func):
+    """
+    Decorate a function to run while holding the datastore lock.
+    """
+    def wrapper(*args, **kwds):
+        _lock.acquire()
+        try:
+            return func(*args, **kwds)
+        finally:
+            _lock.release()
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__  = func.__doc__
+    return wrapper
+
+def _type_name(data_type):
+    if isinstance(data_type, tuple):
+        return ' or '.join([ t.__name__ for t in data_type ])
+    return data_type.__name__
+
+class Key(object):
+    """
+    Key of an entity, made of its kind and either a numeric id or a name.
+    """
+    def __init__(self, encoded=None, _path=None):
+        if _path is None:
+            try:
+                kind, marker, value = base64.urlsafe_b64decode(
+                    str(encoded)).split('\x00', 2)
+            except (TypeError, ValueError):
+                raise BadKeyError('Invalid string key %s' % encoded)
+            _path = (kind, marker == 'i' and int(value) or value)
+        self._kind, self._id_or_name = _path
+
+    @classmethod
+    def from_path(cls, kind, id_or_name):
+        return cls(_path=(kind, id_or_name))
+
+    def kind(self):
+        return self._kind
+
+    def id(self):
+        if isinstance(self._id_or_name, (int, long)): return self._id_or_name
+        return None
+
+    def name(self):
+        if isinstance(self._id_or_name, basestring): return self._id_or_name
+        return None
+
+    def id_or_name(self):
+        return self._id_or_name
+
+    def _sort_key(self):
+        return (self._kind, isinstance(self._id_or_name, basestring),
+            self._id_or_name)
+
+    def __cmp__(self, other):
+        if not isinstance(other, Key): return cmp(id(self), id(other))
+        return cmp(self._sort_key(), other._sort_key())
+
+    def __hash__(self):
+        return hash((self._kind, self._id_or_name))
+
+    def __str__(self):
+        marker = self.id() is not None and 'i' or 'n'
+        return base64.urlsafe_b64encode('%s\x00%s\x00%s' %
+            (self._kind, marker, self._id_or_name))
+
+    def __repr__(self):
+        return 'datastore_types.Key.from_path(%r, %r)' % \
+            (self._kind, self._id_or_name)
+
+class Property(object):
+    """
+    Base class for model properties, stored in the model instance's values.
+    """
+    data_type = object
+
+    def __init__(self, verbose_name=None, name=None, default=None,
+            required=False, validator=None, choices=None, indexed=True):
+        self.verbose_name = verbose_name
+        self.name         = name
+        self.default      = default
+        self.required     = required
+        self.validator    = validator
+        self.choices      = choices
+        self.indexed      = indexed
+
+    def __property_config__(self, model_class, property_name):
+        self.model_class = model_class
+        if self.name is None: self.name = property_name
+
+    def __get__(self, model_instance, model_class):
+        if model_instance is None: return self
+        return model_instance._values.get(self.name)
+
+    def __set__(self, model_instance, value):
+        model_instance._values[self.name] = self.validate(value)
+
+    def default_value(self):
+        return self.default
+
+    def empty(self, value):
+        return not value
+
+    def validate(self, value):
+        if self.empty(value):
+            if self.required:
+                raise BadValueError('Property %s is required' % self.name)
+        elif self.data_type is not object and \
+                not isinstance(value, self.data_type):
+            raise BadValueError('Property %s must be a %s, not %r' %
+                (self.name, _type_name(self.data_type), value))
+        if self.choices and value not in self.choices:
+            raise BadValueError('Property %s is %r; must be one of %r' %
+                (self.name, value, self.choices))
+        if self.validator is not None: self.validator(value)
+        return value
+
+    def get_value_for_datastore(self, model_instance):
+        return self.__get__(model_instance, model_instance.__class__)
+
+    def make_value_from_datastore(self, value):
+        return value
+
+class StringProperty(Property):
+    data_type = basestring
+
+class TextProperty(Property):
+    data_type = basestring
+
+class BlobProperty(Property):
+    data_type = str
+
+class LinkProperty(Property):
+    data_type = basestring
+
+class BooleanProperty(Property):
+    data_type = bool
+
+    def empty(self, value):
+        return value is None
+
+class IntegerProperty(Property):
+    data_type = (int, long)
+
+    def empty(self, value):
+        return value is None
+
+    def validate(self, value):
+        if isinstance(value, bool):
+            raise BadValueError('Property %s must be an int or long, not %r' %
+                (self.name, value))
+        return Property.validate(self, value)
+
+class FloatProperty(Property):
+    data_type = float
+
+    def empty(self, value):
+        return value is None
+
+class DateTimeProperty(Property):
+    data_type = datetime.datetime
+
+    def __init__(self, verbose_name=None, auto_now=False, auto_now_add=False,
+            **kwds):
+        Property.__init__(self, verbose_name, **kwds)
+        self.auto_now     = auto_now
+        self.auto_now_add = auto_now_add
+
+    def default_value(self):
+        if self.auto_now or self.auto_now_add: return self.now()
+        return Property.default_value(self)
+
+    def get_value_for_datastore(self, model_instance):
+        if self.auto_now: self.__set__(model_instance, self.now())
+        return Property.get_value_for_datastore(self, model_instance)
+
+    def now(self):
+        return datetime.datetime.now()
+
+class DateProperty(DateTimeProperty):
+    data_type = datetime.date
+
+    def validate(self, value):
+        if isinstance(value, datetime.datetime):
+            raise BadValueError('Property %s must be a date, not a datetime' %
+                self.name)
+        return Property.validate(self, value)
+
+    def now(self):
+        return datetime.date.today()
+
+class ListProperty(Property):
+    """
+    Property holding a list of values of one type.
+    """
+    data_type = list
+
+    def __init__(self, item_type, verbose_name=None, default=None, **kwds):
+        if default is None: default = []
+        Property.__init__(self, verbose_name, default=default, **kwds)
+        self.item_type = item_type
+
+    def __get__(self, model_instance, model_class):
+        if model_instance is None: return self
+        return model_instance._values.setdefault(self.name, [])
+
+    def default_value(self):
+        return list(self.default)
+
+    def empty(self, value):
+        return value is None
+
+    def validate(self, value):
+        value = Property.validate(self, value)
+        for item in value or []:
+            if not isinstance(item, self.item_type):
+                raise BadValueError('Items in property %s must be %s, not %r' %
+                    (self.name, _type_name(self.item_type), item))
+        return value
+
+    def get_value_for_datastore(self, model_instance):
+        return list(self.__get__(model_instance, model_instance.__class__))
+
+    def make_value_from_datastore(self, value):
+        return list(value)
+
+class StringListProperty(ListProperty):
+
+    def __init__(self, verbose_name=None, default=None, **kwds):
+        ListProperty.__init__(self, basestring, verbose_name, default, **kwds)
+
+class ReferenceProperty(Property):
+    """
+    Property referring to another entity by key, dereferenced on access.
+    """
+    def __init__(self, reference_class=None, verbose_name=None,
+            collection_name=None, **kwds):
+        Property.__init__(self, verbose_name, **kwds)
+        self.reference_class = reference_class
+        self.collection_name = collection_name
+
+    def __property_config__(self, model_class, property_name):
+        Property.__property_config__(self, model_class, property_name)
+        if self.reference_class is None: self.reference_class = Model
+        if self.collection_name is None:
+            self.collection_name = '%s_set' % model_class.__name__.lower()
+        setattr(self.reference_class, self.collection_name,
+            _ReverseReferenceProperty(model_class, self.name))
+
+    def __get__(self, model_instance, model_class):
+        if model_instance is None: return self
+        key = model_instance._values.get(self.name)
+        if key is None: return None
+        cached = model_instance._refs.get(self.name)
+        if cached is None:
+            cached = self.reference_class.get(key)
+            model_instance._refs[self.name] = cached
+        return cached
+
+    def __set__(self, model_instance, value):
+        value = self.validate(value)
+        model_instance._refs.pop(self.name, None)
+        if isinstance(value, Model):
+            model_instance._refs[self.name] = value
+            value = value.key()
+        model_instance._values[self.name] = value
+
+    def validate(self, value):
+        if isinstance(value, Model) and not value.is_saved():
+            raise BadValueError('%s instance must be saved before it can be '
+                'referred to' % value.kind())
+        return Property.validate(self, value)
+
+    def empty(self, value):
+        return value is None
+
+    def get_value_for_datastore(self, model_instance):
+        return model_instance._values.get(self.name)
+
+class _ReverseReferenceProperty(object):
+    """
+    Query for the entities referring to a model instance through a
+    ReferenceProperty.
+    """
+    def __init__(self, model_class, property_name):
+        self.model_class   = model_class
+        self.property_name = property_name
+
+    def __get__(self, model_instance, model_class):
+        if model_instance is None: return self
+        return Query(self.model_class)\
+            .filter('%s =' % self.property_name, model_instance.key())
+
+class PropertiedClass(type):
+    """
+    Metaclass collecting the properties of model classes.
+    """
+    def __init__(cls, name, bases, dct):
+        super(PropertiedClass, cls).__init__(name, bases, dct)
+        cls._properties = {}
+        for base in bases[::-1]:
+            cls._properties.update(getattr(base, '_properties', {}))
+        for attr, value in dct.items():
+            if isinstance(value, Property):
+                value.__property_config__(cls, attr)
+                cls._properties[value.name] = value
+        if dct.get('__module__') != __name__:
+            _kinds[name] = cls
+
+class Model(object):
+    """
+    Base class for datastore models.
+    """
+    __metaclass__ = PropertiedClass
+
+    def __init__(self, parent=None, key_name=None, **kwds):
+        self._values = {}
+        self._refs   = {}
+        self._key    = None
+        self._saved  = False
+        if key_name is not None:
+            if not isinstance(key_name, basestring) or not key_name or \
+                    key_name[0].isdigit():
+                raise BadValueError('Invalid key name %r' % key_name)
+            self._key = Key.from_path(self.kind(), key_name)
+        for name, prop in self._properties.items():
+            if name in kwds:
+                prop.__set__(self, kwds[name])
+            else:
+                prop.__set__(self, prop.default_value())
+
+    @classmethod
+    def _from_stored(cls, key, values):
+        instance = cls.__new__(cls)
+        instance._values = {}
+        instance._refs   = {}
+        instance._key    = key
+        instance._saved  = True
+        for name, prop in cls._properties.items():
+            if name in values:
+                instance._values[name] = \
+                    prop.make_value_from_datastore(values[name])
+        return instance
+
+    def _to_stored(self):
+        return dict([
+            (name, prop.get_value_for_datastore(self))
+            for name, prop in self._properties.items()
+        ])
+
+    def key(self):
+        if self._key is None:
+            raise NotSavedError('%s instance has not been saved' % self.kind())
+        return self._key
+
+    def is_saved(self):
+        return self._saved
+
+    def has_key(self):
+        return self._key is not None
+
+    def put(self):
+        return put(self)
+
+    save = put
+
+    def delete(self):
+        delete(self)
+        self._saved = False
+
+    def dynamic_properties(self):
+        return []
+
+    @classmethod
+    def kind(cls):
+        return cls.__name__
+
+    @classmethod
+    def properties(cls):
+        return dict(cls._properties)
+
+    @classmethod
+    def all(cls, keys_only=False):
+        return Query(cls, keys_only=keys_only)
+
+    @classmethod
+    def gql(cls, query_string, *args, **kwds):
+        return GqlQuery('SELECT * FROM %s %s' % (cls.kind(), query_string),
+            *args, **kwds)
+
+    @classmethod
+    def get(cls, keys):
+        results = get(keys)
+        if isinstance(results, list): checked = results
+        else: checked = [ results ]
+        for result in checked:
+            if result is not None and not isinstance(result, cls):
+                raise KindError('Kind %s is not a kind of %s' %
+                    (result.kind(), cls.kind()))
+        return results
+
+    @classmethod
+    def get_by_key_name(cls, key_names, parent=None):
+        if isinstance(key_names, basestring):
+            return cls.get(Key.from_path(cls.kind(), key_names))
+        return cls.get([ Key.from_path(cls.kind(), n) for n in key_names ])
+
+    @classmethod
+    def get_by_id(cls, ids, parent=None):
+        if isinstance(ids, (int, long)):
+            return cls.get(Key.from_path(cls.kind(), ids))
+        return cls.get([ Key.from_path(cls.kind(), i) for i in ids ])
+
+    @classmethod
+    def get_or_insert(cls, key_name, **kwds):
+        def txn():
+            entity = cls.get_by_key_name(key_name)
+            if entity is None:
+                entity = cls(key_name=key_name, **kwds)
+                entity.put()
+            return entity
+        return run_in_transaction(txn)
+
+def _to_list(items):
+    """
+    Normalize a single item or a sequence of them into a list, noting which
+    it was.
+    """
+    if isinstance(items, (Model, Key, basestring)): return [ items ], False
+    return list(items), True
+
+def _to_key(item):
+    if isinstance(item, Model): return item.key()
+    if isinstance(item, basestring): return Key(item)
+    return item
+
+def _store(key, values):
+    _entities[key] = values
+    _by_kind.setdefault(key.kind(), {})[key] = values
+
+def _remove(key):
+    _entities.pop(key, None)
+    _by_kind.get(key.kind(), {}).pop(key, None)
+
+def _journal(key):
+    """
+    Remember the value of an entity before a transaction changes it.
+    """
+    journal = getattr(_tx, 'journal', None)
+    if journal is not None and key not in journal:
+        journal[key] = _entities.get(key)
+
+@_locked
+def get(keys):
+    """
+    Fetch one or a list of entities by key.
+    """
+    keys, multiple = _to_list(keys)
+    results = []
+    for key in [ _to_key(k) for k in keys ]:
+        stored = _entities.get(key)
+        results.append(stored is not None and
+            _kinds[key.kind()]._from_stored(key, stored) or None)
+    if multiple: return results
+    return results[0]
+
+@_locked
+def put(models):
+    """
+    Save one or a list of model instances, returning their keys.
+    """
+    models, multiple = _to_list(models)
+    _check_batch(models, 'put')
+    keys = []
+    for model in models:
+        values = model._to_stored()
+        if model._key is None:
+            _next_id[0] = _next_id[0] + 1
+            model._key = Key.from_path(model.kind(), _next_id[0])
+        _journal(model._key)
+        _store(model._key, values)
+        model._saved = True
+        keys.append(model._key)
+    if multiple: return keys
+    return keys[0]
+
+@_locked
+def delete(models):
+    """
+    Delete one or a list of entities, by model instance or key.
+    """
+    models, multiple = _to_list(models)
+    _check_batch(models, 'delete')
+    for key in [ _to_key(m) for m in models ]:
+        _journal(key)
+        _remove(key)
+
+def set_conflict_rate(rate, seed=None):
+    """
+    Make each commit of a transaction that wrote anything fail with the
+    given chance, rolling it back to be retried, optionally seeding the
+    draws to make them repeatable.
+    """
+    _conflicts['rate'] = rate
+    if seed is not None: _conflicts['random'].seed(seed)
+
+def _check_batch(items, operation):
+    if len(items) > MAX_BATCH:
+        raise BadRequestError('Cannot %s more than %s entities in a single '
+            'call.' % (operation, MAX_BATCH))
+
+def run_in_transaction(function, *args, **kwds):
+    """
+    Run a function as a transaction, rolling back any changes it made to the
+    datastore should it raise an exception.  Conflicting commits are rolled
+    back and retried up to TRANSACTION_RETRIES times, then fail with
+    TransactionFailedError.
+    """
+    _lock.acquire()
+    try:
+        if getattr(_tx, 'journal', None) is not None:
+            raise BadRequestError('Nested transactions are not supported.')
+        for attempt in range(TRANSACTION_RETRIES + 1):
+            _tx.journal = {}
+            try:
+                rv = function(*args, **kwds)
+            except Rollback:
+                _rollback()
+                return None
+            except:
+                _rollback()
+                raise
+            if not (_tx.journal and
+                    _conflicts['random'].random() < _conflicts['rate']):
+                return rv
+            _rollback()
+        raise TransactionFailedError(
+            'The transaction could not be committed. Please try again.')
+    finally:
+        _tx.journal = None
+        _lock.release()
+
+def _rollback():
+    for key, stored in _tx.journal.items():
+        if stored is None:
+            _remove(key)
+        else:
+            _store(key, stored)
+
+# Order of value types when sorting and comparing mixed types, looked up
+# by exact type first.
+_TYPE_RANKS = {
+    type(None): 0, bool: 1, int: 2, long: 2, float: 2,
+    datetime.datetime: 3, datetime.date: 4, str: 5, unicode: 5
+}
+
+def _type_rank(value):
+    rank = _TYPE_RANKS.get(type(value))
+    if rank is not None: return rank
+    if value is None: return 0
+    if isinstance(value, bool): return 1
+    if isinstance(value, (int, long, float)): return 2
+    if isinstance(value, datetime.datetime): return 3
+    if isinstance(value, datetime.date): return 4
+    if isinstance(value, basestring): return 5
+    if isinstance(value, Key): return 6
+    return 7
+
+def _compare(a, b):
+    rank_a, rank_b = _type_rank(a), _type_rank(b)
+    if rank_a != rank_b: return cmp(rank_a, rank_b)
+    return cmp(a, b)
+
+def _test(value, op, operand):
+    """
+    Check a single property value against a filter.
+    """
+    if op == 'IN':
+        return [ o for o in operand if _compare(value, o) == 0 ] != []
+    if op == '=':
+        if type(value) is type(operand): return value == operand
+        return _compare(value, operand) == 0
+    if op == '!=': return _compare(value, operand) != 0
+    # Inequalities only match values of the same type.
+    if value is None or _type_rank(value) != _type_rank(operand):
+        return False
+    result = cmp(value, operand)
+    if op == '<':  return result < 0
+    if op == '<=': return result <= 0
+    if op == '>':  return result > 0
+    if op == '>=': return result >= 0
+
+class _Descending(object):
+    """
+    Wrapper reversing the order of a sort key.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __cmp__(self, other):
+        return cmp(other.value, self.value)
+
+class Query(object):
+    """
+    Query for entities of a model class.
+    """
+    OPERATORS   = ('=', '!=', '<', '<=', '>', '>=', 'IN')
+    INEQUALITY  = ('!=', '<', '<=', '>', '>=')
+
+    def __init__(self, model_class=None, keys_only=False):
+        self._model_class = model_class
+        self._keys_only   = keys_only
+        self._filters     = []
+        self._orders      = []
+        self._cursor      = None
+        self._last        = None
+        self._limit       = None
+        self._offset      = 0
+
+    def filter(self, property_operator, value):
+        parts = property_operator.strip().split()
+        if len(parts) == 1:
+            name, op = parts[0], '='
+        elif len(parts) == 2:
+            name, op = parts[0], parts[1].upper()
+        else:
+            raise BadArgumentError('Filter %r is invalid' % property_operator)
+        if op == '==': op = '='
+        if op not in self.OPERATORS:
+            raise BadArgumentError('Operator %r is not supported' % op)
+        if op == 'IN':
+            value = [ self._normalize(v) for v in value ]
+        else:
+            value = self._normalize(value)
+        self._filters.append( (name, op, value) )
+        return self
+
+    def _normalize(self, value):
+        if isinstance(value, Model): return value.key()
+        return value
+
+    def order(self, property):
+        if property.startswith('-'):
+            self._orders.append( (property[1:], True) )
+        else:
+            self._orders.append( (property, False) )
+        return self
+
+    def ancestor(self, ancestor):
+        raise BadQueryError('Ancestor queries are not supported')
+
+    def _effective_orders(self):
+        """
+        Work out the sort orders, checking inequality filters as the
+        datastore would.
+        """
+        unequal = []
+        for name, op, value in self._filters:
+            if op in self.INEQUALITY and name not in unequal:
+                unequal.append(name)
+        if len(unequal) > 1:
+            raise BadArgumentError('Only one property per query may have '
+                'inequality filters (%s).' % ', '.join(unequal))
+        if unequal:
+            if not self._orders: return [ (unequal[0], False) ]
+            if self._orders[0][0] != unequal[0]:
+                raise BadArgumentError('First ordering property must be the '
+                    'same as inequality filter property, if specified for '
+                    'this query; received %s, expected %s' %
+                    (self._orders[0][0], unequal[0]))
+        return self._orders
+
+    def _matches(self, key, values):
+        for name, op, operand in self._filters:
+            if name == '__key__':
+                candidates = [ key ]
+            elif name not in values:
+                return False
+            else:
+                candidates = values[name]
+                if not isinstance(candidates, list): candidates = [ candidates ]
+            if not [ c for c in candidates if _test(c, op, operand) ]:
+                return False
+        return True
+
+    def _sort_value(self, key, values, name, descending):
+        if name == '__key__': return key
+        value = values.get(name)
+        if isinstance(value, list):
+            if not value: return None
+            value = list(value)
+            value.sort(_compare)
+            return descending and value[-1] or value[0]
+        return value
+
+    def _sort_key(self, orders):
+        """
+        Build a function making sort keys for (key, values) pairs, with each
+        value ranked by type ahead of the value itself.
+        """
+        def sort_key(result):
+            parts = []
+            for name, descending in orders:
+                value = self._sort_value(result[0], result[1], name, 
+                    descending)
+                part = (_type_rank(value), value)
+                if descending: part = _Descending(part)
+                parts.append(part)
+            parts.append(result[0])
+            return tuple(parts)
+        return sort_key
+
+    @_locked
+    def _run(self, count=None):
+        """
+        Find the (key, values) pairs of matching entities, in order and past
+        any cursor.  Given a count, only that many of the first are sorted out
+        of the rest, which keeps small fetches from deep result sets cheap.
+        """
+        orders   = self._effective_orders()
+        sort_key = self._sort_key(orders)
+        results  = [
+            (key, values) for key, values in 
+                _by_kind.get(self._model_class.kind(), {}).items()
+            if self._matches(key, values)
+        ]
+        if self._cursor is not None:
+            after   = sort_key(self._cursor)
+            results = [ r for r in results if sort_key(r) > after ]
+        if count is not None and count < len(results):
+            return heapq.nsmallest(count, results, key=sort_key)
+        results.sort(key=sort_key)
+        return results
+
+    def _convert(self, results):
+        if self._keys_only: return [ key for key, values in results ]
+        return [ self._model_class._from_stored(key, values)
+            for key, values in results ]
+
+    def fetch(self, limit, offset=0):
+        if self._limit is not None: limit = min(limit, self._limit)
+        offset = offset + self._offset
+        results = self._run(offset + limit)[offset:offset + limit]
+        if results: self._last = results[-1]
+        return self._convert(results)
+
+    def get(self):
+        results = self.fetch(1)
+        return results and results[0] or None
+
+    def count(self, limit=None):
+        results = self._run()
+        if limit is not None: return min(limit, len(results))
+        return len(results)
+
+    def __iter__(self):
+        return iter(self._convert(self._run()))
+
+    def cursor(self):
+        """
+        Encode the position after the last entity fetched.
+        """
+        position = self._last or self._cursor
+        if position is None: return None
+        key, values = position
+        values = dict([ (name, values.get(name))
+            for name, descending in self._effective_orders() ])
+        return base64.urlsafe_b64encode(pickle.dumps(
+            (key.kind(), key.id_or_name(), values) ))
+
+    def with_cursor(self, cursor):
+        try:
+            kind, id_or_name, values = pickle.loads(
+                base64.urlsafe_b64decode(str(cursor)))
+        except Exception:
+            raise BadValueError('Invalid cursor %s' % cursor)
+        self._cursor = (Key.from_path(kind, id_or_name), values)
+        self._last   = None
+        return self
+
+_GQL_TOKEN = re.compile(r"""\s*(
+    :\w+ | '(?:[^']|'')*' | -?\d+\.\d+ | -?\d+ | <= | >= | != | = | < | > |
+    , | \( | \) | \* | \w+
+)""", re.VERBOSE)
+
+class GqlQuery(Query):
+    """
+    Query built from a GQL string, with positional (:1) and keyword (:name)
+    parameters.
+    """
+    def __init__(self, query_string, *args, **kwds):
+        self._tokens = self._tokenize(query_string)
+        self._args   = args
+        self._kwds   = kwds
+
+        self._expect('SELECT')
+        keys_only = self._next() == '__key__'
+        self._expect('FROM')
+        kind = self._next()
+        if kind not in _kinds:
+            raise KindError('No implementation for kind %r' % kind)
+        Query.__init__(self, _kinds[kind], keys_only=keys_only)
+
+        if self._accept('WHERE'):
+            while True:
+                name = self._next()
+                op = self._next().upper()
+                self.filter('%s %s' % (name, op), self._value())
+                if not self._accept('AND'): break
+        if self._accept('ORDER'):
+            self._expect('BY')
+            while True:
+                name = self._next()
+                if self._accept('DESC'):
+                    self.order('-%s' % name)
+                else:
+                    self._accept('ASC')
+                    self.order(name)
+                if not self._accept(','): break
+        if self._accept('LIMIT'):
+            self._limit = int(self._next())
+        if self._accept('OFFSET'):
+            self._offset = int(self._next())
+        if self._tokens:
+            raise BadQueryError('Unexpected %r in GQL' % self._tokens[0])
+
+    def _tokenize(self, query_string):
+        tokens, pos, query_string = [], 0, query_string.strip()
+        while pos < len(query_string):
+            match = _GQL_TOKEN.match(query_string, pos)
+            if not match:
+                raise BadQueryError('Unable to parse GQL at %r' %
+                    query_string[pos:])
+            tokens.append(match.group(1))
+            pos = match.end()
+            while pos < len(query_string) and query_string[pos].isspace():
+                pos = pos + 1
+        return tokens
+
+    def _next(self):
+        if not self._tokens: raise BadQueryError('Unexpected end of GQL')
+        return self._tokens.pop(0)
+
+    def _accept(self, token):
+        if self._tokens and self._tokens[0].upper() == token:
+            self._tokens.pop(0)
+            return True
+        return False
+
+    def _expect(self, token):
+        if not self._accept(token):
+            raise BadQueryError('Expected %s in GQL' % token)
+
+    def _value(self):
+        token = self._next()
+        if token.startswith(':'):
+            name = token[1:]
+            if name.isdigit(): return self._args[int(name) - 1]
+            return self._kwds[name]
+        if token.startswith("'"): return token[1:-1].replace("''", "'")
+        if token == '(':
+            values = []
+            while not self._accept(')'):
+                values.append(self._value())
+                self._accept(',')
+            return values
+        upper = token.upper()
+        if upper == 'NULL': return None
+        if upper == 'TRUE': return True
+        if upper == 'FALSE': return False
+        if '.' in token: return float(token)
+        return int(token)
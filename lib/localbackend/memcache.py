@@ -0,0 +1,124 @@
+"""
+In-memory stand-in for google.appengine.api.memcache, covering the module
+level get/set/add/delete/incr calls and their _multi variants.
+
+Values are stored pickled, as memcache would, so callers get copies and
+oversized values are turned away.
+"""
+import time, threading, pickle
+
+# Largest value memcache will hold, in bytes.
+MAX_VALUE_SIZE = 1000000
+
+# Expiration times beyond 30 days are taken as absolute Unix timestamps.
+MAX_RELATIVE_TIME = 30 * 24 * 60 * 60
+
+_lock  = threading.RLock()
+_items = {}
+
+def _locked(func):
+    """
+    Decorate a function to run while holding the cache lock.
+    """
+    def wrapper(*args, **kwds):
+        _lock.acquire()
+        try:
+            return func(*args, **kwds)
+        finally:
+            _lock.release()
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__  = func.__doc__
+    return wrapper
+
+def _full_key(key, namespace):
+    if namespace: return '%s:%s' % (namespace, key)
+    return key
+
+def _expires(time_):
+    if not time_: return None
+    if time_ > MAX_RELATIVE_TIME: return time_
+    return time.time() + time_
+
+def _lookup(key):
+    item = _items.get(key)
+    if item is None: return None
+    if item[1] is not None and item[1] <= time.time():
+        del _items[key]
+        return None
+    return item
+
+def _store(key, value, time_):
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if len(data) > MAX_VALUE_SIZE: return False
+    _items[key] = (data, _expires(time_))
+    return True
+
+@_locked
+def get(key, namespace=None):
+    item = _lookup(_full_key(key, namespace))
+    if item is None: return None
+    return pickle.loads(item[0])
+
+@_locked
+def get_multi(keys, key_prefix='', namespace=None):
+    results = {}
+    for key in keys:
+        item = _lookup(_full_key(key_prefix + key, namespace))
+        if item is not None: results[key] = pickle.loads(item[0])
+    return results
+
+@_locked
+def set(key, value, time=0, namespace=None):
+    return _store(_full_key(key, namespace), value, time)
+
+@_locked
+def set_multi(mapping, time=0, key_prefix='', namespace=None):
+    return [ key for key, value in mapping.items()
+        if not _store(_full_key(key_prefix + key, namespace), value, time) ]
+
+@_locked
+def add(key, value, time=0, namespace=None):
+    full_key = _full_key(key, namespace)
+    if _lookup(full_key) is not None: return False
+    return _store(full_key, value, time)
+
+@_locked
+def replace(key, value, time=0, namespace=None):
+    full_key = _full_key(key, namespace)
+    if _lookup(full_key) is None: return False
+    return _store(full_key, value, time)
+
+@_locked
+def delete(key, seconds=0, namespace=None):
+    full_key = _full_key(key, namespace)
+    if _lookup(full_key) is None: return 1
+    del _items[full_key]
+    return 2
+
+@_locked
+def delete_multi(keys, seconds=0, key_prefix='', namespace=None):
+    for key in keys:
+        _items.pop(_full_key(key_prefix + key, namespace), None)
+    return True
+
+@_locked
+def incr(key, delta=1, namespace=None, initial_value=None):
+    full_key = _full_key(key, namespace)
+    item = _lookup(full_key)
+    if item is None:
+        if initial_value is None: return None
+        value, expires = initial_value, None
+    else:
+        value, expires = pickle.loads(item[0]), item[1]
+        if not isinstance(value, (int, long)): return None
+    value = max(0, value + delta)
+    _items[full_key] = (pickle.dumps(value), expires)
+    return value
+
+def decr(key, delta=1, namespace=None, initial_value=None):
+    return incr(key, -delta, namespace, initial_value)
+
+@_locked
+def flush_all():
+    _items.clear()
+    return True
@@ -0,0 +1,206 @@
+"""
+In-memory stand-in for google.appengine.api.urlfetch, answering fetches
+with canned responses registered ahead of time.
+
+Canned responses can carry a delay to stand in for network latency, and
+answer conditional GETs with a 304 when the ETag or Last-Modified matches.
+Every fetch is logged in requests, for counting what went upstream.
+
+Asynchronous fetches through create_rpc() and make_fetch_call() each run
+in their own thread.
+"""
+import time, threading
+
+GET    = 'GET'
+POST   = 'POST'
+HEAD   = 'HEAD'
+PUT    = 'PUT'
+DELETE = 'DELETE'
+
+# Largest response body urlfetch will return, in bytes.
+MAX_RESPONSE_SIZE = 2 ** 20
+
+class Error(Exception): pass
+class DownloadError(Error): pass
+class InvalidURLError(Error): pass
+class ResponseTooLargeError(Error): pass
+
+_lock      = threading.RLock()
+_responses = {}
+requests   = []
+
+class _URLFetchResult(object):
+    """
+    Response to a fetch.
+    """
+    def __init__(self, content='', status_code=200, headers=None,
+            content_was_truncated=False, final_url=None):
+        self.content               = content
+        self.status_code           = status_code
+        self.headers               = headers or {}
+        self.content_was_truncated = content_was_truncated
+        self.final_url             = final_url
+
+def register(url, content='', status_code=200, headers=None, delay=0,
+        handler=None):
+    """
+    Register the canned response for a URL, or a handler called with the
+    url, payload, method, and headers of each fetch to build one.
+    """
+    _lock.acquire()
+    try:
+        _responses[url] = (content, status_code, dict(headers or {}),
+            delay, handler)
+    finally:
+        _lock.release()
+
+def reset():
+    """
+    Forget all canned responses and logged requests.
+    """
+    _lock.acquire()
+    try:
+        _responses.clear()
+        del requests[:]
+    finally:
+        _lock.release()
+
+def fetch(url, payload=None, method=GET, headers={}, allow_truncated=False,
+        follow_redirects=True, deadline=None):
+    """
+    Fetch a URL, answered from the canned responses.
+    """
+    if not url.startswith('http://') and not url.startswith('https://'):
+        raise InvalidURLError('Invalid URL %r' % url)
+
+    _lock.acquire()
+    try:
+        requests.append( (url, method, dict(headers or {}), payload) )
+        response = _responses.get(url)
+    finally:
+        _lock.release()
+    if response is None:
+        raise DownloadError('No canned response for %s' % url)
+
+    content, status_code, response_headers, delay, handler = response
+    if delay:
+        if deadline is not None and delay > deadline:
+            time.sleep(deadline)
+            raise DownloadError('Deadline exceeded fetching %s' % url)
+        time.sleep(delay)
+
+    if handler is not None:
+        return handler(url, payload, method, headers)
+
+    headers = headers or {}
+    if method == GET and (
+            ('ETag' in response_headers and
+                headers.get('If-None-Match') == response_headers['ETag']) or
+            ('Last-Modified' in response_headers and
+                headers.get('If-Modified-Since') ==
+                    response_headers['Last-Modified'])):
+        return _URLFetchResult('', 304, dict(response_headers), False, url)
+
+    truncated = False
+    if len(content) > MAX_RESPONSE_SIZE:
+        if not allow_truncated:
+            raise ResponseTooLargeError('Response from %s too large' % url)
+        content, truncated = content[:MAX_RESPONSE_SIZE], True
+
+    return _URLFetchResult(content, status_code, dict(response_headers),
+        truncated, url)
+
+_finished = threading.Condition(_lock)
+
+class _RPC(object):
+    """
+    Asynchronous fetch, as made by create_rpc().
+    """
+    def __init__(self, deadline=None, callback=None):
+        self.deadline = deadline
+        self.callback = callback
+        self.state    = 'idle'
+        self._result  = None
+        self._error   = None
+
+    def _run(self, url, payload, method, headers, allow_truncated,
+            follow_redirects):
+        try:
+            try:
+                self._result = fetch(url, payload, method, headers,
+                    allow_truncated, follow_redirects, self.deadline)
+            except Exception, e:
+                self._error = e
+        finally:
+            _finished.acquire()
+            try:
+                self.state = 'finishing'
+                _finished.notifyAll()
+            finally:
+                _finished.release()
+
+    def wait(self):
+        """
+        Wait for the fetch to finish, then run the callback, if any.
+        """
+        _finished.acquire()
+        try:
+            while self.state == 'running':
+                _finished.wait()
+            if self.state != 'finishing': return
+            self.state = 'done'
+        finally:
+            _finished.release()
+        if self.callback: self.callback()
+
+    def check_success(self):
+        self.wait()
+        if self._error is not None: raise self._error
+
+    def get_result(self):
+        """
+        Wait for the fetch to finish and return its response, or raise its
+        error.
+        """
+        self.check_success()
+        return self._result
+
+    @classmethod
+    def wait_any(cls, rpcs):
+        """
+        Wait for any one of a list of fetches to finish, returning it.
+        """
+        rpcs = list(rpcs)
+        if not rpcs: return None
+        _finished.acquire()
+        try:
+            while True:
+                for rpc in rpcs:
+                    if rpc.state != 'running': break
+                else:
+                    _finished.wait()
+                    continue
+                break
+        finally:
+            _finished.release()
+        rpc.wait()
+        return rpc
+
+def create_rpc(deadline=None, callback=None):
+    """
+    Create an RPC for an asynchronous fetch.
+    """
+    return _RPC(deadline, callback)
+
+def make_fetch_call(rpc, url, payload=None, method=GET, headers={},
+        allow_truncated=False, follow_redirects=True):
+    """
+    Start fetching a URL in the background, through an RPC made by
+    create_rpc().
+    """
+    rpc.state = 'running'
+    thread = threading.Thread(target=rpc._run, args=(url, payload, method,
+        headers, allow_truncated, follow_redirects))
+    thread.setDaemon(True)
+    thread.start()
+    return rpc
@@ -0,0 +1,110 @@
+"""
+In-memory stand-in for google.appengine.ext.webapp, covering just enough
+of requests, responses, handlers and URL routing to serve a WSGI app.
+"""
+import re, cgi, StringIO
+from wsgiref.headers import Headers
+
+class Request(object):
+    """
+    Incoming request, with query string and form parameters.
+    """
+    def __init__(self, environ):
+        self.environ = environ
+        self.method  = environ.get('REQUEST_METHOD', 'GET')
+        self.path    = environ.get('PATH_INFO', '/')
+        self.params  = cgi.parse_qs(environ.get('QUERY_STRING', ''),
+            keep_blank_values=True)
+        if self.method == 'POST':
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            self.body = environ['wsgi.input'].read(length)
+            for name, values in cgi.parse_qs(self.body,
+                    keep_blank_values=True).items():
+                self.params.setdefault(name, []).extend(values)
+        else:
+            self.body = ''
+
+    def get(self, argument_name, default_value=''):
+        values = self.params.get(argument_name)
+        if not values: return default_value
+        return values[0]
+
+    def get_all(self, argument_name):
+        return list(self.params.get(argument_name, []))
+
+    def arguments(self):
+        return self.params.keys()
+
+class Response(object):
+    """
+    Outgoing response, written to out.
+    """
+    def __init__(self):
+        self.out     = StringIO.StringIO()
+        self.headers = Headers([ ('Content-Type', 'text/html; charset=utf-8') ])
+        self.status  = 200
+        self.message = 'OK'
+
+    def set_status(self, code, message=None):
+        self.status  = code
+        self.message = message or 'Status %s' % code
+
+    def clear(self):
+        self.out.seek(0)
+        self.out.truncate(0)
+
+    def wsgi_write(self, start_response):
+        body = self.out.getvalue()
+        if isinstance(body, unicode): body = body.encode('utf-8')
+        self.headers['Content-Length'] = str(len(body))
+        start_response('%d %s' % (self.status, self.message),
+            self.headers.items())
+        return [ body ]
+
+class RequestHandler(object):
+    """
+    Base class for request handlers, with a method per HTTP method.
+    """
+    def initialize(self, request, response):
+        self.request  = request
+        self.response = response
+
+    def error(self, code):
+        self.response.set_status(code)
+        self.response.clear()
+
+    def redirect(self, uri, permanent=False):
+        self.response.set_status(permanent and 301 or 302)
+        self.response.headers['Location'] = str(uri)
+        self.response.clear()
+
+class WSGIApplication(object):
+    """
+    WSGI application routing requests to handlers by regular expression.
+    """
+    def __init__(self, url_mapping, debug=False):
+        self.debug = debug
+        self._url_mapping = [
+            (re.compile('^%s$' % pattern), handler_class)
+            for pattern, handler_class in url_mapping
+        ]
+
+    def __call__(self, environ, start_response):
+        request  = Request(environ)
+        response = Response()
+
+        for regexp, handler_class in self._url_mapping:
+            match = regexp.match(request.path)
+            if match:
+                handler = handler_class()
+                handler.initialize(request, response)
+                method = getattr(handler, request.method.lower(), None)
+                if method is None:
+                    response.set_status(405)
+                else:
+                    method(*match.groups())
+                break
+        else:
+            response.set_status(404)
+
+        return response.wsgi_write(start_response)
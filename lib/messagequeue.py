@@ -1,117 +1,1345 @@
 """
 """
-import datetime, time, md5, logging
+import datetime, time, md5, logging, threading, random, Queue
+import simplejson
 
-from google.appengine.ext import db
-from google.appengine.api import memcache
-from google.appengine.ext import webapp
+from backend import db, memcache, webapp
+
+class DependencyCycleError(ValueError):
+    """
+    Raised when a group of messages depends on itself.
+    """
+    pass
+
+class RetryMessage(Exception):
+    """
+    Raised by a listener that failed to handle a message, but expects to
+    succeed if the message is tried again later, optionally after a given
+    delay in seconds.  Listeners raising anything else but RejectMessage are
+    retried too.
+    """
+    def __init__(self, reason='', delay=None):
+        Exception.__init__(self, reason)
+        self.delay = delay
+
+class RejectMessage(Exception):
+    """
+    Raised by a listener that failed to handle a message and never will.
+    """
+    pass
+
+class LockTimeout(Exception):
+    """
+    Raised when the queue lock couldn't be had before giving up on it.
+    """
+    pass
+
+def _total_seconds(delta):
+    """
+    Convert a timedelta into seconds.
+    """
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0
+
+class SubjectRouter:
+    """
+    Routing table for matching message subjects against listener subject
+    patterns, compiled into a trie over the slash-separated subject path.
+
+    In a pattern, a '*' segment matches any one segment of a subject, and a
+    '#' as the last segment matches any number of remaining segments,
+    including none.  So '/feeds/fetch/*' matches '/feeds/fetch/atom', and
+    '/feeds/#' matches both '/feeds' and '/feeds/fetch/atom'.
+    """
+    # How many subjects to remember the matching listeners for.
+    CACHE_SIZE = 1000
+
+    def __init__(self):
+        self.root = SubjectRouterNode()
+        self.count = 0
+        self.cache = {}
+
+    def add(self, subject_pattern, listener):
+        """
+        Register a listener for subjects matching a pattern.
+        """
+        node = self.root
+        segments = subject_pattern.split('/')
+        for i in range(len(segments)):
+            if segments[i] == '#' and i == len(segments) - 1:
+                node.rest.append( (self.count, listener) )
+                break
+            node = node.children.setdefault(segments[i], SubjectRouterNode())
+        else:
+            node.listeners.append( (self.count, listener) )
+
+        self.count = self.count + 1
+        self.cache.clear()
+
+    def match(self, subject):
+        """
+        List the listeners interested in a subject, in order of registration.
+        """
+        listeners = self.cache.get(subject)
+        if listeners is None:
+            found = []
+            self._match(self.root, subject.split('/'), 0, found)
+            found.sort()
+            listeners = [ listener for n, listener in found ]
+
+            if len(self.cache) >= self.CACHE_SIZE: self.cache.clear()
+            self.cache[subject] = listeners
+
+        return listeners
+
+    def _match(self, node, segments, i, found):
+        """
+        Collect listeners from a node and its children matching the rest of
+        the subject segments.
+        """
+        found.extend(node.rest)
+        if i == len(segments):
+            found.extend(node.listeners)
+            return
+        for segment in dict.fromkeys([ segments[i], '*' ]):
+            child = node.children.get(segment)
+            if child: self._match(child, segments, i + 1, found)
+
+class SubjectRouterNode:
+    """
+    Node in the SubjectRouter trie, with the listeners for patterns ending
+    here and for patterns ending here in '#'.
+    """
+    def __init__(self):
+        self.children  = {}
+        self.listeners = []
+        self.rest      = []
+
+class MessageQueueStats:
+    """
+    Counters and timers on the workings of message queues, kept in memory
+    and cheap enough to leave on.  Every so often, the counts built up since
+    the last time are added into memcache, where the totals across all
+    instances can be found.
+
+    Timers keep a count of calls, total seconds, and the longest call in
+    this process.  Only the counters and timers named in COUNTERS and TIMERS
+    are shared through memcache; anything else, like the timings of each
+    listener, is only kept in this process.
+    """
+    STATS_KEY = 'decafbad/messagequeue/stats/'
+
+    # How often to add counts built up in this process into memcache.
+    FLUSH_SECONDS = 10
+
+    COUNTERS = (
+        'lock_acquired', 'lock_contended', 'lock_spins', 'lock_timeouts',
+        'lock_renewals', 'lock_lost', 'messages_promoted',
+        'reserve_calls', 'messages_scanned', 'messages_reserved',
+        'messages_processed', 'messages_finished', 'messages_retried',
+        'messages_requeued', 'messages_dead',
+        'listener_success', 'listener_retry', 'listener_failure'
+    )
+    TIMERS = ( 
+        'lock_wait', 'lock_held', 'reserve', 'process', 'finish', 'listener' 
+    )
+
+    def __init__(self, flush_seconds=FLUSH_SECONDS):
+        self.flush_seconds = flush_seconds
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forget everything counted in this process.
+        """
+        self._lock.acquire()
+        try:
+            self.counters = {}
+            self.timers = {}
+            self._unflushed = {}
+            self._flushed_at = time.time()
+        finally:
+            self._lock.release()
+
+    def incr(self, name, delta=1):
+        """
+        Add to a counter.
+        """
+        self._lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + delta
+            self._unflushed[name] = self._unflushed.get(name, 0) + delta
+        finally:
+            self._lock.release()
+        self._maybe_flush()
+
+    def add_timing(self, name, seconds):
+        """
+        Count a call of a timer taking some number of seconds.
+        """
+        self._lock.acquire()
+        try:
+            timer = self.timers.get(name)
+            if timer is None: 
+                timer = self.timers[name] = [ 0, 0.0, 0.0 ]
+            timer[0] = timer[0] + 1
+            timer[1] = timer[1] + seconds
+            timer[2] = max(timer[2], seconds)
+            for suffix, delta in (('_count', 1), 
+                    ('_us', int(seconds * 1000000))):
+                self._unflushed[name + suffix] = \
+                    self._unflushed.get(name + suffix, 0) + delta
+        finally:
+            self._lock.release()
+        self._maybe_flush()
+
+    def snapshot(self):
+        """
+        Report everything counted in this process, with timers broken out
+        into counts and milliseconds.
+        """
+        self._lock.acquire()
+        try:
+            counters = dict(self.counters)
+            timers = dict([ 
+                (name, self._timer_stats(count, total, longest))
+                for name, (count, total, longest) in self.timers.items() 
+            ])
+        finally:
+            self._lock.release()
+        return {
+            'since': self.started_at,
+            'counters': counters,
+            'timers': timers
+        }
+
+    def _timer_stats(self, count, total, longest=None):
+        stats = {
+            'count': count,
+            'total_ms': total * 1000,
+            'mean_ms': count and total * 1000 / count or 0.0
+        }
+        if longest is not None: stats['max_ms'] = longest * 1000
+        return stats
+
+    def _maybe_flush(self):
+        if time.time() - self._flushed_at >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        """
+        Add the shared counts built up since the last flush into memcache.
+        """
+        self._lock.acquire()
+        try:
+            unflushed, self._unflushed = self._unflushed, {}
+            self._flushed_at = time.time()
+        finally:
+            self._lock.release()
+
+        names = self._shared_names()
+        for name, delta in unflushed.items():
+            if not delta or name not in names: continue
+            key = self.STATS_KEY + name
+            if memcache.incr(key, delta) is None:
+                # Nobody has counted this yet, unless someone just beat us.
+                if not memcache.add(key, delta):
+                    memcache.incr(key, delta)
+
+    def _shared_names(self):
+        names = list(self.COUNTERS)
+        for name in self.TIMERS:
+            names.extend([ name + '_count', name + '_us' ])
+        return names
+
+    def shared(self):
+        """
+        Report the totals flushed into memcache by all instances.
+        """
+        values = memcache.get_multi(self._shared_names(), 
+            key_prefix=self.STATS_KEY)
+        counters = dict([ (name, values.get(name, 0)) 
+            for name in self.COUNTERS ])
+        timers = dict([ 
+            (name, self._timer_stats(values.get(name + '_count', 0),
+                values.get(name + '_us', 0) / 1000000.0))
+            for name in self.TIMERS 
+        ])
+        return { 'counters': counters, 'timers': timers }
+
+    def clear_shared(self):
+        """
+        Zero out the totals in memcache.
+        """
+        memcache.delete_multi(self._shared_names(), 
+            key_prefix=self.STATS_KEY)
+
+# Stats shared by the message queues in this process, unless given their own.
+process_stats = MessageQueueStats()
+
+class ListenerPool:
+    """
+    Fixed set of worker threads running listeners for queues with
+    parallel_listeners set, started when first needed.  Only usable where
+    request code is allowed to start threads, which the Python 2.5 App
+    Engine runtime doesn't allow.
+
+    Work is submitted by key, and a key still being worked on isn't taken
+    on again, so that a listener that timed out on a message isn't run on
+    it a second time in this process until the first run is over.  A run
+    that times out still holds its thread until it's over, so listeners
+    that get stuck leave fewer threads for the rest.
+    """
+    THREADS = 8
+
+    def __init__(self, threads=THREADS):
+        self.log = logging.getLogger()
+        self.threads = threads
+        self._lock = threading.Lock()
+        self._work = Queue.Queue()
+        self._running = {}
+        self._workers = []
+
+    def submit(self, key, func, *args):
+        """
+        Queue up a call of func for a key, returning a job to wait on: a
+        list of a threading.Event, set once the call is over, and the result
+        of the call.  Returns None instead if work on the key is already
+        queued up or running.
+        """
+        self._lock.acquire()
+        try:
+            if key in self._running: return None
+            job = self._running[key] = [ threading.Event(), None ]
+            while len(self._workers) < self.threads:
+                worker = threading.Thread(target=self._run)
+                worker.setDaemon(True)
+                worker.start()
+                self._workers.append(worker)
+        finally:
+            self._lock.release()
+        self._work.put( (key, job, func, args) )
+        return job
+
+    def _run(self):
+        while True:
+            key, job, func, args = self._work.get()
+            try:
+                try:
+                    job[1] = func(*args)
+                except Exception, e:
+                    self.log.exception('Listener pool call for %s failed' % 
+                        (key,))
+            finally:
+                self._lock.acquire()
+                try:
+                    del self._running[key]
+                finally:
+                    self._lock.release()
+                job[0].set()
+
+# Listener threads shared by all queues in this process.
+process_listener_pool = ListenerPool()
 
 class MessageQueueRequestHandler(webapp.RequestHandler):
+    """
+    Worker endpoint that drains the message queue for a while, reporting on
+    how much got done.  Subclasses list the (subject, listener) pairs their
+    queue should dispatch to in listeners; without any, the worker refuses
+    to run rather than finish messages nothing has handled.
+    """
+    listeners = []
 
     def __init__(self):
         self.log = logging.getLogger()
         self.queue = MessageQueue()
+        self.queue.add_listeners(self.listeners)
 
     def get(self):
-        """ """
-        pass
+        """
+        Run the worker loop, with its deadline, batch_size, and idle_sleep
+        optionally given as query parameters.
+        """
+        if not self.listeners:
+            self.log.error('Worker has no listeners, leaving the queue alone')
+            self.error(500)
+            self.response.headers['Content-Type'] = 'text/plain'
+            self.response.out.write('no listeners registered\n')
+            return
+
+        stats = self.queue.work(
+            deadline=float(self.request.get('deadline', 
+                MessageQueue.WORK_SECONDS)),
+            batch_size=int(self.request.get('batch_size', 
+                MessageQueue.WORK_BATCH)),
+            idle_sleep=float(self.request.get('idle_sleep', 
+                MessageQueue.IDLE_SECONDS))
+        )
+        self.log.info('Worker processed %(processed)s messages in '
+            '%(elapsed_seconds).3f seconds' % stats)
+
+        self.response.headers['Content-Type'] = 'text/plain'
+        names = stats.keys()
+        names.sort()
+        for name in names:
+            self.response.out.write('%s: %s\n' % (name, stats[name]))
+
+class MessageQueueStatsHandler(webapp.RequestHandler):
+    """
+    Endpoint reporting message queue stats as JSON: the counters and timers
+    of this instance and the totals across instances, along with the depth
+    of the queue and the age of its oldest ready message.
+    """
+    def get(self):
+        queue = MessageQueue()
+        queue.stats.flush()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(simplejson.dumps({
+            'instance': queue.stats.snapshot(),
+            'shared': queue.stats.shared(),
+            'queue': queue.gauges()
+        }, sort_keys=True))
+
+class MessageQueueCompactHandler(webapp.RequestHandler):
+    """
+    Endpoint compacting finished and dead messages past the retention age,
+    for cron to call, stopping after max_batches batches so the request
+    stays well within its deadline.
+    """
+    def get(self):
+        max_batches = int(self.request.get('max_batches', 
+            MessageQueue.COMPACT_BATCHES))
+        count = MessageQueue().compact(max_batches=max_batches)
+        self.response.headers['Content-Type'] = 'text/plain'
+        if count is None:
+            self.response.out.write('compaction already running\n')
+        else:
+            self.response.out.write('compacted: %s\n' % count)
+
+class MessageQueueBackfillHandler(webapp.RequestHandler):
+    """
+    Endpoint bringing Messages saved by older versions of the queue up to
+    date, max_batches batches per request.  Reports a cursor to pass back in
+    as a query parameter to carry on, until there's none left.
+    """
+    def get(self):
+        max_batches = int(self.request.get('max_batches', 
+            MessageQueue.BACKFILL_BATCHES))
+        count, cursor = MessageQueue().backfill(max_batches=max_batches,
+            cursor=self.request.get('cursor') or None)
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write('backfilled: %s\ncursor: %s\n' % 
+            (count, cursor or ''))
 
 class MessageQueue:
     """
     Implementation of a message queue for async processing.
     """
     MUTEX_KEY = 'decafbad/messagequeue/mutex'
+    SIGNATURE_KEY = 'decafbad/messagequeue/signature/%s'
+    DUPLICATES_NONE_KEY = 'decafbad/messagequeue/duplicates-none'
+    COMPACT_KEY = 'decafbad/messagequeue/compact'
 
-    def __init__(self):
+    # How many candidates to consider per message wanted when claiming
+    # messages optimistically, to ride out losing races to other workers.
+    CLAIM_OVERSAMPLE = 3
+
+    # Defaults for how long a reservation is held before the message becomes
+    # reservable again, and how many reservations a message gets before it's
+    # declared dead.
+    LEASE_SECONDS = 300
+    MAX_ATTEMPTS  = 5
+
+    # None sorts ahead of every datetime, so range queries on optional dates
+    # are bounded from below by this to skip messages where they're unset.
+    EPOCH = datetime.datetime(1970, 1, 1)
+
+    # How many entities to delete at a time when purging.
+    PURGE_BATCH = 500
+
+    # Most entities the datastore takes in one batch put.
+    PUT_BATCH = 500
+
+    # How long memcache may vouch for claimed signatures, and for there
+    # being no unfinished Messages put with duplicates allowed, before the
+    # datastore is asked again.
+    SIGNATURE_CACHE_SECONDS = 600
+
+    # Version of the properties Messages are saved with.  Messages saved
+    # before it was recorded lack the properties the ready set and the
+    # indexes behind reservation rely on, until backfilled, and how many
+    # batches of Messages to look over per backfill request.
+    SCHEMA_VERSION   = 1
+    BACKFILL_BATCHES = 10
+
+    # How long finished and dead Messages are kept around before compaction,
+    # and how many batches of them to compact per request.
+    RETENTION_SECONDS = 7 * 24 * 60 * 60
+    COMPACT_BATCHES   = 10
+
+    # Delay before the first retry of a failed Message, doubling with each
+    # attempt after that up to a maximum.
+    RETRY_SECONDS     = 30
+    RETRY_MAX_SECONDS = 60 * 60
+
+    # Defaults for the worker loop: how long to run, how many messages to
+    # reserve at a time, and how long to sleep when there's nothing to do,
+    # doubling up to a maximum while the queue stays empty.
+    WORK_SECONDS     = 20
+    WORK_BATCH       = 10
+    IDLE_SECONDS     = 0.5
+    IDLE_MAX_SECONDS = 5
+
+    # How far to count messages when reporting on the queue.
+    GAUGE_LIMIT = 1000
+
+    # How often to look for scheduled messages come due while reserving, and
+    # how many to move into the ready set at a time.  Reserving also looks
+    # whenever it comes up short.
+    PROMOTE_SECONDS = 1
+    PROMOTE_BATCH   = 100
+
+    # How often to look for reservations whose lease has run out while
+    # reserving, so they're put back even while there's a backlog.
+    # Reserving also looks whenever it comes up short.
+    REQUEUE_SECONDS = 10
+
+    # Lanes messages can be put in, with their weights.  While every lane has
+    # messages ready, each gets a share of reservations in proportion to its
+    # weight; capacity a lane leaves unused goes to the others.  Within a
+    # lane, messages are reserved in order of schedule and priority.
+    LANES = [ ('interactive', 8), ('default', 4), ('bulk', 1) ]
+    DEFAULT_LANE = 'default'
+
+    # Defaults for how long the lock is held before it lapses, unless
+    # renewed, and how long to wait for it before giving up.  While waiting,
+    # the lock is retried after a jittered delay that doubles each time, from
+    # LOCK_SLEEP_SECONDS up to LOCK_SLEEP_MAX_SECONDS.
+    LOCK_SECONDS           = 5
+    LOCK_TIMEOUT_SECONDS   = 10
+    LOCK_SLEEP_SECONDS     = 0.005
+    LOCK_SLEEP_MAX_SECONDS = 0.1
+
+    def __init__(self, optimistic=False, shard_count=1, shards=None,
+            lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS,
+            retry_seconds=RETRY_SECONDS, parallel_listeners=False,
+            listener_timeout=None, stats=None, lock_seconds=LOCK_SECONDS,
+            lock_timeout=LOCK_TIMEOUT_SECONDS, lanes=None, 
+            default_lane=DEFAULT_LANE, listener_pool=None):
         """
-        Initialize the message queue
+        Initialize the message queue.  With optimistic set, reservation skips
+        the queue lock and claims each message in its own transaction.
+
+        Messages are partitioned across shard_count shards, each with its own
+        lock and ready index.  This queue only reserves from the given list of
+        shards, defaulting to all of them.
+
+        Reservations lapse after lease_seconds unless the message says
+        otherwise, and a message reserved max_attempts times without finishing
+        is set aside as dead.  Messages with listeners that fail get retried
+        after retry_seconds, doubling with each attempt.
+
+        With parallel_listeners set, all the listeners for a message run at
+        once on the threads of listener_pool, or else the ListenerPool shared
+        by all queues in this process, so this only works where threads are
+        allowed, not on the Python 2.5 runtime.  Any still running after
+        listener_timeout seconds, or once the message's lease runs out, are
+        given up on and the message retried.  They carry on in the
+        background meanwhile, and until they're over the retry counts them
+        as needing another retry rather than running them again alongside,
+        though a retry on another instance can still overlap with them.
+
+        Counters and timers go to the given MessageQueueStats, or else to
+        those shared by all queues in this process.
+
+        The queue lock lapses after lock_seconds unless renewed, and waiting
+        for it raises LockTimeout after lock_timeout seconds.
+
+        lanes lists the (name, weight) pairs of lanes to reserve from, in
+        place of LANES, and messages go in default_lane unless put elsewhere.
         """
         self.log = logging.getLogger()
         self.listeners = []
+        self._listener_names = []
+        self.router = SubjectRouter()
+        self.optimistic = optimistic
+        self.shard_count = shard_count
+        self.shards = shards is None and range(shard_count) or list(shards)
+        self._next_shard = 0
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.parallel_listeners = parallel_listeners
+        self.listener_timeout = listener_timeout
+        self.listener_pool = listener_pool or process_listener_pool
+        self.stats = stats or process_stats
+        self.lock_seconds = lock_seconds
+        self.lock_timeout = lock_timeout
+        self.lanes = list(lanes or self.LANES)
+        self.lane_weights = dict(self.lanes)
+        self.default_lane = default_lane
+        if default_lane not in self.lane_weights:
+            raise ValueError('Default lane %s is not one of %s' % 
+                (default_lane, [ n for n, w in self.lanes ]))
+        self._deficits = dict([ (name, 0.0) for name, weight in self.lanes ])
+        self._promoted_at = {}
+        self._requeued_at = {}
+        self._duplicates_checked_at = 0
+        self._lock_depths = {}
+        self._lock_tokens = {}
+        self._locked_at = {}
+        self._renewed_at = {}
 
     def flush_all(self):
         """
-        Clear out the Message queue
+        Clear out the Message queue, a batch at a time.
         """
-        # TODO: Run this a few times to clear out > 1000 Messages?
-        db.delete(QueuedMessage.all())
-        db.delete(QueuedMessageDependency.all())
+        for model in (QueuedMessage, QueuedMessageDependency, 
+                QueuedMessageSummary):
+            self._purge_query(model.all(keys_only=True), self.PURGE_BATCH)
+        self._purge_query(QueuedMessageSignature.all(keys_only=True),
+            self.PURGE_BATCH, delete=QueuedMessageSignature.delete_claims)
 
-    def put(self, subject='', body='', scheduled_for=None, priority=0, 
-            dependencies=None, allow_duplicate=True):
+    def purge(self, subject=None, finished_before=None, dead_before=None,
+            batch_size=PURGE_BATCH, max_batches=None, cursor=None):
+        """
+        Delete Messages a batch at a time, optionally only those with a given
+        subject and/or finished, or declared dead, before a given time.
+        Raises ValueError if given both finished_before and dead_before, as
+        no Message is both.  Messages depending on unfinished Messages that
+        get deleted stop waiting on them.
+
+        Stops after max_batches, if given, returning the count of Messages
+        deleted along with a cursor to pass back in to resume, which is None
+        once there's nothing left to delete.
+        """
+        if finished_before is not None and dead_before is not None:
+            raise ValueError('Purge by finished_before or dead_before, '
+                'not both')
+        query = QueuedMessage.all()
+        if subject is not None:
+            query.filter("subject =", subject)
+        if finished_before is not None:
+            query.filter("finished_at >", self.EPOCH)\
+                .filter("finished_at <", finished_before)
+        elif dead_before is not None:
+            query.filter("dead_at >", self.EPOCH)\
+                .filter("dead_at <", dead_before)
+        return self._purge_query(query, batch_size, max_batches, cursor,
+            self._delete_messages)
+
+    def _purge_query(self, query, batch_size, max_batches=None, cursor=None,
+            delete=db.delete):
         """
-        Put a Message into the queue
+        Delete everything found by a query a batch at a time, with the given
+        function or else by key.
         """
-        def do_put():
+        count, batches = 0, 0
+        while max_batches is None or batches < max_batches:
+            if cursor: query.with_cursor(cursor)
+            keys = query.fetch(batch_size)
+            if keys: delete(keys)
+            count, batches = count + len(keys), batches + 1
+            if len(keys) < batch_size: return count, None
+            cursor = query.cursor()
+        return count, cursor
 
-            message = QueuedMessage(
-                subject=subject, 
-                body=body, 
-                priority=priority, 
-                scheduled_for=scheduled_for
-            )
+    def compact(self, max_age=RETENTION_SECONDS, max_count=None, 
+            subjects=None, batch_size=PURGE_BATCH, max_batches=None):
+        """
+        Archive finished and dead Messages into daily per-subject summaries
+        and delete them, a batch at a time.  Messages go once they finished or
+        were declared dead more than max_age seconds ago, or, for each of the
+        given subjects, once they're older than the newest max_count finished
+        Messages with that subject.
 
-            if not allow_duplicate:
-                # Skip saving the message if one already exists with the new
-                # one's signature
-                new_sig = message._make_signature()
-                existing = QueuedMessage.all()\
-                    .filter("signature =", new_sig).fetch(1)
-                if existing: return None
+        Only one compaction runs at a time; returns the count of Messages
+        compacted, or None if another compaction is already running.
+        """
+        if not memcache.add(key=self.COMPACT_KEY, value='1', time=600):
+            return None
+        try:
+            count = 0
 
-            # Save the message and create any necessary dependencies.
-            message.put()
-            if dependencies:
-                for dep in dependencies:
-                    message.add_dependency(dep)
-            
-            return message
+            if max_age is not None:
+                cutoff = datetime.datetime.now() - \
+                    datetime.timedelta(seconds=max_age)
+                query = QueuedMessage.all()\
+                    .filter("finished_at >", self.EPOCH)\
+                    .filter("finished_at <", cutoff)\
+                    .order("finished_at")
+                count = count + self._compact_query(query, 0, 
+                    batch_size, max_batches)
+                query = QueuedMessage.all()\
+                    .filter("dead_at >", self.EPOCH)\
+                    .filter("dead_at <", cutoff)\
+                    .order("dead_at")
+                count = count + self._compact_query(query, 0, 
+                    batch_size, max_batches)
 
-        return self.run_with_lock(do_put)
+            if max_count is not None:
+                for subject in subjects or []:
+                    query = QueuedMessage.all()\
+                        .filter("subject =", subject)\
+                        .filter("finished_at >", self.EPOCH)\
+                        .order("-finished_at")
+                    count = count + self._compact_query(query, max_count,
+                        batch_size, max_batches)
 
-    def reserve(self):
+            return count
+        finally:
+            memcache.delete(key=self.COMPACT_KEY)
+
+    def _compact_query(self, query, offset, batch_size, max_batches):
         """
-        Reserve a message from the queue for exclusive processing
+        Archive and delete Messages found by a query past an offset, a batch
+        at a time.
         """
-        def do_reservation():
-            # Try grabbing all unreserved and unfinished Messages, in order of
-            # creation and priority.
-            messages = QueuedMessage.gql("""
-                WHERE reserved_at=:1 AND finished_at=:1 
-                ORDER BY created_at, priority DESC
-            """, None).fetch(1000)
-            
+        count, batches = 0, 0
+        while max_batches is None or batches < max_batches:
+            messages = query.fetch(batch_size, offset)
+            if messages:
+                QueuedMessageSummary.archive(messages)
+                self._delete_messages(messages)
+            count, batches = count + len(messages), batches + 1
+            if len(messages) < batch_size: break
+        return count
+
+    def backfill(self, batch_size=PURGE_BATCH, max_batches=None, 
+            cursor=None):
+        """
+        Bring Messages saved by older versions of the queue up to date, so
+        that they can be found and reserved: assign their shard by subject
+        and their lane, schedule them, count their pending dependencies,
+        give any left reserved a lease to run out, and work out whether
+        they're ready.  Messages already up to date are left alone.
+
+        Works through all Messages a batch at a time, stopping after
+        max_batches, if given.  Returns the count of Messages updated along
+        with a cursor to pass back in to resume, which is None once every
+        Message has been looked at.
+        """
+        def update(key, pending):
+            message = QueuedMessage.get(key)
+            if not message or message.schema_version is not None:
+                return False
             now = datetime.datetime.now()
+            message.shard = self.shard_for(message.subject)
+            message.lane = message.lane or self.default_lane
+            message.attempts = message.attempts or 0
+            message.unique = bool(message.unique)
+            message.pending_dependencies = pending
+            if message.scheduled_for is None:
+                message.scheduled_for = message.created_at or now
+            message.timer_at = None
+            if not message.finished_at and message.scheduled_for > now:
+                message.timer_at = message.scheduled_for
+            if message.reserved_at and not message.finished_at and \
+                    not message.lease_expires_at:
+                # Reservations never lapsed before, so this one may well
+                # have been abandoned.  Have it lapse from when it was made.
+                message.lease_expires_at = message.reserved_at + \
+                    datetime.timedelta(seconds=message.lease_seconds or 
+                        self.lease_seconds)
+                message.attempts = max(1, message.attempts)
+            message.schema_version = self.SCHEMA_VERSION
+            message.update_ready()
+            message.put()
+            return True
+
+        query = QueuedMessage.all()
+        count, batches = 0, 0
+        while max_batches is None or batches < max_batches:
+            if cursor: query.with_cursor(cursor)
+            messages = query.fetch(batch_size)
             for message in messages:
+                if message.schema_version is not None: continue
+                pending = QueuedMessageDependency.all(keys_only=True)\
+                    .filter("dependent_message =", message).count()
+                if db.run_in_transaction(update, message.key(), pending):
+                    count = count + 1
+            batches = batches + 1
+            # Backfilled Messages can now be found as put with duplicates
+            # allowed, which may be news to memcache.
+            if count: memcache.delete(self.DUPLICATES_NONE_KEY)
+            if len(messages) < batch_size: return count, None
+            cursor = query.cursor()
+        return count, cursor
 
-                # Skip scheduled messages not yet ready to run
-                if message.scheduled_for and message.scheduled_for > now:
-                    continue
+    def put(self, subject='', body='', scheduled_for=None, priority=0, 
+            dependencies=None, allow_duplicate=True, shard_key=None,
+            lease_seconds=None, lane=None):
+        """
+        Put a Message into the queue, in the shard picked by shard_key or
+        else by subject, and in the given lane or else the default lane.
+        lease_seconds overrides the queue's lease timeout for this message.
+        Raises LockTimeout, having saved nothing, if the message has
+        dependencies and the lock can't be had to add them.
+        """
+        # Messages with dependencies start out of the ready set, so that
+        # nothing can reserve them before the dependencies are counted.
+        message = self._build_message(subject, body, scheduled_for, priority,
+            shard_key, lease_seconds, lane)
+        message.update_ready()
+        if dependencies: message.ready = False
+        message.prepare_put()
 
-                # Skip messages that are depending on at least 1 other message.
-                dependencies = QueuedMessageDependency.all()\
-                    .filter("dependent_message =", message).fetch(1)
-                if dependencies: continue
+        # Skip saving the message if an unfinished one already exists with the
+        # new one's signature.
+        if not allow_duplicate:
+            message.unique = True
+            if not self._claim_signature(message): return None
 
-                # Set the reserved date on the message and stop looking.
-                message.reserved_at = now
+        if not dependencies:
+            message.put()
+        else:
+            # Save the message and create its dependencies in one step, under
+            # the same lock that finishing messages takes, so that failing to
+            # get the lock leaves nothing behind, not even a claimed
+            # signature.
+            def save():
                 message.put()
-                return message
+                message.add_dependencies(dependencies)
+            try:
+                self.run_with_lock(save)
+            except LockTimeout:
+                self._release_signatures([ message ])
+                raise
+
+        if not message.unique: memcache.delete(self.DUPLICATES_NONE_KEY)
+        return message
+
+    def _claim_signature(self, message):
+        """
+        Record the signature of a new message, returning False if an
+        unfinished message already has it.  Signatures claimed by others and
+        known to memcache cost no datastore calls, and the rest a
+        transactional get by key name.
+
+        Messages put with duplicates allowed claim nothing, so they're
+        looked for with a query, unless memcache vouches for there being no
+        unfinished ones at all: every such put forgets that, and the next
+        query to find none of them anywhere remembers it again.
+        """
+        cache_key = self.SIGNATURE_KEY % message.signature
+        cached = memcache.get_multi([ cache_key, self.DUPLICATES_NONE_KEY ])
+        if cached.get(cache_key): return False
+
+        # Look for any unfinished Messages with duplicates allowed at most
+        # once per SIGNATURE_CACHE_SECONDS, so that while there are some,
+        # checks cost one query rather than two.
+        if not cached.get(self.DUPLICATES_NONE_KEY):
+            now = time.time()
+            if now - self._duplicates_checked_at >= \
+                    self.SIGNATURE_CACHE_SECONDS:
+                self._duplicates_checked_at = now
+                if QueuedMessage.all(keys_only=True)\
+                        .filter("unique =", False)\
+                        .filter("finished_at =", None).get() is None:
+                    memcache.set(self.DUPLICATES_NONE_KEY, '1', 
+                        time=self.SIGNATURE_CACHE_SECONDS)
+                    cached[self.DUPLICATES_NONE_KEY] = '1'
+
+        if not cached.get(self.DUPLICATES_NONE_KEY):
+            duplicate = QueuedMessage.all(keys_only=True)\
+                .filter("signature =", message.signature)\
+                .filter("unique =", False)\
+                .filter("finished_at =", None).get()
+            if duplicate is not None: return False
+
+        key_name = QueuedMessageSignature.key_name_for(message.signature)
+        def claim():
+            if QueuedMessageSignature.get_by_key_name(key_name): return False
+            QueuedMessageSignature(key_name=key_name).put()
+            return True
+
+        claimed = db.run_in_transaction(claim)
+        memcache.set(cache_key, '1', time=self.SIGNATURE_CACHE_SECONDS)
+        return claimed
+
+    def _release_signatures(self, messages):
+        """
+        Forget the signatures claimed by messages put without duplicates
+        allowed, so the same message can be put again.
+        """
+        QueuedMessageSignature.release(messages)
+
+    def _delete_messages(self, messages):
+        """
+        Delete a batch of Messages along with the signatures they claimed.
+        Unfinished Messages also take their dependencies with them, under the
+        lock, releasing anything that was waiting on them.
+        """
+        self._release_signatures(messages)
+        unfinished = [ m for m in messages if not m.finished_at ]
+        if unfinished:
+            self.run_with_lock(lambda: self._drop_dependencies(unfinished))
+        db.delete(messages)
+
+    def _drop_dependencies(self, messages):
+        """
+        Delete the dependencies of and on Messages about to be deleted,
+        counting down the Messages depending on them.  Expects the lock to be
+        held.
+        """
+        for message in messages:
+            message.release_dependents(self.renew_lock)
+            while True:
+                keys = QueuedMessageDependency.all(keys_only=True)\
+                    .filter("dependent_message =", message).fetch(500)
+                if not keys: break
+                db.delete(keys)
+
+    def put_group(self, messages, edges):
+        """
+        Put a group of Messages with dependencies between them into the queue.
+
+        messages is a list of dicts of keyword arguments as accepted by put(),
+        other than dependencies, which edges take the place of, and
+        allow_duplicate, since every Message in a group is saved.  edges is a
+        list of (preceding, dependent) index pairs into messages.  Raises
+        DependencyCycleError if the dependencies contain a cycle, before
+        anything gets saved.  Otherwise, all the Messages and then all the
+        dependencies are saved, PUT_BATCH at a time, and the Messages
+        returned.
+        """
+        edges = set(edges)
+        count = len(messages)
+        for preceding, dependent in edges:
+            if not (0 <= preceding < count and 0 <= dependent < count):
+                raise ValueError('Dependency (%s, %s) out of range' % 
+                    (preceding, dependent))
+
+        # Topologically sort the group, by repeatedly peeling off Messages
+        # with no remaining dependencies.  Anything left over sits on a cycle.
+        pending    = [ 0 ] * count
+        dependents = [ [] for i in range(count) ]
+        for preceding, dependent in edges:
+            pending[dependent] = pending[dependent] + 1
+            dependents[preceding].append(dependent)
+
+        remaining = list(pending)
+        ready = [ i for i in range(count) if not remaining[i] ]
+        sorted_count = 0
+        while ready:
+            i = ready.pop()
+            sorted_count = sorted_count + 1
+            for dependent in dependents[i]:
+                remaining[dependent] = remaining[dependent] - 1
+                if not remaining[dependent]: ready.append(dependent)
+
+        if sorted_count < count:
+            raise DependencyCycleError('Cycle among messages %s' % 
+                [ i for i in range(count) if remaining[i] ])
+
+        # Everything is new and unfinished, so dependency counters can be set
+        # up front and no lock is needed to keep them straight.
+        group = []
+        for i in range(count):
+            message = self._build_message(**messages[i])
+            message.pending_dependencies = pending[i]
+            message.update_ready()
+            message.prepare_put()
+            group.append(message)
+        self._put_batches(group)
+        self._put_batches([ 
+            QueuedMessageDependency(
+                preceding_message=group[preceding], 
+                dependent_message=group[dependent]
+            ) for preceding, dependent in edges
+        ])
+        if group: memcache.delete(self.DUPLICATES_NONE_KEY)
+
+        return group
+
+    def _put_batches(self, entities):
+        """
+        Save a list of entities PUT_BATCH at a time.
+        """
+        for i in range(0, len(entities), self.PUT_BATCH):
+            db.put(entities[i:i + self.PUT_BATCH])
+
+    def _build_message(self, subject='', body='', scheduled_for=None, 
+            priority=0, shard_key=None, lease_seconds=None, lane=None):
+        """
+        Build an unsaved Message, assigned to its shard and lane.
+        """
+        if lane is None: 
+            lane = self.default_lane
+        elif lane not in self.lane_weights:
+            raise ValueError('Lane %s is not one of %s' % 
+                (lane, [ n for n, w in self.lanes ]))
+        message = QueuedMessage(
+            subject=subject, 
+            body=body, 
+            priority=priority, 
+            shard=self.shard_for(shard_key is None and subject or shard_key),
+            lane=lane,
+            lease_seconds=lease_seconds,
+            schema_version=self.SCHEMA_VERSION
+        )
+        message.schedule(scheduled_for)
+        return message
 
-        return self.run_with_lock(do_reservation)
+    def shard_for(self, shard_key):
+        """
+        Map a shard key onto one of this queue's shards.
+        """
+        if self.shard_count == 1: return 0
+        return int(md5.new(shard_key).hexdigest()[:8], 16) % self.shard_count
+
+    def reserve(self):
+        """
+        Reserve a message from the queue for exclusive processing
+        """
+        messages = self.reserve_many(1)
+        return messages and messages[0] or None
+
+    def reserve_many(self, count):
+        """
+        Reserve up to count messages from the queue for exclusive processing,
+        with a single lock acquisition per shard visited.
+        """
+        start = time.time()
+        messages = []
+        for shard in self._shard_rotation():
+            wanted = count - len(messages)
+            if wanted <= 0: break
+            if time.time() - self._requeued_at.get(shard, 0) >= \
+                    self.REQUEUE_SECONDS:
+                self.requeue_expired(shard)
+            if time.time() - self._promoted_at.get(shard, 0) >= \
+                    self.PROMOTE_SECONDS:
+                self.promote_due(shard)
+            reserved = self._reserve_shard(shard, wanted)
+
+            # Coming up short, put any abandoned reservations and newly due
+            # messages in play and take another look.
+            if len(reserved) < wanted and \
+                    self.requeue_expired(shard) + self.promote_due(shard):
+                reserved.extend(
+                    self._reserve_shard(shard, wanted - len(reserved)))
+
+            messages.extend(reserved)
+
+        self.stats.add_timing('reserve', time.time() - start)
+        self.stats.incr('reserve_calls')
+        self.stats.incr('messages_reserved', len(messages))
+        return messages
+
+    def _reserve_shard(self, shard, count):
+        """
+        Reserve up to count messages from a shard, by whichever strategy this
+        queue uses.
+        """
+        if self.optimistic:
+            return self._reserve_lanes(shard, count, self._claim_many)
+        try:
+            return self.run_with_lock(lambda: self._reserve_lanes(shard, 
+                count, self._reserve_ready), shard)
+        except LockTimeout:
+            self.log.warning('Timed out waiting to reserve from shard %s' % 
+                shard)
+            return []
+
+    def _reserve_lanes(self, shard, count, reserve):
+        """
+        Reserve up to count messages from a shard's lanes, by deficit round
+        robin: each lane is owed its weighted share of every reservation, and
+        what it's owed carries over between calls until it's paid out or the
+        lane runs dry.  Anything a lane can't use goes to the others, in
+        order of weight.
+        """
+        if len(self.lanes) == 1:
+            return reserve(shard, self.lanes[0][0], count)
+
+        messages, short = [], []
+        for lane, share in self._lane_shares(count):
+            share = min(share, count - len(messages))
+            if share <= 0: continue
+            reserved = reserve(shard, lane, share)
+            messages.extend(reserved)
+            if len(reserved) < share:
+                # Lanes run dry forfeit what they're owed, so an idle lane
+                # can't save up for a burst.
+                self._deficits[lane] = 0.0
+                short.append(lane)
+
+        by_weight = [ (-weight, i, name) 
+            for i, (name, weight) in enumerate(self.lanes) ]
+        by_weight.sort()
+        for weight, i, lane in by_weight:
+            wanted = count - len(messages)
+            if wanted <= 0: break
+            if lane in short: continue
+            messages.extend(reserve(shard, lane, wanted))
+
+        for message in messages:
+            self.stats.incr('messages_reserved %s' % message.lane)
+        return messages
+
+    def _lane_shares(self, count):
+        """
+        Add each lane's weighted share of count to what it's owed, and split
+        count between the lanes by what they're owed, largest remainders
+        first.  Credit carried over can leave the lanes owed more than count
+        between them, in which case those owed least are cut back first.
+        Returns a list of (lane, share) pairs adding up to at most count.
+        """
+        total = float(sum([ weight for name, weight in self.lanes ]))
+        shares, remainders, least_owed = {}, [], []
+        for i in range(len(self.lanes)):
+            name, weight = self.lanes[i]
+            owed = self._deficits[name] + count * weight / total
+            self._deficits[name] = owed
+            shares[name] = max(0, int(owed))
+            remainders.append( (-(owed - shares[name]), i, name) )
+            least_owed.append( (owed, i, name) )
+
+        remainders.sort()
+        for r, i, name in remainders[:max(0, count - sum(shares.values()))]:
+            shares[name] = shares[name] + 1
+
+        least_owed.sort()
+        excess = sum(shares.values()) - count
+        for owed, i, name in least_owed:
+            if excess <= 0: break
+            cut = min(shares[name], excess)
+            shares[name] = shares[name] - cut
+            excess = excess - cut
+
+        for name in shares:
+            self._deficits[name] = self._deficits[name] - shares[name]
+        return [ (name, shares[name]) for name, weight in self.lanes ]
+
+    def _shard_rotation(self):
+        """
+        List this queue's shards, starting with a different one on each call
+        so that no one shard gets drained ahead of the others.
+        """
+        start = self._next_shard % len(self.shards)
+        self._next_shard = start + 1
+        return self.shards[start:] + self.shards[:start]
+
+    def _reserve_ready(self, shard, lane, count):
+        """
+        Reserve up to count messages from a lane of a shard, expecting the
+        shard's lock to be held.
+        """
+        # The ready flag already accounts for reservation, completion, and
+        # dependencies, so only the rows to be reserved need fetching.
+        now = datetime.datetime.now()
+        messages = self._ready_query(shard, lane).fetch(count)
+        self.stats.incr('messages_scanned', len(messages))
+
+        # Set the reserved date on the messages, take them out of the ready
+        # set, and save them all in one batch.
+        for message in messages:
+            self._mark_reserved(message, now)
+        if messages: db.put(messages)
+        return messages
+
+    def _claim_many(self, shard, lane, count):
+        """
+        Reserve up to count messages from a lane of a shard without its
+        lock, by claiming each candidate in a transaction that only succeeds
+        if it's still ready.  Candidates lost to another worker are skipped
+        in favor of the next.
+        """
+        now  = datetime.datetime.now()
+        keys = self._ready_query(shard, lane, keys_only=True)\
+            .fetch(count * self.CLAIM_OVERSAMPLE)
+        self.stats.incr('messages_scanned', len(keys))
+
+        def claim(key):
+            message = QueuedMessage.get(key)
+            if not message or not message.ready: return None
+            self._mark_reserved(message, now)
+            message.put()
+            return message
+
+        messages = []
+        for key in keys:
+            try:
+                message = db.run_in_transaction(claim, key)
+            except db.TransactionFailedError:
+                message = None
+            if message: 
+                messages.append(message)
+                if len(messages) >= count: break
+
+        return messages
+
+    def _mark_reserved(self, message, now):
+        """
+        Stamp a message as reserved, counting the attempt and starting its
+        lease.
+        """
+        lease_seconds = message.lease_seconds or self.lease_seconds
+        message.reserved_at = now
+        message.lease_expires_at = now + \
+            datetime.timedelta(seconds=lease_seconds)
+        message.attempts = message.attempts + 1
+        message.ready = False
+
+    def requeue_expired(self, shard=None, limit=100):
+        """
+        Find reservations whose lease has run out, in one shard or all of this
+        queue's shards, and make their messages reservable again.  Messages
+        out of attempts are marked dead instead.  Returns the count of
+        messages put back in the ready set.
+        """
+        now    = datetime.datetime.now()
+        shards = shard is None and self.shards or [ shard ]
+
+        def requeue(key):
+            # Re-check under the transaction, in case the message was
+            # finished or requeued since the query ran.
+            message = QueuedMessage.get(key)
+            if not message or message.finished_at: return None
+            if not message.lease_expires_at: return None
+            if message.lease_expires_at > now: return None
+            message.reserved_at = None
+            message.lease_expires_at = None
+            if message.attempts >= self.max_attempts:
+                message.dead_at = now
+            message.update_ready()
+            message.put()
+            return message
+
+        count, dead = 0, 0
+        for shard in shards:
+            self._requeued_at[shard] = time.time()
+            keys = QueuedMessage.all(keys_only=True)\
+                .filter("shard =", shard)\
+                .filter("lease_expires_at >", self.EPOCH)\
+                .filter("lease_expires_at <=", now)\
+                .order("lease_expires_at").fetch(limit)
+            for key in keys:
+                try:
+                    message = db.run_in_transaction(requeue, key)
+                except db.TransactionFailedError:
+                    message = None
+                if message and message.ready: count = count + 1
+                if message and message.dead_at: dead = dead + 1
+
+        if count: self.stats.incr('messages_requeued', count)
+        if dead: self.stats.incr('messages_dead', dead)
+        return count
+
+    def promote_due(self, shard=None, limit=PROMOTE_BATCH):
+        """
+        Find messages scheduled for later whose time has come, in one shard
+        or all of this queue's shards, and stop their timers so they can
+        join the ready set.  Returns the count of messages made ready.
+        """
+        now    = datetime.datetime.now()
+        shards = shard is None and self.shards or [ shard ]
+
+        def promote(key):
+            # Re-check under the transaction, in case the message was
+            # promoted since the query ran.
+            message = QueuedMessage.get(key)
+            if not message or not message.timer_at: return False
+            if message.timer_at > now: return False
+            message.timer_at = None
+            message.update_ready()
+            message.put()
+            return message.ready
+
+        count = 0
+        for shard in shards:
+            self._promoted_at[shard] = time.time()
+            keys = QueuedMessage.all(keys_only=True)\
+                .filter("shard =", shard)\
+                .filter("timer_at >", self.EPOCH)\
+                .filter("timer_at <=", now)\
+                .order("timer_at").fetch(limit)
+            for key in keys:
+                try:
+                    if db.run_in_transaction(promote, key):
+                        count = count + 1
+                except db.TransactionFailedError:
+                    pass
+
+        if count: self.stats.incr('messages_promoted', count)
+        return count
+
+    def _ready_query(self, shard, lane, keys_only=False):
+        """
+        Build a query for ready Messages in a lane of a shard, in order of
+        priority and creation.  Messages scheduled for later wait on timers
+        outside the ready set, so everything here is due.
+        """
+        return QueuedMessage.all(keys_only=keys_only)\
+            .filter("shard =", shard)\
+            .filter("lane =", lane)\
+            .filter("ready =", True)\
+            .order("-priority").order("created_at")
+
+    def gauges(self):
+        """
+        Look over the queue, reporting how many messages are ready in all
+        and per lane, reserved, and dead, and how long the oldest ready
+        message has been due.  Counts stop at GAUGE_LIMIT per shard and lane.
+        """
+        now = datetime.datetime.now()
+        ready, reserved, oldest = 0, 0, None
+        lanes = dict([ (name, 0) for name, weight in self.lanes ])
+        for shard in self.shards:
+            for lane in lanes:
+                lanes[lane] = lanes[lane] + self._ready_query(shard, lane, 
+                    keys_only=True).count(self.GAUGE_LIMIT)
+                message = QueuedMessage.all()\
+                    .filter("shard =", shard)\
+                    .filter("lane =", lane)\
+                    .filter("ready =", True)\
+                    .order("scheduled_for").get()
+                if message and (oldest is None or 
+                        message.scheduled_for < oldest):
+                    oldest = message.scheduled_for
+            reserved = reserved + QueuedMessage.all(keys_only=True)\
+                .filter("shard =", shard)\
+                .filter("lease_expires_at >", self.EPOCH)\
+                .count(self.GAUGE_LIMIT)
+        ready = sum(lanes.values())
+
+        dead = QueuedMessage.all(keys_only=True)\
+            .filter("dead_at >", self.EPOCH).count(self.GAUGE_LIMIT)
+
+        return {
+            'ready': ready,
+            'lanes': lanes,
+            'reserved': reserved,
+            'dead': dead,
+            'oldest_ready_age_seconds': 
+                oldest and _total_seconds(now - oldest) or 0.0
+        }
 
     def add_listener(self, subject_pattern, listener):
         """
-        Register a message listener interested in a subject
+        Register a message listener interested in a subject, or in subjects
+        matching a pattern as understood by SubjectRouter.
         """
+        # Name the listener, so its outcomes can be recorded on messages,
+        # numbering any that would share a name with one already added.
+        name = '%s %s' % (subject_pattern, 
+            getattr(listener, '__name__', None) or repr(listener))
+        count = self._listener_names.count(name)
+        self._listener_names.append(name)
+        if count: name = '%s #%s' % (name, count + 1)
+
         self.listeners.append( (subject_pattern, listener) )
+        self.router.add(subject_pattern, (name, listener))
 
     def add_listeners(self, listeners):
         """
         Add a list of listeners, expected as a list of (subject, listener)
         tuple pairs.
         """
-        self.listeners.extend(listeners)
+        for subject_pattern, listener in listeners:
+            self.add_listener(subject_pattern, listener)
 
     def process(self):
         """
@@ -122,45 +1350,344 @@ class MessageQueue:
         message = self.reserve()
         if not message: return None
 
-        # Run through all registered listeners looking for any interested in
-        # the subject of this message.
-        for subject, listener in self.listeners:
-            if message.subject == subject:
-                try:
-                    listener(message)
-                except:
-                    # TODO: Do something with an exception here
-                    pass
-
-        # Mark the message as finished and return it.
-        message.finish()
+        self._dispatch(message)
         return message
 
-    def run_with_lock(self, func):
+    def process_batch(self, count):
+        """
+        Reserve up to count messages in one go and process each of them in
+        turn.  Returns the list of messages processed.
+        """
+        messages = self.reserve_many(count)
+        for message in messages:
+            self._dispatch(message)
+        return messages
+
+    def work(self, deadline=WORK_SECONDS, batch_size=WORK_BATCH, 
+            idle_sleep=IDLE_SECONDS, max_idle_sleep=IDLE_MAX_SECONDS):
+        """
+        Process messages batch_size at a time until deadline seconds have
+        passed, backing off from idle_sleep up to max_idle_sleep seconds
+        while there's nothing to do.  A batch started before the deadline
+        runs to completion, so leave some headroom under request limits.
+
+        Returns a dict of stats on the run.
+        """
+        start = time.time()
+        stop  = start + deadline
+        processed, batches, idle = 0, 0, 0.0
+        sleep = idle_sleep
+
+        while time.time() < stop:
+            messages = self.process_batch(batch_size)
+            batches = batches + 1
+            if messages:
+                processed = processed + len(messages)
+                sleep = idle_sleep
+                continue
+
+            nap = min(sleep, stop - time.time())
+            if nap <= 0: break
+            time.sleep(nap)
+            idle = idle + nap
+            sleep = min(sleep * 2, max_idle_sleep)
+
+        self.stats.flush()
+        elapsed = time.time() - start
+        return {
+            'processed': processed,
+            'batches': batches,
+            'idle_seconds': idle,
+            'elapsed_seconds': elapsed,
+            'messages_per_second': elapsed and processed / elapsed or 0.0
+        }
+
+    def _dispatch(self, message):
+        """
+        Hand a reserved message to all interested listeners, recording how
+        each fared on the message.  Then finish it, unless any listener needs
+        the message retried.
+        """
+        # Run through all registered listeners interested in the subject of
+        # this message, skipping those already done with it on an earlier
+        # attempt.
+        start = time.time()
+        outcomes = message.get_outcomes()
+        listeners = [ 
+            (name, listener) 
+            for name, listener in self.router.match(message.subject)
+            if outcomes.get(name) not in 
+                (QueuedMessage.SUCCESS, QueuedMessage.FAILURE)
+        ]
+
+        if self.parallel_listeners and listeners:
+            results = self._run_listeners_parallel(message, listeners)
+        else:
+            results = dict([ 
+                (name, self._run_listener(name, listener, message))
+                for name, listener in listeners
+            ])
+
+        # Retry after the longest delay any failed listener needs: what it
+        # asked for, or else the usual backoff.
+        delays = []
+        for name, listener in listeners:
+            outcome, retry_delay = results[name]
+            outcomes[name] = outcome
+            if outcome == QueuedMessage.RETRY:
+                if retry_delay is None: retry_delay = self.backoff(message)
+                delays.append(retry_delay)
+
+        message.set_outcomes(outcomes)
+        if QueuedMessage.RETRY in outcomes.values():
+            self.retry(message, delays and max(delays) or None)
+        else:
+            try:
+                self.finish(message)
+            except LockTimeout:
+                # Save the outcomes and leave the message reserved, so that
+                # once its lease runs out it's finished without running the
+                # listeners again.
+                self.log.warning('Timed out finishing message %s' % 
+                    message.key())
+                message.put()
+
+        self.stats.add_timing('process', time.time() - start)
+        self.stats.incr('messages_processed')
+
+    def _run_listener(self, name, listener, message):
+        """
+        Run a listener on a message, returning its outcome along with any
+        delay it asked for before a retry.
+        """
+        start = time.time()
+        try:
+            listener(message)
+            result = QueuedMessage.SUCCESS, None
+        except RejectMessage:
+            self.log.exception('Listener %s rejected message %s' % 
+                (name, message.key()))
+            result = QueuedMessage.FAILURE, None
+        except Exception, e:
+            self.log.exception('Listener %s failed on message %s' % 
+                (name, message.key()))
+            # Only RetryMessage can ask for a delay.
+            delay = None
+            if isinstance(e, RetryMessage): delay = e.delay
+            result = QueuedMessage.RETRY, delay
+
+        elapsed = time.time() - start
+        self.stats.add_timing('listener', elapsed)
+        self.stats.add_timing('listener %s' % name, elapsed)
+        self.stats.incr('listener_%s' % result[0])
+        return result
+
+    def _run_listeners_parallel(self, message, listeners):
+        """
+        Run listeners on a message at once on the listener pool, and wait
+        for them all to finish or time out.  Listeners that time out are
+        left to run in the background, but counted as needing a retry, as
+        are those still running on the message from an earlier attempt.
+        """
+        results, jobs = {}, []
+        for name, listener in listeners:
+            job = self.listener_pool.submit( (str(message.key()), name), 
+                self._run_listener, name, listener, message)
+            if job is None:
+                self.log.warning('Listener %s still running on message %s' %
+                    (name, message.key()))
+                results[name] = (QueuedMessage.RETRY, None)
+            else:
+                jobs.append( (name, job) )
+
+        # Wait no longer than the listener timeout, nor past the lease.
+        timeouts = [ t for t in [ 
+            self.listener_timeout, 
+            message.lease_expires_at and 
+                _total_seconds(message.lease_expires_at - 
+                    datetime.datetime.now())
+        ] if t is not None ]
+        deadline = timeouts and time.time() + min(timeouts) or None
+
+        for name, job in jobs:
+            job[0].wait(deadline and max(0, deadline - time.time()))
+            if not job[0].isSet():
+                self.log.warning('Listener %s timed out on message %s' %
+                    (name, message.key()))
+            results[name] = job[1] or (QueuedMessage.RETRY, None)
+        return results
+
+    def retry(self, message, delay=None):
+        """
+        Put a reserved message back in the queue to be tried again after a
+        delay, growing exponentially with each attempt unless given, or set
+        it aside as dead once out of attempts.
+        """
+        now = datetime.datetime.now()
+        if delay is None: delay = self.backoff(message)
+
+        message.reserved_at = None
+        message.lease_expires_at = None
+        if message.attempts >= self.max_attempts:
+            message.dead_at = now
+            self.stats.incr('messages_dead')
+        else:
+            message.schedule(now + datetime.timedelta(seconds=delay))
+            self.stats.incr('messages_retried')
+        message.update_ready()
+        message.put()
+
+    def backoff(self, message):
+        """
+        Work out how many seconds to wait before retrying a message, growing
+        exponentially with each attempt.
+        """
+        return min(self.RETRY_MAX_SECONDS, 
+            self.retry_seconds * 2 ** max(0, message.attempts - 1))
+
+    def finish(self, message):
+        """
+        Mark a message as finished.  Only if it has dependents is the lock
+        taken, to serialize the update of their counters with any other
+        dependency changes.  If the lock can't be had, the message is put
+        back as it was, reserved, and LockTimeout raised.
+        """
+        start = time.time()
+        lease_expires_at = message.lease_expires_at
+        message.mark_finished()
+
+        # Dependencies are looked for only once the message is marked, so
+        # that any added meanwhile are either found here or released by the
+        # put adding them, which checks again for finished messages.
+        if message.has_dependents():
+            try:
+                self.run_with_lock(
+                    lambda: message.release_dependents(self.renew_lock))
+            except LockTimeout:
+                message.finished_at = None
+                message.lease_expires_at = lease_expires_at
+                message.put()
+                raise
+        self._release_signatures([ message ])
+        self.stats.add_timing('finish', time.time() - start)
+        self.stats.incr('messages_finished')
+
+    def run_with_lock(self, func, shard=None):
         """
         For creation of Message groups with dependencies, this method allows the
         whole process to run within an exclusive lock.
         """
-        self.lock()
+        self.lock(shard)
         rv = None
         try:
             rv = func()
         finally:    
-            self.unlock()
+            self.unlock(shard)
         return rv
 
-    def lock(self):
+    def lock(self, shard=None):
+        """
+        Attempt to set a mutex in memcache to lock the queue (or just one of
+        its shards) for serial access, retrying with jittered exponential
+        backoff and raising LockTimeout if it can't be had in time.  Locks
+        already held by this queue are simply re-entered.
+
+        The mutex holds a random token, unique to each acquisition, which
+        is returned.  The lock lapses after lock_seconds, so long critical
+        sections should call renew_lock().
+        """
+        key = self._mutex_key(shard)
+        depth = self._lock_depths.get(key, 0)
+        if depth:
+            self._lock_depths[key] = depth + 1
+            return self._lock_tokens[key]
+
+        token = '%x' % random.getrandbits(64)
+        start, spins = time.time(), 0
+        sleep = self.LOCK_SLEEP_SECONDS
+        while not memcache.add(key=key, value=token, time=self.lock_seconds):
+            waited = time.time() - start
+            if waited >= self.lock_timeout:
+                self._count_lock_wait(start, spins)
+                self.stats.incr('lock_timeouts')
+                raise LockTimeout('Waited %.3f seconds for lock %s' % 
+                    (waited, key))
+            spins = spins + 1
+            time.sleep(min(random.uniform(sleep / 2, sleep), 
+                self.lock_timeout - waited))
+            sleep = min(sleep * 2, self.LOCK_SLEEP_MAX_SECONDS)
+
+        self._count_lock_wait(start, spins)
+        self.stats.incr('lock_acquired')
+
+        self._lock_depths[key] = 1
+        self._lock_tokens[key] = token
+        self._locked_at[key] = self._renewed_at[key] = time.time()
+        return token
+
+    def _count_lock_wait(self, start, spins):
+        self.stats.add_timing('lock_wait', time.time() - start)
+        if spins:
+            self.stats.incr('lock_contended')
+            self.stats.incr('lock_spins', spins)
+
+    def renew_lock(self, shard=None):
         """
-        Attempt to set a mutex in memcache to lock the queue for serial access.
+        Extend the lock held by this queue for another lock_seconds,
+        returning False if it lapsed and was lost to another holder.
         """
-        while memcache.add(key=self.MUTEX_KEY, value='1', time=1) == False:
-            time.sleep(0.01)
+        key = self._mutex_key(shard)
+        token = self._lock_tokens.get(key)
+        if token is None or memcache.get(key) != token:
+            self._renewed_at.pop(key, None)
+            self._lost_lock(key)
+            return False
+        memcache.set(key=key, value=token, time=self.lock_seconds)
+        self._renewed_at[key] = time.time()
+        self.stats.incr('lock_renewals')
+        return True
 
-    def unlock(self):
+    def unlock(self, shard=None):
         """
-        Unlock the queue.
+        Unlock the queue, once the outermost holder of the lock lets go.  A
+        lock that has lapsed and been taken by another holder is left alone.
         """
-        memcache.delete(key=self.MUTEX_KEY)
+        key = self._mutex_key(shard)
+        depth = self._lock_depths.get(key, 0) - 1
+        if depth > 0:
+            self._lock_depths[key] = depth
+            return
+        self._lock_depths.pop(key, None)
+        token = self._lock_tokens.pop(key, None)
+        locked_at = self._locked_at.pop(key, None)
+        renewed_at = self._renewed_at.pop(key, None)
+        if locked_at is not None:
+            self.stats.add_timing('lock_held', time.time() - locked_at)
+
+        # Well within lock_seconds of taking or renewing the lock, it can't
+        # have lapsed, so it's simply deleted.  Later on, it's checked first,
+        # though without compare-and-delete in memcache there's still a
+        # sliver of time between checking and deleting for it to change
+        # hands.
+        if renewed_at is not None and \
+                time.time() - renewed_at < self.lock_seconds / 2.0:
+            memcache.delete(key=key)
+        elif memcache.get(key) == token:
+            memcache.delete(key=key)
+        else:
+            self._lost_lock(key)
+
+    def _lost_lock(self, key):
+        self.stats.incr('lock_lost')
+        self.log.warning('Lock %s lapsed while held' % key)
+
+    def _mutex_key(self, shard):
+        """
+        Build the memcache key for the lock on a shard.  An unsharded queue
+        has just the one lock.
+        """
+        if shard is None or self.shard_count == 1: return self.MUTEX_KEY
+        return '%s/%s' % (self.MUTEX_KEY, shard)
 
 class QueuedMessage(db.Model):
     """
@@ -169,37 +1696,172 @@ class QueuedMessage(db.Model):
     created_at    = db.DateTimeProperty(auto_now_add=True)
     updated_at    = db.DateTimeProperty(auto_now=True)
     scheduled_for = db.DateTimeProperty(default=None)
+
+    # Set to scheduled_for while the message waits for its time to come,
+    # keeping it out of the ready set until then.
+    timer_at      = db.DateTimeProperty(default=None)
     reserved_at   = db.DateTimeProperty(default=None)
     finished_at   = db.DateTimeProperty(default=None)
     priority      = db.IntegerProperty(default=0)
+    shard         = db.IntegerProperty(default=0)
+    lane          = db.StringProperty(default=MessageQueue.DEFAULT_LANE)
+
+    # Count of preceding Messages not yet finished.
+    pending_dependencies = db.IntegerProperty(default=0)
+
+    # How each listener fared on the message, as "outcome:listener name".
+    listener_outcomes = db.StringListProperty()
+
+    SUCCESS = 'success'
+    RETRY   = 'retry'
+    FAILURE = 'failure'
+
+    # Reservations lapse once lease_expires_at passes, after which the message
+    # is retried until it runs out of attempts and is marked dead.
+    lease_seconds    = db.IntegerProperty(default=None)
+    lease_expires_at = db.DateTimeProperty(default=None)
+    attempts         = db.IntegerProperty(default=0)
+    dead_at          = db.DateTimeProperty(default=None)
+
+    # Unreserved, unfinished, and not waiting on any dependencies.
+    ready         = db.BooleanProperty(default=True)
    
     subject       = db.StringProperty(required=True)
     body          = db.BlobProperty(required=True)
     signature     = db.StringProperty()
-    
-    # TODO: retries?
 
-    def finish(self):
+    # Put with duplicates not allowed, holding a claim on its signature
+    # until it's finished or deleted.
+    unique        = db.BooleanProperty(default=False)
+
+    # MessageQueue.SCHEMA_VERSION when saved, or None if saved before that
+    # was recorded and not yet backfilled.
+    schema_version = db.IntegerProperty(default=None)
+
+    def finish(self, heartbeat=None):
+        """
+        Mark a message as finished, release its dependents, and give up any
+        claim on its signature.
+        """
+        self.mark_finished()
+        self.release_dependents(heartbeat)
+        QueuedMessageSignature.release([ self ])
+
+    def mark_finished(self):
         """
-        Mark a message as finished and delete any dependencies.
+        Mark when the Message was finished.
         """
-        # Mark when the Message was finished.
         self.finished_at = datetime.datetime.now()
+        self.lease_expires_at = None
+        self.ready = False
         self.put()
 
-        # Delete all dependencies on this Message.
-        db.delete(QueuedMessageDependency.all().filter("preceding_message =", self))
+    def has_dependents(self):
+        """
+        Check whether any Messages depend on this one.
+        """
+        return QueuedMessageDependency.all(keys_only=True)\
+            .filter("preceding_message =", self).get() is not None
+
+    def release_dependents(self, heartbeat=None):
+        """
+        Delete any dependencies on this finished Message, readying any
+        dependent Messages left with nothing else to wait on.  heartbeat, if
+        given, is called between batches of dependencies, as for renewing a
+        lock held over all this.
+        """
+        # Work through dependencies on this Message a batch at a time,
+        # decrementing the counters on dependent Messages with one batched
+        # write and then deleting the dependencies.
+        while True:
+            dependencies = QueuedMessageDependency.all()\
+                .filter("preceding_message =", self).fetch(500)
+            if not dependencies: break
+
+            counts = {}
+            for dependency in dependencies:
+                key = QueuedMessageDependency.dependent_message\
+                    .get_value_for_datastore(dependency)
+                counts[key] = counts.get(key, 0) + 1
+
+            dependents = [ d for d in QueuedMessage.get(counts.keys()) if d ]
+            for dependent in dependents:
+                dependent.pending_dependencies = max(0, 
+                    dependent.pending_dependencies - counts[dependent.key()])
+                dependent.update_ready()
+
+            db.put(dependents)
+            db.delete(dependencies)
+            if heartbeat: heartbeat()
 
     def add_dependency(self, preceding_message):
         """
         Create a dependency between this Message and a preceding Message required to be
         finished before this one.
         """
-        dependency = QueuedMessageDependency(
-            preceding_message=preceding_message, 
-            dependent_message=self
-        )
-        dependency.put()
+        self.add_dependencies([ preceding_message ])
+
+    def add_dependencies(self, preceding_messages):
+        """
+        Create dependencies between this Message and a list of preceding
+        Messages, counting those not yet finished.
+        """
+        # Nothing to wait for on preceding Messages already finished, going
+        # by a fresh look rather than possibly stale copies.
+        preceding = QueuedMessage.get([ m.key() for m in preceding_messages ])
+        preceding = [ m for m in preceding if m and not m.finished_at ]
+
+        if preceding:
+            db.put([
+                QueuedMessageDependency(
+                    preceding_message=m, 
+                    dependent_message=self
+                ) for m in preceding
+            ])
+
+        self.pending_dependencies = self.pending_dependencies + len(preceding)
+        self.update_ready()
+        self.put()
+
+        # Finishing doesn't take the lock unless it finds dependencies, so a
+        # preceding Message may have finished since the look above without
+        # seeing the new ones.  Release its dependents here instead; whichever
+        # of this and the finish gets the lock first deletes the dependencies,
+        # so nothing is counted twice.
+        finished = [ m for m in 
+            QueuedMessage.get([ m.key() for m in preceding ])
+            if m and m.finished_at ]
+        for message in finished:
+            message.release_dependents()
+        if finished:
+            current = QueuedMessage.get(self.key())
+            self.pending_dependencies = current.pending_dependencies
+            self.ready = current.ready
+
+    def get_outcomes(self):
+        """
+        Get the outcomes of listeners on this message as a dict.
+        """
+        outcomes = {}
+        for entry in self.listener_outcomes:
+            outcome, name = entry.split(':', 1)
+            outcomes[name] = outcome
+        return outcomes
+
+    def set_outcomes(self, outcomes):
+        """
+        Set the outcomes of listeners on this message from a dict.
+        """
+        self.listener_outcomes = [ 
+            '%s:%s' % (outcome, name) for name, outcome in outcomes.items() 
+        ]
+
+    def update_ready(self):
+        """
+        Work out whether the message belongs in the ready set.
+        """
+        self.ready = not (self.reserved_at or self.finished_at or 
+            self.dead_at or self.pending_dependencies or self.timer_at)
 
     def _make_signature(self):
         """
@@ -214,16 +1876,136 @@ class QueuedMessage(db.Model):
         """
         Save the message, updating signature and anything else necessary.
         """
-        self.signature = self._make_signature()
+        self.prepare_put()
         db.Model.put(self)
 
+    def schedule(self, scheduled_for=None):
+        """
+        Schedule the message for a given time, defaulting to now, starting
+        a timer if that's still to come.
+        """
+        now = datetime.datetime.now()
+        self.scheduled_for = scheduled_for or now
+        self.timer_at = self.scheduled_for > now and self.scheduled_for or None
+
+    def prepare_put(self):
+        """
+        Update signature and anything else necessary ahead of saving, for
+        when the message is saved in a batch with db.put().
+        """
+        if self.scheduled_for is None: self.schedule()
+        self.signature = self._make_signature()
+
 class QueuedMessageDependency(db.Model):
     """
     Depencency link between two Messages
     """
-    # TODO: Do not allow circular dependencies
+    # MessageQueue.put_group() rejects circular dependencies up front, but
+    # nothing stops add_dependency() from closing a loop between existing
+    # Messages.
     preceding_message = db.ReferenceProperty(QueuedMessage, 
         collection_name='preceding_message')
     dependent_message = db.ReferenceProperty(QueuedMessage, 
         collection_name='dependent_message')
 
+class QueuedMessageSignature(db.Model):
+    """
+    Record of the signature of an unfinished Message put without duplicates
+    allowed, keyed by the signature so that duplicates can be spotted without
+    a query.
+    """
+    created_at = db.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def key_name_for(cls, signature):
+        """
+        Build a key name from a signature, which can't start with a digit.
+        """
+        return 'sig-%s' % signature
+
+    @classmethod
+    def release(cls, messages):
+        """
+        Delete the signatures claimed by Messages put without duplicates
+        allowed, along with what memcache knows of them.
+        """
+        cls.delete_claims([ 
+            db.Key.from_path(cls.kind(), cls.key_name_for(m.signature))
+            for m in messages if m.unique
+        ])
+
+    @classmethod
+    def delete_claims(cls, keys):
+        """
+        Delete signatures by key, along with what memcache knows of them.
+        """
+        if not keys: return
+        db.delete(keys)
+        memcache.delete_multi([ MessageQueue.SIGNATURE_KEY % 
+            key.name()[len(cls.key_name_for('')):] for key in keys ])
+
+class QueuedMessageSummary(db.Model):
+    """
+    Compact record of the Messages with a subject finished, or declared dead,
+    on a given day, left behind when the Messages themselves are compacted.
+    """
+    subject           = db.StringProperty(required=True)
+    day               = db.DateProperty(required=True)
+    count             = db.IntegerProperty(default=0)
+    dead              = db.IntegerProperty(default=0)
+    attempts          = db.IntegerProperty(default=0)
+    wait_seconds      = db.FloatProperty(default=0.0)
+    first_finished_at = db.DateTimeProperty(default=None)
+    last_finished_at  = db.DateTimeProperty(default=None)
+
+    @classmethod
+    def key_name_for(cls, subject, day):
+        """
+        Build a key name from a subject and day.
+        """
+        return 'summary-%s-%s' % (md5.new(subject).hexdigest(), 
+            day.strftime('%Y%m%d'))
+
+    @classmethod
+    def archive(cls, messages):
+        """
+        Fold a list of finished and dead Messages into their summaries,
+        fetching and saving all the summaries involved in one batch each.
+        """
+        groups = {}
+        for message in messages:
+            day = (message.finished_at or message.dead_at).date()
+            key_name = cls.key_name_for(message.subject, day)
+            groups.setdefault(key_name, (message.subject, day, []))[2]\
+                .append(message)
+
+        key_names = groups.keys()
+        summaries = cls.get_by_key_name(key_names)
+        for i in range(len(key_names)):
+            subject, day, grouped = groups[key_names[i]]
+            summary = summaries[i] or cls(key_name=key_names[i], 
+                subject=subject, day=day)
+            for message in grouped:
+                summary.add(message)
+            summaries[i] = summary
+
+        db.put(summaries)
+        return summaries
+
+    def add(self, message):
+        """
+        Count a finished or dead Message in this summary.
+        """
+        if not message.finished_at:
+            self.dead = self.dead + 1
+            return
+        self.count = self.count + 1
+        self.attempts = self.attempts + message.attempts
+        self.wait_seconds = self.wait_seconds + \
+            _total_seconds(message.finished_at - message.created_at)
+        if not self.first_finished_at or \
+                message.finished_at < self.first_finished_at:
+            self.first_finished_at = message.finished_at
+        if not self.last_finished_at or \
+                message.finished_at > self.last_finished_at:
+            self.last_finished_at = message.finished_at
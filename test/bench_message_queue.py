@@ -0,0 +1,354 @@
+"""
+Message queue benchmarks
+
+Measures put, reserve, process, and finish throughput and latency for
+MessageQueue across a sweep of queue depths, dependency fan-in, ratios of
+future-scheduled messages, worker concurrency, and shard counts, writing the
+results as JSON.  Workers reserve under the shard locks, or with --optimistic
+claim messages in transactions instead; on the local backend,
+--conflict-rate makes those transactions conflict to show the cost of
+retrying them.  Given results from an earlier run as a baseline, exits with
+an error when any throughput has dropped by more than a tolerance.
+
+Each scenario fills the queue to the given depth, then has its workers
+process a sample of the ready messages, so reservation cost is measured
+against a queue that's still deep.
+
+    python bench_message_queue.py --depth 1000 --depth 10000 -o bench.json
+    python bench_message_queue.py --baseline bench.json
+    python bench_message_queue.py --optimistic --concurrency 1 \\
+        --concurrency 4 --concurrency 8 --conflict-rate 0.1
+"""
+# Find library locations relative to this file.
+import sys, os
+base_dir = os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) )
+sys.path.extend([ os.path.join(base_dir, d) for d in
+    ( 'lib', 'extlib' )
+])
+
+import logging, datetime, time, threading, optparse
+import simplejson
+import messagequeue, backend
+
+from backend import db, memcache
+
+# Default sweep, each list varied in turn with the others at their first.
+DEPTHS           = [ 1000, 10000 ]
+FAN_INS          = [ 0, 4 ]
+SCHEDULED_RATIOS = [ 0.0, 0.5 ]
+CONCURRENCIES    = [ 1, 4 ]
+SHARDS           = [ 1, 4 ]
+
+# How many messages to process per scenario, and how many to reserve at a
+# time while doing so.
+SAMPLE     = 500
+BATCH_SIZE = 10
+
+# Share of throughput a scenario may lose against a baseline before it's
+# counted as a regression.
+TOLERANCE = 0.2
+
+class TimedMessageQueue(messagequeue.MessageQueue):
+    """
+    MessageQueue recording how long each reservation and finish takes.
+    """
+    def __init__(self, timings, **kwargs):
+        messagequeue.MessageQueue.__init__(self, **kwargs)
+        self.timings = timings
+
+    def reserve_many(self, count):
+        start = time.time()
+        messages = messagequeue.MessageQueue.reserve_many(self, count)
+        self.timings.record('reserve', time.time() - start, len(messages))
+        return messages
+
+    def finish(self, message):
+        start = time.time()
+        messagequeue.MessageQueue.finish(self, message)
+        self.timings.record('finish', time.time() - start)
+
+class Timings:
+    """
+    Latencies per operation, safe to record into from several workers.
+    """
+    def __init__(self):
+        self.latencies = {}
+        self.counts    = {}
+        self.elapsed   = {}
+        self._lock     = threading.Lock()
+
+    def record(self, operation, seconds, count=1):
+        """
+        Record how long one call of an operation took, and how many messages
+        it handled.
+        """
+        self._lock.acquire()
+        try:
+            self.latencies.setdefault(operation, []).append(seconds)
+            self.counts[operation] = self.counts.get(operation, 0) + count
+        finally:
+            self._lock.release()
+
+    def summary(self, operation, elapsed):
+        """
+        Summarize an operation as messages per second of wall time along
+        with percentiles of its latency in milliseconds.
+        """
+        latencies = list(self.latencies.get(operation, []))
+        latencies.sort()
+        count = self.counts.get(operation, 0)
+        return {
+            'count': count,
+            'calls': len(latencies),
+            'seconds': elapsed,
+            'per_second': elapsed and count / elapsed or 0.0,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'max_ms': (latencies and latencies[-1] or 0.0) * 1000
+        }
+
+def percentile(values, fraction):
+    """
+    Pick the value at a fraction of the way through a sorted list.
+    """
+    if not values: return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def reset():
+    """
+    Start from an empty datastore and cache.
+    """
+    if backend.BACKEND == 'local':
+        db.reset()
+    else:
+        messagequeue.MessageQueue().flush_all()
+    memcache.flush_all()
+
+def fill(queue, timings, depth, fan_in, scheduled_ratio):
+    """
+    Put depth messages into the queue.  With fan_in, every message after
+    each run of fan_in messages depends on that run.  scheduled_ratio of
+    the messages, spread evenly, are scheduled an hour out.
+    """
+    later = datetime.datetime.now() + datetime.timedelta(hours=1)
+    run = []
+    scheduled = 0.0
+    for i in range(depth):
+        scheduled = scheduled + scheduled_ratio
+        scheduled_for = None
+        if scheduled >= 1:
+            scheduled, scheduled_for = scheduled - 1, later
+
+        dependencies = None
+        if fan_in and len(run) == fan_in:
+            dependencies, run = run, []
+
+        start = time.time()
+        message = queue.put(subject='/bench/%s' % (i % 10),
+            body='benchmark message %s' % i, scheduled_for=scheduled_for,
+            dependencies=dependencies)
+        timings.record('put', time.time() - start)
+
+        if fan_in and dependencies is None and scheduled_for is None:
+            run.append(message)
+
+def drain(queues, timings, sample, batch_size):
+    """
+    Have a worker thread per queue process batches of messages until the
+    sample has been processed between them or the queue runs dry.
+    """
+    state = { 'processed': 0 }
+    lock = threading.Lock()
+
+    def work(queue):
+        while True:
+            lock.acquire()
+            try:
+                wanted = min(batch_size, sample - state['processed'])
+                state['processed'] = state['processed'] + max(0, wanted)
+            finally:
+                lock.release()
+            if wanted <= 0: break
+
+            messages = queue.reserve_many(wanted)
+            for message in messages:
+                start = time.time()
+                queue._dispatch(message)
+                timings.record('process', time.time() - start)
+
+            if len(messages) < wanted: break
+
+    threads = [ threading.Thread(target=work, args=(q,)) for q in queues ]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+def listener(message):
+    """
+    Listener that accepts every message and does nothing with it.
+    """
+    pass
+
+def run_scenario(depth, fan_in, scheduled_ratio, concurrency, shards=1,
+        optimistic=False, sample=SAMPLE, batch_size=BATCH_SIZE):
+    """
+    Run one scenario on an empty queue, returning its parameters along with
+    a summary of each operation.
+    """
+    reset()
+    timings = Timings()
+    queues = []
+    for i in range(concurrency):
+        queue = TimedMessageQueue(timings, shard_count=shards,
+            optimistic=optimistic)
+        queue.add_listener('/bench/#', listener)
+        queues.append(queue)
+
+    start = time.time()
+    fill(queues[0], timings, depth, fan_in, scheduled_ratio)
+    fill_seconds = time.time() - start
+
+    start = time.time()
+    drain(queues, timings, sample, batch_size)
+    drain_seconds = time.time() - start
+
+    return {
+        'name': scenario_name(depth, fan_in, scheduled_ratio, concurrency,
+            shards, optimistic),
+        'depth': depth,
+        'fan_in': fan_in,
+        'scheduled_ratio': scheduled_ratio,
+        'concurrency': concurrency,
+        'shards': shards,
+        'optimistic': optimistic,
+        'sample': sample,
+        'batch_size': batch_size,
+        'put': timings.summary('put', fill_seconds),
+        'reserve': timings.summary('reserve', drain_seconds),
+        'process': timings.summary('process', drain_seconds),
+        'finish': timings.summary('finish', drain_seconds)
+    }
+
+def scenario_name(depth, fan_in, scheduled_ratio, concurrency, shards=1,
+        optimistic=False):
+    # Defaults are left out, to keep names comparable with older results.
+    name = 'depth=%s fan_in=%s scheduled=%s concurrency=%s' % (
+        depth, fan_in, scheduled_ratio, concurrency)
+    if shards != 1: name = name + ' shards=%s' % shards
+    if optimistic: name = name + ' optimistic'
+    return name
+
+def scenarios(depths, fan_ins, scheduled_ratios, concurrencies, shards):
+    """
+    List the scenarios in a sweep: each parameter varied in turn, with the
+    rest held at their first value.  Concurrencies are also run at every
+    shard count, to show how throughput scales with both.
+    """
+    base = (depths[0], fan_ins[0], scheduled_ratios[0], concurrencies[0],
+        shards[0])
+    sweep = [ base ]
+    for position, values in enumerate(
+            [ depths, fan_ins, scheduled_ratios, concurrencies, shards ]):
+        for value in values[1:]:
+            scenario = list(base)
+            scenario[position] = value
+            if tuple(scenario) not in sweep: sweep.append(tuple(scenario))
+    for concurrency in concurrencies[1:]:
+        for shard_count in shards[1:]:
+            scenario = base[:3] + (concurrency, shard_count)
+            if scenario not in sweep: sweep.append(scenario)
+    return sweep
+
+def regressions(results, baseline, tolerance=TOLERANCE):
+    """
+    Compare results against a baseline run, listing a message for each
+    operation whose throughput dropped by more than tolerance.
+    """
+    previous = dict([ (r['name'], r) for r in baseline['results'] ])
+    found = []
+    for result in results['results']:
+        before = previous.get(result['name'])
+        if not before: continue
+        for operation in ('put', 'reserve', 'process', 'finish'):
+            was = before[operation]['per_second']
+            now = result[operation]['per_second']
+            if was and now < was * (1 - tolerance):
+                found.append('%s: %s fell from %.1f to %.1f per second' %
+                    (result['name'], operation, was, now))
+    return found
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--depth', type='int', action='append',
+        help='queue depth to test, repeatable (default %s)' % DEPTHS)
+    parser.add_option('--fan-in', type='int', action='append',
+        help='dependencies per dependent message, repeatable '
+            '(default %s)' % FAN_INS)
+    parser.add_option('--scheduled-ratio', type='float', action='append',
+        help='share of messages scheduled in the future, repeatable '
+            '(default %s)' % SCHEDULED_RATIOS)
+    parser.add_option('--concurrency', type='int', action='append',
+        help='worker threads, repeatable (default %s)' % CONCURRENCIES)
+    parser.add_option('--shards', type='int', action='append',
+        help='shards to spread messages across, repeatable '
+            '(default %s)' % SHARDS)
+    parser.add_option('--optimistic', action='store_true', default=False,
+        help='reserve by claiming messages in transactions, without locks')
+    parser.add_option('--conflict-rate', type='float', default=0.0,
+        help='chance of each transaction conflicting and being retried, '
+            'on the local backend only (default %default)')
+    parser.add_option('--sample', type='int', default=SAMPLE,
+        help='messages to process per scenario (default %default)')
+    parser.add_option('--batch-size', type='int', default=BATCH_SIZE,
+        help='messages to reserve at a time (default %default)')
+    parser.add_option('-o', '--output',
+        help='file to write JSON results to, instead of stdout')
+    parser.add_option('--baseline',
+        help='JSON results of an earlier run to check for regressions')
+    parser.add_option('--tolerance', type='float', default=TOLERANCE,
+        help='share of throughput that may be lost against the baseline '
+            '(default %default)')
+    options, args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if options.conflict_rate:
+        if backend.BACKEND != 'local':
+            parser.error('--conflict-rate needs the local backend')
+        db.set_conflict_rate(options.conflict_rate, seed=0)
+
+    results = {
+        'backend': backend.BACKEND,
+        'started_at': datetime.datetime.now().isoformat(),
+        'results': []
+    }
+    for depth, fan_in, scheduled_ratio, concurrency, shards in scenarios(
+            options.depth or DEPTHS, options.fan_in or FAN_INS,
+            options.scheduled_ratio or SCHEDULED_RATIOS,
+            options.concurrency or CONCURRENCIES, options.shards or SHARDS):
+        result = run_scenario(depth, fan_in, scheduled_ratio, concurrency,
+            shards, options.optimistic, options.sample, options.batch_size)
+        results['results'].append(result)
+        sys.stderr.write('%s: %.1f puts/s, %.1f processed/s, '
+            'reserve p99 %.1fms\n' % (result['name'],
+                result['put']['per_second'], result['process']['per_second'],
+                result['reserve']['p99_ms']))
+
+    output = simplejson.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        out = open(options.output, 'w')
+        try:
+            out.write(output)
+        finally:
+            out.close()
+    else:
+        print output
+
+    if options.baseline:
+        baseline = simplejson.load(open(options.baseline))
+        found = regressions(results, baseline, options.tolerance)
+        for regression in found:
+            sys.stderr.write('Regression: %s\n' % regression)
+        if found: return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
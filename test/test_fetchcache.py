@@ -0,0 +1,361 @@
+"""
+Fetch cache tests
+"""
+# Find library locations relative to this file.
+import sys, os
+base_dir = os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) )
+sys.path.extend([ os.path.join(base_dir, d) for d in
+    ( 'lib', 'extlib', 'controllers' )
+])
+
+import unittest, logging, time, threading
+
+from backend import memcache, urlfetch
+from feedmagick import fetchcache
+import main
+
+class TestFetchCache(unittest.TestCase):
+
+    def setUp(self):
+        self.log = logging.getLogger()
+        self.log.setLevel(logging.DEBUG)
+        urlfetch.reset()
+        memcache.flush_all()
+        fetchcache.local_cache.clear()
+        self.refresh_wait = fetchcache.REFRESH_WAIT_SECONDS
+
+    def tearDown(self):
+        urlfetch.reset()
+        memcache.flush_all()
+        fetchcache.local_cache.clear()
+        fetchcache.REFRESH_WAIT_SECONDS = self.refresh_wait
+
+    def test_request_fingerprint(self):
+        """
+        Make sure fetches that can't differ share a fingerprint, and that
+        those that can don't.
+        """
+        fingerprint = fetchcache.request_fingerprint
+        url = 'http://example.com/feed?a=1'
+        base = fingerprint(url)
+
+        # Equivalent URLs, header names and order, and headers that only
+        # concern the cache or the connection.
+        self.assertEqual(base, fingerprint('HTTP://Example.COM:80/feed?a=1'))
+        self.assertEqual(base, fingerprint(url + '#top'))
+        self.assertEqual(fingerprint('http://example.com'),
+            fingerprint('http://example.com/'))
+        self.assertEqual(base, fingerprint(url, method='get'))
+        self.assertEqual(base, fingerprint(url, headers={
+            'If-None-Match': '"abc"', 'Cache-Control': 'no-cache' }))
+        self.assertEqual(
+            fingerprint(url, headers={ 'Accept': 'a', 'User-Agent': 'b' }),
+            fingerprint(url, headers={ 'user-agent': 'b ', 'ACCEPT': 'a' }))
+
+        # Anything that can change the result.
+        different = [
+            fingerprint('http://example.com/feed?a=2'),
+            fingerprint('https://example.com/feed?a=1'),
+            fingerprint(url, method='POST'),
+            fingerprint(url, method='POST', payload='x=1'),
+            fingerprint(url, method='POST', payload='x=2'),
+            fingerprint(url, headers={ 'Accept': 'application/atom+xml' }),
+            fingerprint(url, headers={ 'Cookie': 'session=1' }),
+            fingerprint(url, allow_truncated=True),
+            fingerprint(url, follow_redirects=False)
+        ]
+        self.assertEqual(len(dict.fromkeys([ base ] + different)),
+            len(different) + 1)
+
+    def test_urlfetch_cached_keys(self):
+        """
+        Make sure fetches differing by method, payload, or headers are cached
+        apart, and long URLs still make valid memcache keys.
+        """
+        url = 'http://example.com/feed'
+        def respond(url, payload, method, headers):
+            return urlfetch._URLFetchResult('%s %s %s' % (method, payload,
+                headers.get('Accept')), 200, {}, False, url)
+        urlfetch.register(url, handler=respond)
+
+        handler = main.MainHandler()
+        fetches = [
+            {},
+            { 'method': 'POST', 'payload': 'x=1' },
+            { 'method': 'POST', 'payload': 'x=2' },
+            { 'headers': { 'Accept': 'text/xml' } }
+        ]
+        expected = [ 'GET None None', 'POST x=1 None', 'POST x=2 None',
+            'GET None text/xml' ]
+        for i in range(2):
+            results = [ handler.urlfetch_cached(url, **kw) for kw in fetches ]
+            self.assertEqual([ r['content'] for r in results ], expected)
+            self.assertEqual([ r['cache_hit'] for r in results ], [ i == 1 ] * 4)
+        self.assertEqual(len(urlfetch.requests), 4)
+
+        long_url = 'http://example.com/' + 'x' * 500
+        self.assert_(len(handler.urlfetch_cache_key(long_url)) < 250)
+
+    def test_lru_cache(self):
+        """
+        Make sure the LRU cache stays within its size, dropping the least
+        recently used values first, and expires values past their time.
+        """
+        cache = fetchcache.LRUCache(max_bytes=100, ttl=None)
+        cache.set('a', 'A', 40)
+        cache.set('b', 'B', 40)
+        self.assertEqual(cache.get('a'), 'A')
+
+        # Making room for c drops b, since a was used more recently.
+        cache.set('c', 'C', 40)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertEqual(cache.get('c'), 'C')
+        self.assertEqual(cache.bytes, 80)
+
+        # Replacing a value swaps its size, and values too big are refused.
+        cache.set('a', 'AA', 70)
+        self.assertEqual(cache.bytes, 70)
+        self.assertEqual(cache.get('c'), None)
+        self.assertEqual(cache.set('d', 'D', 101), False)
+
+        cache.set('e', 'E', 10, ttl=0.05)
+        self.assertEqual(cache.get('e'), 'E')
+        time.sleep(0.06)
+        self.assertEqual(cache.get('e'), None)
+
+        self.assertEqual(cache.stats(), { 'hits': 4, 'misses': 3,
+            'evictions': 2, 'expirations': 1, 'items': 1, 'bytes': 70 })
+
+    def test_urlfetch_cached_locally(self):
+        """
+        Make sure repeat lookups are served from this process without going
+        to memcache, and that memcache still backs the local cache.
+        """
+        url = 'http://example.com/feed'
+        urlfetch.register(url, content='feed')
+        handler = main.MainHandler()
+
+        self.assertEqual(handler.urlfetch_cached(url)['cache_hit'], False)
+        memcache.flush_all()
+        self.assertEqual(handler.urlfetch_cached(url)['cache_hit'], True)
+        self.assertEqual(fetchcache.local_cache.hits, 1)
+
+        # With both copies gone it's fetched again, and then with only this
+        # process's copy gone, memcache still has it.
+        fetchcache.local_cache.clear()
+        self.assertEqual(handler.urlfetch_cached(url)['cache_hit'], False)
+        fetchcache.local_cache.clear()
+        result = handler.urlfetch_cached(url)
+        self.assertEqual((result['cache_hit'], result['content']),
+            (True, 'feed'))
+        self.assertEqual(fetchcache.local_cache.hits, 0)
+        self.assertEqual(len(urlfetch.requests), 2)
+
+    def test_urlfetch_cached_locally_stale(self):
+        """
+        Make sure a copy in this process that's no longer fresh gives way to
+        a fresher one in memcache, refreshed by another instance, rather
+        than being fetched again.
+        """
+        url = 'http://example.com/feed'
+        urlfetch.register(url, content='feed')
+        handler = main.MainHandler()
+        cache_key = handler.urlfetch_cache_key(url)
+
+        handler.urlfetch_cached(url)
+        stale = fetchcache.local_cache.get(cache_key)
+        stale['cache_time'] = stale['cache_time'] - 60
+        fetchcache.local_cache.set(cache_key, stale, 
+            fetchcache.result_size(stale))
+
+        result = handler.urlfetch_cached(url, cache_max_age=30)
+        self.assertEqual((result['cache_hit'], result['content']),
+            (True, 'feed'))
+        self.assertEqual(len(urlfetch.requests), 1)
+        self.assert_(handler.urlfetch_cache_fresh(
+            fetchcache.local_cache.get(cache_key), 30))
+
+        # With nothing fresher in memcache, it's fetched as before.
+        memcache.flush_all()
+        fetchcache.local_cache.set(cache_key, stale, 
+            fetchcache.result_size(stale))
+        handler.urlfetch_cached(url, cache_max_age=30, stale_max_age=0)
+        self.assertEqual(len(urlfetch.requests), 2)
+
+    def test_record_format(self):
+        """
+        Make sure results survive packing into a record, come out well
+        compressed, and that records cut short or from another version
+        aren't mistaken for results.
+        """
+        result = {
+            'content': '<rss><item>feed</item></rss>\n' * 1000,
+            'status_code': 200,
+            'headers': { 'Etag': '"abc"', 'Last-Modified': 'Sat, 01 Jan 2000',
+                'Content-Type': 'application/rss+xml' },
+            'content_was_truncated': False,
+            'cache_time': 1234567890.5
+        }
+        record = fetchcache.pack_result(result)
+        self.assert_(len(record) * 10 < len(result['content']))
+        self.assertEqual(fetchcache.record_length(record), len(record))
+
+        # The ETag comes back under the name the conditional fetch looks for.
+        unpacked = fetchcache.unpack_result(record)
+        self.assertEqual(unpacked['headers'], { 'ETag': '"abc"', 
+            'Last-Modified': 'Sat, 01 Jan 2000',
+            'Content-Type': 'application/rss+xml' })
+        del unpacked['headers'], result['headers']
+        self.assertEqual(unpacked, result)
+
+        for bad in (record[:-1], record[:10], 'FMC\x00' + record[4:],
+                record[:-5] + 'xxxxx'):
+            self.assertRaises(fetchcache.BadRecord, 
+                fetchcache.unpack_result, bad)
+
+    def test_big_feed_cached(self):
+        """
+        Make sure a feed too big for one memcache value is cached in chunks,
+        and that losing any chunk makes it a miss rather than a bad result.
+        """
+        url = 'http://example.com/big'
+        # Random content doesn't compress, so this can't fit in one value.
+        content = os.urandom(1000 * 1000)
+        urlfetch.register(url, content=content)
+        handler = main.MainHandler()
+
+        self.assertEqual(handler.urlfetch_cached(url)['cache_hit'], False)
+        fetchcache.local_cache.clear()
+        result = handler.urlfetch_cached(url)
+        self.assertEqual(result['cache_hit'], True)
+        self.assert_(result['content'] == content)
+        self.assertEqual(len(urlfetch.requests), 1)
+
+        cache_key = handler.urlfetch_cache_key(url)
+        self.assertEqual(len(fetchcache.cache_get_multi([ cache_key ])), 1)
+        self.assert_(memcache.get(cache_key + ':1'))
+        memcache.delete(cache_key + ':1')
+        self.assertEqual(fetchcache.cache_get_multi([ cache_key ]), {})
+
+    def test_stale_while_revalidate(self):
+        """
+        Make sure stale results are served as is while another caller holds
+        the refresh, and that only the caller holding it fetches.
+        """
+        url = 'http://example.com/feed'
+        urlfetch.register(url, content='feed', headers={ 'ETag': '"1"' })
+        handler = main.MainHandler()
+        cache_key = handler.urlfetch_cache_key(url)
+
+        self.assertEqual(handler.urlfetch_cached(url)['cache_hit'], False)
+
+        # Someone else is refreshing, so the stale result will do.
+        self.assert_(fetchcache.acquire_refresh(cache_key))
+        result = handler.urlfetch_cached(url, cache_max_age=0)
+        self.assertEqual((result['cache_hit'], result['cache_stale'],
+            result['content']), (True, True, 'feed'))
+        self.assertEqual(len(urlfetch.requests), 1)
+
+        # Unless it's too stale to serve at all, in which case it's waited
+        # for rather than fetched again.
+        fetchcache.REFRESH_WAIT_SECONDS = 0.2
+        self.assertRaises(fetchcache.FetchInProgress, handler.urlfetch_cached,
+            url, cache_max_age=0, stale_max_age=0)
+        self.assertEqual(len(urlfetch.requests), 1)
+
+        # Once they're done, this caller refreshes, and a not modified
+        # answer makes the cached result fresh again.
+        fetchcache.release_refresh(cache_key)
+        cache_time = handler.urlfetch_cache_lookup(
+            [ cache_key ])[cache_key]['cache_time']
+        time.sleep(0.01)
+        result = handler.urlfetch_cached(url, cache_max_age=0)
+        self.assertEqual('cache_stale' in result, False)
+        self.assertEqual(len(urlfetch.requests), 2)
+        self.assertEqual(urlfetch.requests[-1][2]['If-None-Match'], '"1"')
+        self.assert_(handler.urlfetch_cache_lookup(
+            [ cache_key ])[cache_key]['cache_time'] > cache_time)
+        self.assert_(fetchcache.acquire_refresh(cache_key))
+
+    def test_cold_fetches_across_processes(self):
+        """
+        Make sure callers sharing nothing in process, as on separate
+        instances, fetch an uncached URL once between them, the rest waiting
+        for it to turn up in memcache.  Callers left waiting on a fetch that
+        never lands give up without fetching, unless it's let go of, in
+        which case one of them takes it over.
+        """
+        url, other = 'http://example.com/feed', 'http://example.com/other'
+        def respond(url, payload, method, headers):
+            time.sleep(0.1)
+            return urlfetch._URLFetchResult('feed', 200, {}, False, url)
+        urlfetch.register(url, handler=respond)
+        urlfetch.register(other, content='other')
+
+        class Alone:
+            def run(self, key, func, *args):
+                return func(*args)
+        in_flight = main.fetches_in_flight
+        main.fetches_in_flight = Alone()
+        try:
+            results = []
+            def fetch():
+                fetchcache.local_cache.clear()
+                results.append(main.MainHandler().urlfetch_cached(url))
+            threads = [ threading.Thread(target=fetch) for i in range(8) ]
+            for thread in threads: thread.start()
+            for thread in threads: thread.join()
+        finally:
+            main.fetches_in_flight = in_flight
+        self.assertEqual([ r['content'] for r in results ], [ 'feed' ] * 8)
+        self.assertEqual(len(urlfetch.requests), 1)
+
+        # Another caller holds the fetch of other and never finishes it.
+        handler = main.MainHandler()
+        other_key = handler.urlfetch_cache_key(other)
+        self.assert_(fetchcache.acquire_refresh(other_key))
+        fetchcache.REFRESH_WAIT_SECONDS = 0.2
+        results, errors = handler.urlfetch_cached_many([ url, other ])
+        self.assertEqual(results.keys(), [ url ])
+        self.assert_(isinstance(errors[other], fetchcache.FetchInProgress))
+        self.assertEqual(len(urlfetch.requests), 1)
+
+        # Once it's let go of, waiting callers take it over.
+        threading.Timer(0.05, fetchcache.release_refresh, 
+            [ other_key ]).start()
+        fetchcache.REFRESH_WAIT_SECONDS = 1
+        results, errors = handler.urlfetch_cached_many([ other ])
+        self.assertEqual((results[other]['content'], errors), ('other', {}))
+        self.assertEqual(len(urlfetch.requests), 2)
+
+    def test_coalesced_fetches(self):
+        """
+        Make sure concurrent callers after the same uncached URL share one
+        fetch, and that once it's cached but stale only one of them
+        refreshes it while the rest are served the stale result.
+        """
+        url = 'http://example.com/feed'
+        def respond(url, payload, method, headers):
+            time.sleep(0.1)
+            return urlfetch._URLFetchResult('feed', 200, {}, False, url)
+        urlfetch.register(url, handler=respond)
+
+        def fetch_all(count, **kw):
+            results = []
+            def fetch():
+                results.append(main.MainHandler().urlfetch_cached(url, **kw))
+            threads = [ threading.Thread(target=fetch) for i in range(count) ]
+            for thread in threads: thread.start()
+            for thread in threads: thread.join()
+            return results
+
+        results = fetch_all(8)
+        self.assertEqual([ r['content'] for r in results ], [ 'feed' ] * 8)
+        self.assertEqual(len(urlfetch.requests), 1)
+
+        results = fetch_all(8, cache_max_age=0)
+        self.assertEqual([ r['content'] for r in results ], [ 'feed' ] * 8)
+        self.assertEqual(len([ r for r in results if r.get('cache_stale') ]),
+            7)
+        self.assertEqual(len(urlfetch.requests), 2)
@@ -0,0 +1,126 @@
+"""
+Feed fetcher tests
+"""
+# Find library locations relative to this file.
+import sys, os
+base_dir = os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) )
+sys.path.extend([ os.path.join(base_dir, d) for d in
+    ( 'lib', 'extlib', 'controllers' )
+])
+
+import unittest, logging, time, threading
+
+from backend import memcache, urlfetch
+from feedmagick.fetcher import FeedFetcher
+from feedmagick import fetchcache
+import main
+
+class TestFeedFetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.log = logging.getLogger()
+        self.log.setLevel(logging.DEBUG)
+        urlfetch.reset()
+        memcache.flush_all()
+        fetchcache.local_cache.clear()
+
+    def tearDown(self):
+        urlfetch.reset()
+        memcache.flush_all()
+        fetchcache.local_cache.clear()
+
+    def register_slow(self, urls, delay):
+        """
+        Register URLs that take a while to answer, keeping track of the most
+        fetches in flight at once overall and per host.
+        """
+        lock = threading.Lock()
+        state = { 'total': 0, 'hosts': {}, 'max_total': 0, 'max_host': 0 }
+
+        def handler(url, payload, method, headers):
+            host = url.split('/')[2]
+            lock.acquire()
+            try:
+                state['total'] = state['total'] + 1
+                state['hosts'][host] = state['hosts'].get(host, 0) + 1
+                state['max_total'] = max(state['max_total'], state['total'])
+                state['max_host'] = max(state['max_host'],
+                    state['hosts'][host])
+            finally:
+                lock.release()
+            time.sleep(delay)
+            lock.acquire()
+            try:
+                state['total'] = state['total'] - 1
+                state['hosts'][host] = state['hosts'][host] - 1
+            finally:
+                lock.release()
+            return urlfetch._URLFetchResult('feed at %s' % url, 200, {},
+                False, url)
+
+        for url in urls:
+            urlfetch.register(url, handler=handler)
+        return state
+
+    def test_fetch_all(self):
+        """
+        Fetch a batch of slow URLs across a few hosts, and make sure they're
+        fetched concurrently within the overall and per host limits.
+        """
+        urls = [ 'http://feeds%s.example.com/%s' % (i % 4, i)
+            for i in range(24) ]
+        state = self.register_slow(urls, 0.1)
+
+        fetcher = FeedFetcher(max_in_flight=6, per_host=2)
+        start = time.time()
+        results, errors = fetcher.fetch_all(urls + urls[:3])
+        elapsed = time.time() - start
+
+        self.assertEqual(errors, {})
+        self.assertEqual(len(results), 24)
+        self.assertEqual(results[urls[5]].content, 'feed at %s' % urls[5])
+        self.assertEqual(len(urlfetch.requests), 24)
+        self.assertEqual(state['max_total'], 6)
+        self.assertEqual(state['max_host'], 2)
+
+        # Four rounds of six, rather than 24 fetches one after another.
+        self.assert_(elapsed < 1.0)
+
+    def test_fetch_errors_and_deadline(self):
+        """
+        Make sure failed fetches are reported as errors, and that fetches not
+        started before the deadline are left out.
+        """
+        urls = [ 'http://slow.example.com/%s' % i for i in range(6) ]
+        self.register_slow(urls, 0.2)
+
+        fetcher = FeedFetcher(max_in_flight=2, per_host=2, deadline=0.3)
+        results, errors = fetcher.fetch_all(
+            [ 'http://missing.example.com/' ] + urls)
+
+        self.assertEqual(errors.keys(), [ 'http://missing.example.com/' ])
+        self.assert_(isinstance(errors['http://missing.example.com/'],
+            urlfetch.DownloadError))
+        self.assert_(0 < len(results) < len(urls))
+
+    def test_urlfetch_cached_many(self):
+        """
+        Fetch feeds through the cache all at once, and make sure the second
+        time around they're served from the cache without going upstream.
+        """
+        urls = [ 'http://feeds.example.com/%s' % i for i in range(3) ]
+        for url in urls:
+            urlfetch.register(url, content='feed at %s' % url)
+
+        handler = main.MainHandler()
+        results, errors = handler.urlfetch_cached_many(urls)
+        self.assertEqual(errors, {})
+        self.assertEqual([ results[url]['cache_hit'] for url in urls ],
+            [ False, False, False ])
+        self.assertEqual(results[urls[1]]['content'],
+            'feed at %s' % urls[1])
+
+        results, errors = handler.urlfetch_cached_many(urls)
+        self.assertEqual([ results[url]['cache_hit'] for url in urls ],
+            [ True, True, True ])
+        self.assertEqual(len(urlfetch.requests), 3)
@@ -1,11 +1,17 @@
 """
 Message queue tests
 """
-import unittest, logging, datetime, time
+# Find library locations relative to this file.
+import sys, os
+base_dir = os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) )
+sys.path.extend([ os.path.join(base_dir, d) for d in 
+    ( 'lib', 'extlib' ) 
+])
+
+import unittest, logging, datetime, time, random, threading
 import messagequeue
 
-from google.appengine.ext import db
-from google.appengine.api import memcache
+from backend import db, memcache, webapp
 
 class TestMessageQueue(unittest.TestCase):
 
@@ -20,6 +26,7 @@ class TestMessageQueue(unittest.TestCase):
 
     def tearDown(self):
         memcache.flush_all()
+        db.set_conflict_rate(0.0)
 
     def test_memcache_mutex(self):
         """Try out a memcache-based mutex"""
@@ -51,6 +58,161 @@ class TestMessageQueue(unittest.TestCase):
         # There should be no more messages to reserve
         self.assert_(self.queue.reserve() is None)
 
+    def test_reserve_many(self):
+        """
+        Reserve messages in batches and make sure they come out in order,
+        each reserved exactly once.
+        """
+        subject = '/tests/message/batch'
+        bodies  = []
+        for i in range(7):
+            body = 'sample body %s' % i
+            bodies.append(body)
+            self.queue.put(subject=subject, body=body)
+
+        first = self.queue.reserve_many(5)
+        self.assertEqual([ m.body for m in first ], bodies[:5])
+        self.assert_(not [ m for m in first if m.reserved_at is None ])
+
+        rest = self.queue.reserve_many(5)
+        self.assertEqual([ m.body for m in rest ], bodies[5:])
+        self.assertEqual(self.queue.reserve_many(5), [])
+
+    def test_optimistic_reserve(self):
+        """
+        Reserve messages without the queue lock from a pair of competing
+        queues and make sure no message is handed out twice.
+        """
+        queues = [
+            messagequeue.MessageQueue(optimistic=True),
+            messagequeue.MessageQueue(optimistic=True)
+        ]
+        for i in range(6):
+            self.queue.put(subject='/tests/optimistic', body='b%s' % i)
+
+        # Hold the lock throughout to prove reservation doesn't need it.
+        def reserve_all():
+            seen, turn = [], 0
+            while True:
+                reserved = queues[turn % 2].reserve_many(2)
+                if not reserved: return seen
+                seen.extend([ m.body for m in reserved ])
+                turn = turn + 1
+
+        seen = self.queue.run_with_lock(reserve_all)
+        self.assertEqual(sorted(seen), [ 'b%s' % i for i in range(6) ])
+
+    def test_optimistic_conflicts(self):
+        """
+        Make sure claims whose transactions keep conflicting are skipped and
+        left ready, and that with some conflicts every message is still
+        reserved exactly once.
+        """
+        queue = messagequeue.MessageQueue(optimistic=True)
+        for i in range(10):
+            queue.put(subject='/tests/conflicts', body='b%s' % i)
+
+        db.set_conflict_rate(1.0)
+        self.assertEqual(queue.reserve_many(5), [])
+        self.assertEqual(queue.gauges()['ready'], 10)
+
+        db.set_conflict_rate(0.7, seed=1)
+        seen = []
+        for i in range(20):
+            seen.extend([ m.body for m in queue.reserve_many(3) ])
+        self.assertEqual(sorted(seen), sorted([ 'b%s' % i for i in range(10) ]))
+
+    def test_shards(self):
+        """
+        Partition messages across shards and make sure workers assigned to a
+        shard only reserve from it, while an unassigned queue sees them all.
+        """
+        queue = messagequeue.MessageQueue(shard_count=4)
+        subjects = [ '/tests/shard/%s' % i for i in range(8) ]
+        for subject in subjects:
+            queue.put(subject=subject, body='by subject')
+        queue.put(subject='/tests/shard/keyed', body='by key', shard_key='k')
+
+        keyed = messagequeue.MessageQueue(shard_count=4,
+            shards=[ queue.shard_for('k') ]).reserve_many(10)
+        self.assert_('by key' in [ m.body for m in keyed ])
+        self.assert_(not [ m for m in keyed if m.shard != queue.shard_for('k') ])
+
+        rest = queue.reserve_many(20)
+        self.assertEqual(len(keyed) + len(rest), len(subjects) + 1)
+        for message in rest:
+            self.assertEqual(message.shard, queue.shard_for(message.subject))
+
+    def test_lease_expiry(self):
+        """
+        Abandon a reservation past its lease and make sure the message comes
+        back around until it runs out of attempts and is marked dead.
+        """
+        queue = messagequeue.MessageQueue(max_attempts=2)
+        queue.put(subject='/tests/lease', body='abandoned', lease_seconds=60)
+
+        def abandon(message):
+            message.lease_expires_at = \
+                datetime.datetime.now() - datetime.timedelta(seconds=1)
+            message.put()
+
+        # Nothing has expired yet, so nothing gets requeued.
+        message = queue.reserve()
+        self.assertEqual(message.attempts, 1)
+        self.assert_(message.lease_expires_at > datetime.datetime.now())
+        self.assertEqual(queue.requeue_expired(), 0)
+        self.assert_(queue.reserve() is None)
+
+        # An expired lease puts the message back in play.
+        abandon(message)
+        message = queue.reserve()
+        self.assertEqual(message.body, 'abandoned')
+        self.assertEqual(message.attempts, 2)
+
+        # Out of attempts, the message is dead and stays that way.
+        abandon(message)
+        self.assertEqual(queue.requeue_expired(), 0)
+        self.assert_(queue.reserve() is None)
+        message = messagequeue.QueuedMessage.get(message.key())
+        self.assert_(message.dead_at is not None)
+        self.assert_(not message.ready)
+
+    def test_lease_expiry_backlog(self):
+        """
+        Make sure abandoned reservations are put back every REQUEUE_SECONDS
+        even while there's a backlog for reserving to keep busy with.
+        """
+        queue = messagequeue.MessageQueue()
+        for i in range(10):
+            queue.put(subject='/tests/lease', body='b%s' % i)
+        message = queue.reserve()
+        message.lease_expires_at = \
+            datetime.datetime.now() - datetime.timedelta(seconds=1)
+        message.put()
+
+        # Not time to look yet, and reserving isn't coming up short.
+        self.assertEqual(queue.reserve().body, 'b1')
+        queue.REQUEUE_SECONDS = 0
+        message = queue.reserve()
+        self.assertEqual((message.body, message.attempts), ('b0', 2))
+
+    def test_process_batch(self):
+        """
+        Process a batch of messages and make sure they all get handed to
+        listeners and finished.
+        """
+        results = []
+        self.queue.add_listener('/tests/batch',
+            lambda message: results.append(message.body))
+        for i in range(4):
+            self.queue.put(subject='/tests/batch', body='b%s' % i)
+
+        messages = self.queue.process_batch(10)
+        self.assertEqual(len(messages), 4)
+        self.assertEqual(results, [ 'b0', 'b1', 'b2', 'b3' ])
+        self.assert_(not [ m for m in messages if m.finished_at is None ])
+        self.assertEqual(self.queue.process_batch(10), [])
+
     def test_scheduled_for(self):
         """
         Make sure a scheduled message doesn't get reserved until after its
@@ -162,6 +324,124 @@ class TestMessageQueue(unittest.TestCase):
         self.assertEqual(t_message4.body, 'message4')
         self.assert_(self.queue.reserve() is None)
 
+    def test_ready_flag(self):
+        """
+        Make sure the ready flag tracks reservation, completion, and
+        dependencies so that reservation never has to look past it.
+        """
+        subject  = '/tests/ready'
+        message1 = self.queue.put(subject=subject, body='message1')
+        message2 = self.queue.put(subject=subject, body='message2',
+            dependencies=[message1])
+        self.assert_(message1.ready)
+        self.assert_(not message2.ready)
+
+        t_message1 = self.queue.reserve()
+        self.assertEqual(t_message1.body, 'message1')
+        self.assert_(not t_message1.ready)
+
+        t_message1.finish()
+        self.assert_(messagequeue.QueuedMessage.get(message2.key()).ready)
+
+        # Depending on an already finished message shouldn't block anything.
+        message3 = self.queue.put(subject=subject, body='message3',
+            dependencies=[t_message1])
+        self.assert_(message3.ready)
+
+    def test_finish_lock(self):
+        """
+        Make sure finishing only takes the lock for messages with dependents,
+        and that one that can't get it is left reserved to finish later.
+        """
+        queue = messagequeue.MessageQueue(lock_timeout=0.1)
+        first = queue.put(subject='/tests/finish', body='first')
+        queue.put(subject='/tests/finish', body='second', 
+            dependencies=[ first ])
+        queue.put(subject='/tests/finish', body='alone')
+        first, alone = queue.reserve_many(2)
+
+        holder = messagequeue.MessageQueue()
+        holder.lock()
+        queue.finish(alone)
+        self.assertRaises(messagequeue.LockTimeout, queue.finish, first)
+        first = messagequeue.QueuedMessage.get(first.key())
+        self.assertEqual(first.finished_at, None)
+        self.assert_(first.lease_expires_at is not None)
+        holder.unlock()
+
+        queue.finish(first)
+        self.assertEqual(queue.reserve().body, 'second')
+
+    def test_dependency_counter(self):
+        """
+        Fan a bunch of messages into one and make sure its counter of pending
+        dependencies counts down as they finish.
+        """
+        subject = '/tests/fanin'
+        fetches = [ self.queue.put(subject=subject, body='fetch %s' % i)
+            for i in range(5) ]
+        aggregate = self.queue.put(subject=subject, body='aggregate',
+            dependencies=fetches)
+        self.assertEqual(aggregate.pending_dependencies, 5)
+
+        for i, message in enumerate(self.queue.reserve_many(10)):
+            self.assertEqual(message.body, 'fetch %s' % i)
+            self.queue.finish(message)
+            aggregate = messagequeue.QueuedMessage.get(aggregate.key())
+            self.assertEqual(aggregate.pending_dependencies, 4 - i)
+
+        self.assert_(aggregate.ready)
+        self.assertEqual(self.queue.reserve().body, 'aggregate')
+        self.assertEqual(
+            messagequeue.QueuedMessageDependency.all().count(), 0)
+
+    def test_put_group(self):
+        """
+        Submit a dependent group of messages in one go and make sure they get
+        reserved in dependency order, and that cycles are turned away.
+        """
+        subject = '/tests/group'
+        self.assertRaises(messagequeue.DependencyCycleError,
+            self.queue.put_group,
+            [ dict(subject=subject, body='m%s' % i) for i in range(3) ],
+            [ (0, 1), (1, 2), (2, 0) ])
+        self.assertRaises(ValueError, self.queue.put_group,
+            [ dict(subject=subject, body='m0') ], [ (0, 1) ])
+        self.assert_(self.queue.reserve() is None)
+
+        # m0 -> m1 -> m3, m2 -> m3
+        group = self.queue.put_group(
+            [ dict(subject=subject, body='m%s' % i) for i in range(4) ],
+            [ (0, 1), (1, 3), (2, 3) ])
+        self.assertEqual([ m.pending_dependencies for m in group ],
+            [ 0, 1, 0, 2 ])
+
+        order = []
+        while True:
+            message = self.queue.reserve()
+            if not message: break
+            order.append(message.body)
+            self.queue.finish(message)
+        self.assertEqual(len(order), 4)
+        self.assert_(order.index('m0') < order.index('m1') < order.index('m3'))
+        self.assert_(order.index('m2') < order.index('m3'))
+
+    def test_put_group_batches(self):
+        """
+        Make sure a group too big for one datastore batch is saved in several,
+        a chain of 1000 messages each depending on the one before.
+        """
+        count = 1000
+        group = self.queue.put_group(
+            [ dict(subject='/tests/group/big', body='m%s' % i) 
+                for i in range(count) ],
+            [ (i, i + 1) for i in range(count - 1) ])
+        self.assertEqual(messagequeue.QueuedMessage.all().count(), count)
+        self.assertEqual(messagequeue.QueuedMessageDependency.all().count(),
+            count - 1)
+        self.assertEqual(self.queue.reserve().body, 'm0')
+        self.assert_(self.queue.reserve() is None)
+
     def test_duplicate_signature(self):
         """
         Try out optional duplicate message restriction.
@@ -182,6 +462,246 @@ class TestMessageQueue(unittest.TestCase):
         self.assert_(self.queue.reserve() is not None)
         self.assert_(self.queue.reserve() is None)
 
+    def test_duplicate_signature_uncached(self):
+        """
+        Make sure duplicates are still caught once memcache has forgotten
+        about their signatures.
+        """
+        message1 = self.queue.put(subject='test subject', body='unique body',
+            allow_duplicate=False)
+        self.assert_(message1 is not None)
+
+        memcache.flush_all()
+        message2 = self.queue.put(subject='test subject', body='unique body',
+            allow_duplicate=False)
+        self.assert_(message2 is None)
+
+        # The second check should have warmed up the cache again.
+        self.assert_(memcache.get(
+            messagequeue.MessageQueue.SIGNATURE_KEY % message1.signature))
+
+    def test_duplicate_signature_released(self):
+        """
+        Make sure only messages put without duplicates allowed leave records
+        of their signatures, and that those go once the message is finished
+        or deleted, letting it be put again.
+        """
+        self.queue.put(subject='test subject', body='allowed')
+        self.assertEqual(
+            messagequeue.QueuedMessageSignature.all().count(), 0)
+
+        kw = dict(subject='test subject', body='unique', 
+            allow_duplicate=False)
+        self.assert_(self.queue.put(**kw) is not None)
+        self.assertEqual(
+            messagequeue.QueuedMessageSignature.all().count(), 1)
+        self.assert_(self.queue.put(**kw) is None)
+
+        for message in self.queue.reserve_many(2):
+            self.queue.finish(message)
+        self.assertEqual(
+            messagequeue.QueuedMessageSignature.all().count(), 0)
+        self.assert_(self.queue.put(**kw) is not None)
+
+        self.queue.purge(subject='test subject')
+        self.assert_(self.queue.put(**kw) is not None)
+        self.queue.compact(max_age=0)
+        self.assert_(self.queue.put(**kw) is None)
+
+    def test_duplicate_signature_cache(self):
+        """
+        Make sure memcache never blocks a signature once nothing unfinished
+        has it, whether its original was put with duplicates allowed,
+        finished through the Message itself, or flushed, and that while
+        there are no Messages with duplicates allowed, checks for new
+        signatures run no queries.
+        """
+        kw = dict(subject='test subject', body='cached',
+            allow_duplicate=False)
+        allowed = self.queue.put(subject='test subject', body='cached')
+        self.assert_(self.queue.put(**kw) is None)
+        self.queue.finish(self.queue.reserve())
+        unique = self.queue.put(**kw)
+        self.assert_(unique is not None)
+
+        self.queue.reserve().finish()
+        self.assert_(self.queue.put(**kw) is not None)
+
+        self.queue.flush_all()
+        queue = messagequeue.MessageQueue()
+        self.assert_(queue.put(**kw) is not None)
+
+        queries = []
+        def counting(cls, keys_only=False):
+            queries.append(cls)
+            return db.Model.all.im_func(cls, keys_only)
+        messagequeue.QueuedMessage.all = classmethod(counting)
+        try:
+            for i in range(5):
+                self.assert_(queue.put(subject='test subject',
+                    body='new %s' % i, allow_duplicate=False) is not None)
+        finally:
+            del messagequeue.QueuedMessage.all
+        self.assertEqual(queries, [])
+
+    def test_purge(self):
+        """
+        Purge messages in small batches, resuming from a cursor, and with
+        filters on subject and finish time.
+        """
+        for i in range(5):
+            self.queue.put(subject='/tests/purge/a', body='a%s' % i)
+            self.queue.put(subject='/tests/purge/b', body='b%s' % i)
+
+        count, cursor = self.queue.purge(subject='/tests/purge/a',
+            batch_size=2, max_batches=2)
+        self.assertEqual(count, 4)
+        self.assert_(cursor is not None)
+        count, cursor = self.queue.purge(subject='/tests/purge/a',
+            batch_size=2, cursor=cursor)
+        self.assertEqual(count, 1)
+        self.assert_(cursor is None)
+        self.assertEqual(messagequeue.QueuedMessage.all().count(), 5)
+
+        # Only finished messages go when purging by finish time.
+        for message in self.queue.reserve_many(3):
+            self.queue.finish(message)
+        count, cursor = self.queue.purge(
+            finished_before=datetime.datetime.now() +
+                datetime.timedelta(seconds=1))
+        self.assertEqual(count, 3)
+        self.assertEqual(messagequeue.QueuedMessage.all().count(), 2)
+
+    def test_purge_dependencies(self):
+        """
+        Make sure purging an unfinished message takes its dependencies with
+        it, rather than leaving what depends on it waiting forever.
+        """
+        first = self.queue.put(subject='/tests/purge/first', body='first')
+        second = self.queue.put(subject='/tests/purge/second', body='second',
+            dependencies=[ first ])
+        self.queue.put(subject='/tests/purge/third', body='third', 
+            dependencies=[ second ])
+
+        self.queue.purge(subject='/tests/purge/first')
+        second = messagequeue.QueuedMessage.get(second.key())
+        self.assertEqual(second.pending_dependencies, 0)
+        self.assertEqual(self.queue.reserve().body, 'second')
+        self.assertEqual(
+            messagequeue.QueuedMessageDependency.all().count(), 1)
+
+        self.queue.purge(subject='/tests/purge/second')
+        self.assertEqual(
+            messagequeue.QueuedMessageDependency.all().count(), 0)
+        self.assertEqual(self.queue.reserve().body, 'third')
+
+    def test_compact(self):
+        """
+        Compact finished messages by age and by count per subject, and make
+        sure they end up counted in summaries.
+        """
+        for i in range(6):
+            self.queue.put(subject='/tests/compact', body='c%s' % i)
+        self.queue.put(subject='/tests/compact', body='unfinished')
+
+        messages = self.queue.reserve_many(6)
+        for message in messages:
+            self.queue.finish(message)
+
+        # Backdate a couple of the messages past the retention age.
+        for message in messages[:2]:
+            message.finished_at = message.finished_at - \
+                datetime.timedelta(days=30)
+            message.put()
+
+        self.assertEqual(self.queue.compact(), 2)
+        self.assertEqual(messagequeue.QueuedMessage.all().count(), 5)
+
+        # Keep only the newest finished message for the subject.
+        self.assertEqual(self.queue.compact(max_age=None, max_count=1,
+            subjects=[ '/tests/compact' ]), 3)
+        remaining = [ m.body for m in messagequeue.QueuedMessage.all() ]
+        self.assertEqual(sorted(remaining), [ 'c5', 'unfinished' ])
+
+        summaries = messagequeue.QueuedMessageSummary.all().fetch(10)
+        self.assertEqual(len(summaries), 2)
+        self.assertEqual(sum([ s.count for s in summaries ]), 5)
+        self.assertEqual(sum([ s.attempts for s in summaries ]), 5)
+
+    def test_compact_dead(self):
+        """
+        Make sure dead messages past the retention age get compacted too,
+        counted in summaries and releasing anything waiting on them, and
+        that they can be purged by when they died.
+        """
+        queue = messagequeue.MessageQueue(max_attempts=1, retry_seconds=0)
+        queue.add_listener('/tests/dead', lambda message: 1 / 0)
+        for i in range(2):
+            queue.put(subject='/tests/dead', body='dead %s' % i)
+        dead = [ queue.process(), queue.process() ]
+        self.assert_(not [ m for m in dead if m.dead_at is None ])
+        waiting = queue.put(subject='/tests/waiting', body='waiting',
+            dependencies=[ dead[0] ])
+
+        dead[0].dead_at = dead[0].dead_at - datetime.timedelta(days=30)
+        dead[0].put()
+        self.assertEqual(queue.compact(), 1)
+        summary = messagequeue.QueuedMessageSummary.all().get()
+        self.assertEqual((summary.count, summary.dead), (0, 1))
+        self.assertEqual(queue.reserve().body, 'waiting')
+
+        later = datetime.datetime.now() + datetime.timedelta(seconds=1)
+        self.assertRaises(ValueError, queue.purge, finished_before=later,
+            dead_before=later)
+        count, cursor = queue.purge(dead_before=later)
+        self.assertEqual(count, 1)
+        self.assertEqual([ m.body for m in messagequeue.QueuedMessage.all() ],
+            [ 'waiting' ])
+
+    def test_backfill(self):
+        """
+        Make sure messages saved before the ready set, shards, lanes, and
+        timers existed can't be reserved until backfilled, and then come out
+        as they would have if put now, waiting on anything still pending.
+        """
+        queue = messagequeue.MessageQueue(shard_count=4)
+        first  = queue.put(subject='/tests/old/1', body='first')
+        second = queue.put(subject='/tests/old/2', body='second',
+            dependencies=[ first ])
+        later  = queue.put(subject='/tests/old/3', body='later',
+            scheduled_for=datetime.datetime.now() +
+                datetime.timedelta(hours=1))
+        abandoned = queue.put(subject='/tests/old/4', body='abandoned')
+
+        # Strip each down to what the queue saved before, with one left
+        # reserved and never finished.
+        old = [ 'ready', 'shard', 'lane', 'timer_at', 'pending_dependencies',
+            'lease_seconds', 'lease_expires_at', 'attempts', 'dead_at',
+            'unique', 'schema_version' ]
+        abandoned_at = datetime.datetime.now() - datetime.timedelta(hours=1)
+        for message in (first, second, later, abandoned):
+            values = db._entities[message.key()]
+            for name in old: values.pop(name, None)
+            if message is abandoned: values['reserved_at'] = abandoned_at
+        self.assertEqual(queue.reserve_many(10), [])
+
+        count, cursor = queue.backfill(batch_size=3)
+        self.assertEqual((count, cursor), (4, None))
+        self.assertEqual(queue.backfill(), (0, None))
+
+        for message in messagequeue.QueuedMessage.all():
+            self.assertEqual(message.shard, queue.shard_for(message.subject))
+            self.assertEqual(message.schema_version, queue.SCHEMA_VERSION)
+        self.assertEqual(messagequeue.QueuedMessage.get(second.key())\
+            .pending_dependencies, 1)
+        self.assert_(messagequeue.QueuedMessage.get(later.key()).timer_at)
+
+        self.assertEqual([ m.body for m in queue.reserve_many(10) ],
+            [ 'first', 'abandoned' ])
+        queue.finish(messagequeue.QueuedMessage.get(first.key()))
+        self.assertEqual(queue.reserve().body, 'second')
+        self.assert_(queue.reserve() is None)
+
     def test_listen_process(self):
         """
         Try out pairing listeners with a queue of messages and run through 
@@ -235,6 +755,468 @@ class TestMessageQueue(unittest.TestCase):
         # Finally, there should be no more messages left to reserve
         self.assert_(self.queue.reserve() is None)
 
+    def test_listener_patterns(self):
+        """
+        Register listeners with wildcard subject patterns and make sure
+        messages get routed to the right ones, in order of registration.
+        """
+        results = []
+        def make_listener(name):
+            return lambda message: results.append(
+                '%s-%s' % (name, message.body))
+
+        self.queue.add_listeners([
+            ( '/feeds/fetch/*', make_listener('one') ),
+            ( '/feeds/#', make_listener('all') ),
+            ( '/feeds/fetch', make_listener('exact') ),
+            ( '/feeds/*/atom', make_listener('atom') )
+        ])
+
+        self.queue.put(subject='/feeds/fetch', body='b1')
+        self.queue.put(subject='/feeds/fetch/atom', body='b2')
+        self.queue.put(subject='/feeds/fetch/atom/extra', body='b3')
+        self.queue.put(subject='/elsewhere', body='b4')
+        while self.queue.process(): pass
+
+        self.assertEqual(','.join(results), ','.join([
+            'all-b1', 'exact-b1',
+            'one-b2', 'all-b2', 'atom-b2',
+            'all-b3'
+        ]))
+
+    def test_listener_failures(self):
+        """
+        Make sure failing listeners get their messages retried, rejecting
+        listeners don't, and listeners that succeeded aren't run again.
+        """
+        queue = messagequeue.MessageQueue(retry_seconds=0, max_attempts=3)
+        calls = []
+
+        def steady(message):
+            calls.append('steady')
+        def flaky(message):
+            calls.append('flaky')
+            if calls.count('flaky') < 2:
+                raise messagequeue.RetryMessage('upstream timed out')
+        def broken(message):
+            calls.append('broken')
+            raise messagequeue.RejectMessage('malformed feed')
+
+        queue.add_listeners([
+            ( '/tests/failures', steady ),
+            ( '/tests/failures', flaky ),
+            ( '/tests/failures', broken )
+        ])
+        queue.put(subject='/tests/failures', body='b1')
+
+        # The first attempt leaves the message waiting on a retry.
+        message = queue.process()
+        self.assert_(message.finished_at is None)
+        self.assertEqual(message.get_outcomes(), {
+            '/tests/failures steady': 'success',
+            '/tests/failures flaky': 'retry',
+            '/tests/failures broken': 'failure'
+        })
+
+        # The second only runs the flaky listener, and finishes the message.
+        message = queue.process()
+        self.assert_(message.finished_at is not None)
+        self.assertEqual(calls, [ 'steady', 'flaky', 'broken', 'flaky' ])
+        self.assertEqual(message.get_outcomes()['/tests/failures flaky'],
+            'success')
+
+        # A listener that never recovers runs the message out of attempts.
+        queue.add_listener('/tests/hopeless', lambda message: 1 / 0)
+        queue.put(subject='/tests/hopeless', body='b2')
+        for i in range(3):
+            message = queue.process()
+            self.assertEqual(message.attempts, i + 1)
+        self.assert_(message.dead_at is not None)
+        self.assert_(queue.process() is None)
+
+    def test_listener_retry_delays(self):
+        """
+        Make sure a listener asking for a short retry delay doesn't cut
+        short the backoff of another that failed without asking, and that
+        only RetryMessage gets to ask.
+        """
+        queue = messagequeue.MessageQueue(retry_seconds=600)
+        class Slow(IOError):
+            delay = 1
+        def soon(message):
+            raise messagequeue.RetryMessage('try again soon', delay=1)
+        def failing(message):
+            raise Slow('upstream down')
+        queue.add_listeners([
+            ( '/tests/delays', soon ),
+            ( '/tests/delays', failing )
+        ])
+        queue.put(subject='/tests/delays', body='b1')
+
+        message = queue.process()
+        self.assert_(message.timer_at - datetime.datetime.now() >
+            datetime.timedelta(seconds=590))
+
+        queue.put(subject='/tests/delays/soon', body='b2')
+        queue.add_listener('/tests/delays/soon', soon)
+        message = queue.process()
+        self.assert_(message.timer_at - datetime.datetime.now() <
+            datetime.timedelta(seconds=2))
+
+    def test_anonymous_listeners(self):
+        """
+        Make sure listeners sharing a name on one subject each get their own
+        outcome, so one failing isn't hidden by another succeeding.
+        """
+        queue = messagequeue.MessageQueue()
+        def fail(message):
+            raise messagequeue.RetryMessage('not yet')
+        queue.add_listener('/tests/anonymous', lambda message: fail(message))
+        queue.add_listener('/tests/anonymous', lambda message: None)
+        queue.put(subject='/tests/anonymous', body='b1')
+
+        message = queue.process()
+        self.assertEqual(message.get_outcomes(), {
+            '/tests/anonymous <lambda>': 'retry',
+            '/tests/anonymous <lambda> #2': 'success'
+        })
+        self.assert_(message.finished_at is None)
+
+    def test_parallel_listeners(self):
+        """
+        Run a message's listeners concurrently and make sure they overlap,
+        and that one that runs past the timeout gets the message retried.
+        """
+        queue = messagequeue.MessageQueue(parallel_listeners=True,
+            listener_timeout=0.5)
+        def slow(message): time.sleep(0.3)
+        def slower(message): time.sleep(0.3)
+        def stuck(message): time.sleep(2)
+
+        queue.add_listeners([
+            ( '/tests/parallel', slow ),
+            ( '/tests/parallel', slower )
+        ])
+        queue.put(subject='/tests/parallel', body='b1')
+        start = time.time()
+        message = queue.process()
+        self.assert_(time.time() - start < 0.5)
+        self.assert_(message.finished_at is not None)
+
+        queue.add_listener('/tests/parallel/stuck', stuck)
+        queue.add_listener('/tests/parallel/stuck', slow)
+        queue.put(subject='/tests/parallel/stuck', body='b2')
+        start = time.time()
+        message = queue.process()
+        self.assert_(time.time() - start < 1)
+        self.assert_(message.finished_at is None)
+        self.assertEqual(message.get_outcomes(), {
+            '/tests/parallel/stuck stuck': 'retry',
+            '/tests/parallel/stuck slow': 'success'
+        })
+
+    def test_parallel_listeners_overlap(self):
+        """
+        Make sure a listener that timed out on a message isn't run on it
+        again while the first run carries on, and that the listener pool
+        runs no more at once than it has threads.
+        """
+        pool = messagequeue.ListenerPool(threads=2)
+        queue = messagequeue.MessageQueue(parallel_listeners=True,
+            listener_timeout=0.2, retry_seconds=0, listener_pool=pool)
+        released = threading.Event()
+        calls = []
+        def stuck(message):
+            calls.append('stuck')
+            released.wait()
+        def quick(message):
+            calls.append('quick')
+        queue.add_listeners([
+            ( '/tests/parallel', stuck ),
+            ( '/tests/parallel', quick )
+        ])
+        queue.put(subject='/tests/parallel', body='b1')
+
+        for i in range(2):
+            message = queue.process()
+            self.assert_(message.finished_at is None)
+        self.assertEqual(calls, [ 'stuck', 'quick' ])
+
+        released.set()
+        time.sleep(0.05)
+        message = queue.process()
+        self.assert_(message.finished_at is not None)
+        self.assertEqual(calls, [ 'stuck', 'quick', 'stuck' ])
+        self.assertEqual(len(pool._workers), 2)
+
+    def test_work(self):
+        """
+        Drain the queue with the worker loop and make sure it stops at the
+        deadline and reports what it got done.
+        """
+        results = []
+        self.queue.add_listener('/tests/work',
+            lambda message: results.append(message.body))
+        for i in range(5):
+            self.queue.put(subject='/tests/work', body='w%s' % i)
+
+        start = time.time()
+        stats = self.queue.work(deadline=0.5, batch_size=2, idle_sleep=0.1)
+        self.assert_(time.time() - start < 1.0)
+
+        self.assertEqual(len(results), 5)
+        self.assertEqual(stats['processed'], 5)
+        self.assert_(stats['batches'] >= 3)
+        self.assert_(stats['idle_seconds'] > 0)
+        self.assert_(stats['elapsed_seconds'] >= 0.5)
+
+    def test_work_handler(self):
+        """
+        Make sure the worker endpoint drains the queue into its listeners,
+        and refuses to run without any rather than finish messages unhandled.
+        """
+        results = []
+        class Worker(messagequeue.MessageQueueRequestHandler):
+            listeners = [ 
+                ('/tests/work', lambda message: results.append(message.body))
+            ]
+
+        def get(handler_class):
+            handler = handler_class()
+            handler.initialize(webapp.Request({ 'QUERY_STRING': 
+                'deadline=0.2&idle_sleep=0.05' }), webapp.Response())
+            handler.get()
+            return handler.response
+
+        self.queue.put(subject='/tests/work', body='w1')
+        response = get(messagequeue.MessageQueueRequestHandler)
+        self.assertEqual(response.status, 500)
+        self.assertEqual(self.queue.gauges()['ready'], 1)
+
+        response = get(Worker)
+        self.assertEqual(response.status, 200)
+        self.assert_('processed: 1' in response.out.getvalue())
+        self.assertEqual(results, [ 'w1' ])
+
+    def test_lanes(self):
+        """
+        Fill a bulk lane ahead of an interactive one, and make sure the
+        interactive lane still gets its weighted share of reservations, one
+        at a time or in batches, and that the bulk lane gets the rest once
+        the interactive lane runs dry.
+        """
+        queue = messagequeue.MessageQueue(
+            lanes=[ ('interactive', 3), ('bulk', 1) ], default_lane='bulk')
+        for i in range(20):
+            queue.put(subject='/tests/lanes', body='bulk %s' % i)
+        for i in range(10):
+            queue.put(subject='/tests/lanes', body='interactive %s' % i,
+                lane='interactive')
+
+        lanes = [ queue.reserve().lane for i in range(4) ]
+        self.assertEqual(lanes.count('interactive'), 3)
+        self.assertEqual(lanes.count('bulk'), 1)
+
+        lanes = [ m.lane for m in queue.reserve_many(4) ]
+        self.assertEqual(lanes.count('interactive'), 3)
+        self.assertEqual(lanes.count('bulk'), 1)
+
+        # Four interactive messages are left, the rest of the batch goes to
+        # the bulk lane.
+        lanes = [ m.lane for m in queue.reserve_many(8) ]
+        self.assertEqual(lanes.count('interactive'), 4)
+        self.assertEqual(lanes.count('bulk'), 4)
+
+        # Interactive messages put later are still reserved first.
+        queue.put(subject='/tests/lanes', body='late', lane='interactive')
+        self.assertEqual(queue.reserve().body, 'late')
+
+        self.assertEqual(queue.gauges()['lanes'],
+            { 'interactive': 0, 'bulk': 14 })
+        self.assertRaises(ValueError, queue.put, subject='/tests/lanes',
+            body='nowhere', lane='nowhere')
+
+    def test_lanes_one_at_a_time(self):
+        """
+        Reserve one message at a time while the lanes slowly fill and drain,
+        and make sure credit carried over between calls never gets more than
+        one message reserved at once.
+        """
+        queue = messagequeue.MessageQueue(
+            lanes=[ ('interactive', 5), ('default', 1), ('bulk', 1) ])
+        rand = random.Random(1)
+        for i in range(700):
+            for lane in ('interactive', 'default', 'bulk'):
+                if rand.random() < 0.3:
+                    queue.put(subject='/tests/lanes', body='%s %s' % 
+                        (lane, i), lane=lane)
+            messages = queue.reserve_many(1)
+            self.assert_(len(messages) <= 1, [ m.body for m in messages ])
+            for message in messages: queue.finish(message)
+
+    def test_timers(self):
+        """
+        Make sure messages scheduled for later stay out of the ready set
+        until they come due, and that priority orders the ready set.
+        """
+        later = datetime.datetime.now() + datetime.timedelta(seconds=0.3)
+        scheduled = self.queue.put(subject='/tests/timers', body='later',
+            scheduled_for=later, priority=10)
+        self.assertEqual(scheduled.ready, False)
+        self.assertEqual(scheduled.timer_at, later)
+
+        self.queue.put(subject='/tests/timers', body='low', priority=0)
+        self.queue.put(subject='/tests/timers', body='high', priority=5)
+
+        self.assertEqual(self.queue.promote_due(), 0)
+        self.assertEqual(self.queue.reserve().body, 'high')
+        self.assertEqual(self.queue.reserve().body, 'low')
+        self.assert_(self.queue.reserve() is None)
+
+        time.sleep(0.35)
+        message = self.queue.reserve()
+        self.assertEqual(message.body, 'later')
+        self.assertEqual(message.timer_at, None)
+
+    def test_stats(self):
+        """
+        Process some messages and make sure the queue's counters, timers,
+        and gauges account for them, both in this process and once flushed
+        into memcache.
+        """
+        stats = messagequeue.MessageQueueStats(flush_seconds=3600)
+        stats.clear_shared()
+        queue = messagequeue.MessageQueue(stats=stats)
+
+        def fail(message):
+            raise messagequeue.RetryMessage('not yet')
+        queue.add_listener('/tests/stats/ok', lambda message: None)
+        queue.add_listener('/tests/stats/fail', fail)
+
+        for i in range(3):
+            queue.put(subject='/tests/stats/ok', body='ok %s' % i)
+        queue.put(subject='/tests/stats/fail', body='fail')
+        queue.put(subject='/tests/stats/ok', body='later',
+            scheduled_for=datetime.datetime.now() +
+                datetime.timedelta(hours=1))
+
+        gauges = queue.gauges()
+        self.assertEqual(gauges['ready'], 4)
+        self.assertEqual(gauges['reserved'], 0)
+        self.assert_(gauges['oldest_ready_age_seconds'] >= 0)
+
+        self.assertEqual(len(queue.process_batch(10)), 4)
+
+        snapshot = stats.snapshot()
+        counters, timers = snapshot['counters'], snapshot['timers']
+        self.assertEqual(counters['reserve_calls'], 1)
+        self.assertEqual(counters['messages_reserved'], 4)
+        self.assertEqual(counters['messages_processed'], 4)
+        self.assertEqual(counters['messages_finished'], 3)
+        self.assertEqual(counters['messages_retried'], 1)
+        self.assertEqual(counters['listener_success'], 3)
+        self.assertEqual(counters['listener_retry'], 1)
+        # Only reserving takes the lock, since nothing has dependents.
+        self.assertEqual(counters['lock_acquired'], 1)
+        self.assertEqual(timers['process']['count'], 4)
+        self.assertEqual(timers['finish']['count'], 3)
+        self.assertEqual(timers['listener /tests/stats/fail fail']['count'], 1)
+        self.assert_(timers['reserve']['max_ms'] >= 0)
+
+        self.assertEqual(stats.shared()['counters']['messages_processed'], 0)
+        stats.flush()
+        shared = stats.shared()
+        self.assertEqual(shared['counters']['messages_processed'], 4)
+        self.assertEqual(shared['timers']['finish']['count'], 3)
+
+        gauges = queue.gauges()
+        self.assertEqual(gauges['ready'], 0)
+        self.assertEqual(gauges['dead'], 0)
+
+    def test_lock(self):
+        """
+        Make sure the lock is re-entrant, times out waiting on another holder,
+        can be renewed, and isn't released out from under a new holder once
+        it has lapsed.
+        """
+        stats = messagequeue.MessageQueueStats(flush_seconds=3600)
+        first = messagequeue.MessageQueue(stats=stats)
+        second = messagequeue.MessageQueue(stats=stats, lock_timeout=0.2)
+
+        token = first.lock()
+        self.assertEqual(first.lock(), token)
+        first.unlock()
+
+        start = time.time()
+        self.assertRaises(messagequeue.LockTimeout, second.lock)
+        self.assert_(0.2 <= time.time() - start < 0.5)
+        self.assertEqual(stats.counters['lock_timeouts'], 1)
+        self.assert_(stats.counters['lock_spins'] >= 2)
+
+        self.assert_(first.renew_lock())
+        first.unlock()
+        self.assert_(first.lock() != token)
+        first.unlock()
+
+        # Let the lock lapse, and have it taken by another queue.
+        first.lock()
+        memcache.delete(first.MUTEX_KEY)
+        second_token = second.lock()
+        self.assertEqual(first.renew_lock(), False)
+        first.unlock()
+        self.assertEqual(memcache.get(first.MUTEX_KEY), second_token)
+        self.assertEqual(stats.counters['lock_lost'], 2)
+        second.unlock()
+        self.assertEqual(memcache.get(first.MUTEX_KEY), None)
+
+    def test_lock_calls(self):
+        """
+        Make sure taking and letting go of an uncontended lock costs just
+        the one memcache call each.
+        """
+        queue = messagequeue.MessageQueue(
+            stats=messagequeue.MessageQueueStats(flush_seconds=3600))
+        calls = []
+        originals = {}
+        def counting(name):
+            def call(*args, **kw):
+                calls.append(name)
+                return originals[name](*args, **kw)
+            return call
+        for name in ('get', 'add', 'set', 'delete', 'incr'):
+            originals[name] = getattr(memcache, name)
+            setattr(memcache, name, counting(name))
+        try:
+            queue.lock()
+            queue.unlock()
+        finally:
+            for name, original in originals.items():
+                setattr(memcache, name, original)
+        self.assertEqual(calls, [ 'add', 'delete' ])
+        self.assertEqual(memcache.get(queue.MUTEX_KEY), None)
+
+    def test_put_lock_timeout(self):
+        """
+        Make sure a put with dependencies that can't get the lock saves
+        nothing, so that it can simply be tried again.
+        """
+        queue = messagequeue.MessageQueue(lock_timeout=0.1)
+        first = queue.put(subject='/tests/put', body='first')
+
+        holder = messagequeue.MessageQueue()
+        holder.lock()
+        self.assertRaises(messagequeue.LockTimeout, queue.put, 
+            subject='/tests/put', body='second', dependencies=[ first ],
+            allow_duplicate=False)
+        holder.unlock()
+        self.assertEqual(messagequeue.QueuedMessage.all().count(), 1)
+
+        second = queue.put(subject='/tests/put', body='second', 
+            dependencies=[ first ], allow_duplicate=False)
+        self.assertEqual(second.pending_dependencies, 1)
+        queue.finish(queue.reserve())
+        self.assertEqual(queue.reserve().body, 'second')
+
     def test_everything(self):
         """ """
         pass